@@ -0,0 +1,102 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares messages bodies conversion with the converters against the naive
+per-message conversion on realistic messages corpora.
+
+Run from the repository root as:
+  PYTHONPATH=. python contrib/benchmarks/converters.py [--messages N] [--repeats-ratio R]
+"""
+
+import argparse
+import random
+import timeit
+
+import html2text
+import markdown
+
+from pumaduct.converters import create_converter
+
+WORDS = (
+    "hello", "meeting", "tomorrow", "sure", "thanks", "link", "please", "check",
+    "the", "a", "is", "will", "see", "you", "later", "ok", "document", "review")
+
+def _text(rnd):
+  return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))).capitalize()
+
+def generate_corpora(num_messages, repeats_ratio):
+  """Generates bodies of messages from IM networks (HTML) and from Matrix (Markdown).
+
+  Most messages are short plain text, some have formatting and `repeats_ratio`
+  of them repeat earlier ones, e.g. greetings or bots notifications."""
+  rnd = random.Random(0)
+  html_bodies = []
+  markdown_bodies = []
+  for i in range(num_messages):
+    if i and rnd.random() < repeats_ratio:
+      html_bodies.append(rnd.choice(html_bodies))
+      markdown_bodies.append(rnd.choice(markdown_bodies))
+      continue
+    text = _text(rnd)
+    kind = rnd.random()
+    if kind < 0.7:
+      html_bodies.append(text)
+      markdown_bodies.append(text)
+    elif kind < 0.9:
+      html_bodies.append("<b>{0}</b> {1}".format(text, _text(rnd)))
+      markdown_bodies.append("**{0}** {1}".format(text, _text(rnd)))
+    else:
+      html_bodies.append("{0}<br>{1} &amp; <a href=\"http://example.com\">{2}</a>".format(
+          text, _text(rnd), _text(rnd)))
+      markdown_bodies.append("{0}\n- {1}\n- [{2}](http://example.com)".format(
+          text, _text(rnd), _text(rnd)))
+  return html_bodies, markdown_bodies
+
+def _naive_html2text(body):
+  return html2text.HTML2Text().handle(body)
+
+def _measure(func, bodies):
+  return timeit.timeit(lambda: [func(body) for body in bodies], number=3) / 3 / len(bodies)
+
+def run(num_messages, repeats_ratio, cache_size):
+  """Returns per-message conversion times in microseconds and converters statistics."""
+  html_bodies, markdown_bodies = generate_corpora(num_messages, repeats_ratio)
+  results = {}
+  results["html2text_naive_us"] = _measure(_naive_html2text, html_bodies) * 1e6
+  results["markdown_naive_us"] = _measure(markdown.markdown, markdown_bodies) * 1e6
+  # New converters per measurement, so that the cache is warmed up only within the run.
+  for (name, bodies) in (("html2text", html_bodies), ("markdown", markdown_bodies)):
+    converter = create_converter(name, cache_size)
+    results[name + "_converter_us"] = timeit.timeit(
+        lambda: [converter.convert(body) for body in bodies], number=1) / len(bodies) * 1e6
+    results[name + "_stats"] = converter.stats()
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description="PuMaDuct messages converters benchmark.")
+  parser.add_argument("--messages", type=int, default=10000)
+  parser.add_argument("--repeats-ratio", type=float, default=0.1)
+  parser.add_argument("--cache-size", type=int, default=1000)
+  args = parser.parse_args()
+  for key, value in run(args.messages, args.repeats_ratio, args.cache_size).items():
+    print("{0}: {1:.1f}".format(key, value) if isinstance(value, float) else
+          "{0}: {1}".format(key, value))
+
+if __name__ == "__main__":
+  main()
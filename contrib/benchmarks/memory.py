@@ -0,0 +1,110 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures memory used by the in-memory accounts, contacts and rooms state.
+
+Run from the repository root as:
+  PYTHONPATH=. python contrib/benchmarks/memory.py [--contacts N] [--contacts-per-account N]
+"""
+
+import argparse
+import json
+import tracemalloc
+
+from pumaduct.layers.base import Account, BaseLayer, Room
+from pumaduct.utils import intern_id
+
+NETWORK = "prpl-jabber"
+
+CONF = {
+    "networks": {
+        NETWORK: {
+            "prefix": "xmpp",
+            "ext_pattern": "^((?P<user>[^@]+)@)?(?P<host>[^/@]+)(/(?P<resource>.*))?$",
+            "ext_format": "{user}@{host}"}},
+    "hs_server": "https://localhost:8448",
+    "users_blacklist": [],
+    "users_whitelist": [],
+    "max_cache_items": 1000
+}
+
+def _measure(func):
+  before = tracemalloc.take_snapshot()
+  result = func()
+  after = tracemalloc.take_snapshot()
+  size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+  return result, size
+
+def run(num_contacts, contacts_per_account):
+  """Builds the state for the given number of contacts and returns bytes per object."""
+  base = BaseLayer(CONF, None, None, {}, None, None, None, None)
+  num_accounts = max(1, num_contacts // contacts_per_account)
+  # Contacts are shared between accounts, as it's typically the case
+  # for popular contacts, which makes MXIDs duplication more visible.
+  ext_contacts = [
+      "contact{0}@example.com".format(i) for i in range(contacts_per_account * 2)]
+  # Matrix IDs arrive in JSON-decoded events, so every occurrence is a new string.
+  users = ["@user{0}:localhost".format(i) for i in range(num_accounts)]
+
+  def create_accounts():
+    for i, user in enumerate(users):
+      base.accounts[intern_id(json.loads(json.dumps(user)))].append(Account(
+          i, json.loads(json.dumps(NETWORK)), "user{0}@example.com".format(i),
+          "password", None, CONF["networks"][NETWORK], None))
+
+  def add_contacts():
+    for i, accounts in enumerate(base.accounts.values()):
+      for j in range(contacts_per_account):
+        ext_contact = ext_contacts[(i + j) % len(ext_contacts)]
+        contact = base.ext_contact_to_mxid(NETWORK, ext_contact)
+        base.add_contact(accounts[0], ext_contact, contact)
+
+  def add_rooms():
+    for i, (user, accounts) in enumerate(base.accounts.items()):
+      for contact in accounts[0].contacts:
+        event = json.loads(json.dumps({"sender": user, "state_key": contact}))
+        room = Room(event["sender"])
+        room.members.add(intern_id(event["state_key"]))
+        base.rooms["!room{0}-{1}:localhost".format(i, len(base.rooms))] = room
+
+  tracemalloc.start()
+  _, accounts_size = _measure(create_accounts)
+  _, contacts_size = _measure(add_contacts)
+  _, rooms_size = _measure(add_rooms)
+  tracemalloc.stop()
+  num_rooms = len(base.rooms)
+  return {
+      "accounts": num_accounts,
+      "contacts": num_accounts * contacts_per_account,
+      "rooms": num_rooms,
+      "bytes_per_account": accounts_size / num_accounts,
+      "bytes_per_contact": contacts_size / (num_accounts * contacts_per_account),
+      "bytes_per_room": rooms_size / num_rooms}
+
+def main():
+  parser = argparse.ArgumentParser(description="PuMaDuct memory usage benchmark.")
+  parser.add_argument("--contacts", type=int, default=100000)
+  parser.add_argument("--contacts-per-account", type=int, default=100)
+  args = parser.parse_args()
+  for key, value in run(args.contacts, args.contacts_per_account).items():
+    print("{0}: {1:.1f}".format(key, value) if isinstance(value, float) else
+          "{0}: {1}".format(key, value))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,88 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the storage size and the decoding cost of offline messages payloads
+stored as JSON strings and encoded by the payload codec.
+
+Run from the repository root as:
+  PYTHONPATH=. python contrib/benchmarks/payload_codec.py [--messages N] [--compression zlib]
+"""
+
+import argparse
+import json
+import random
+import timeit
+
+from pumaduct.payload_codec import PayloadCodec
+
+WORDS = (
+    "hello", "meeting", "tomorrow", "sure", "thanks", "link", "please", "check",
+    "the", "a", "is", "will", "see", "you", "later", "ok", "document", "review")
+
+def _text(rnd, num_words):
+  return " ".join(rnd.choice(WORDS) for _ in range(num_words))
+
+def generate_payloads(num_messages):
+  """Generates the mix of short, long and formatted text payloads."""
+  rnd = random.Random(0)
+  payloads = []
+  for i in range(num_messages):
+    kind = i % 4
+    if kind in (0, 1):
+      payloads.append({"msgtype": "m.text", "body": _text(rnd, rnd.randint(1, 10))})
+    elif kind == 2:
+      payloads.append({"msgtype": "m.text", "body": _text(rnd, rnd.randint(50, 200))})
+    else:
+      body = _text(rnd, rnd.randint(20, 100))
+      payloads.append({
+          "msgtype": "m.text", "body": body, "format": "org.matrix.custom.html",
+          "formatted_body": "<p><b>{0}</b></p>".format(body)})
+  return payloads
+
+def run(num_messages, compression, threshold):
+  """Returns the sizes and per-message decoding times for both storage formats."""
+  codec = PayloadCodec(compression, threshold)
+  payloads = generate_payloads(num_messages)
+  json_rows = [json.dumps(payload) for payload in payloads]
+  encoded_rows = [codec.encode(payload) for payload in payloads]
+  json_decode = timeit.timeit(lambda: [json.loads(row) for row in json_rows], number=5) / 5
+  codec_decode = timeit.timeit(
+      lambda: [codec.decode(row) for row in encoded_rows], number=5) / 5
+  json_size = sum(len(row.encode("utf8")) for row in json_rows)
+  encoded_size = sum(len(row) for row in encoded_rows)
+  return {
+      "messages": num_messages,
+      "json_bytes": json_size,
+      "encoded_bytes": encoded_size,
+      "size_ratio": encoded_size / json_size,
+      "json_decode_us_per_message": json_decode / num_messages * 1e6,
+      "codec_decode_us_per_message": codec_decode / num_messages * 1e6}
+
+def main():
+  parser = argparse.ArgumentParser(description="PuMaDuct payload codec benchmark.")
+  parser.add_argument("--messages", type=int, default=10000)
+  parser.add_argument("--compression", default="zlib")
+  parser.add_argument("--threshold", type=int, default=256)
+  args = parser.parse_args()
+  for key, value in run(args.messages, args.compression, args.threshold).items():
+    print("{0}: {1:.3f}".format(key, value) if isinstance(value, float) else
+          "{0}: {1}".format(key, value))
+
+if __name__ == "__main__":
+  main()
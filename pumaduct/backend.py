@@ -40,9 +40,9 @@ class Backend(object): # pylint:disable=too-many-instance-attributes
   """Creates and manages all backend processing layers."""
 
   def __init__(self, conf, glib, matrix_client, clients, db_session,
-               account_storage, message_storage):
+               account_storage, message_storage, sent_event_storage):
     self.base = BaseLayer(conf, glib, matrix_client, clients, db_session,
-                          account_storage, message_storage)
+                          account_storage, message_storage, sent_event_storage)
     self.connection = ConnectionLayer(conf, self.base)
     self.messages = MessagesLayer(conf, self.base)
     self.typing = TypingLayer(conf, self.base)
@@ -0,0 +1,52 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Caching primitives used by PuMaDuct."""
+
+from cachetools import LRUCache
+
+class StatsLRUCache(LRUCache):
+  """LRU cache that keeps track of its hits and misses."""
+
+  def __init__(self, maxsize, getsizeof=None):
+    super(StatsLRUCache, self).__init__(maxsize, getsizeof)
+    self.hits = 0
+    self.misses = 0
+
+  def lookup(self, key, default=None):
+    """Returns cached value for the key or `default`, updating the statistics."""
+    if key in self:
+      self.hits += 1
+      return self[key]
+    self.misses += 1
+    return default
+
+  def hit_rate(self):
+    """Returns the ratio of lookups that were served from the cache."""
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+  def stats(self):
+    """Returns the summary of the cache usage as a dict."""
+    return {
+        "size": self.currsize,
+        "maxsize": self.maxsize,
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hit_rate()}
@@ -0,0 +1,179 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Converters of messages bodies between text and markup formats."""
+
+import re
+import threading
+
+import html2text
+import markdown
+
+from pumaduct.cache import StatsLRUCache
+
+class ConverterBase(object):
+  """
+  Converts messages bodies, caching the results for repeated bodies.
+
+  Most of the messages are short plain text, for which the conversion result
+  is known upfront: such bodies are detected with the cheap check and bypass
+  both the converter and the cache.
+  """
+  def __init__(self, cache_size):
+    self.cache = StatsLRUCache(maxsize=cache_size)
+    self.plain = 0
+
+  def convert(self, body):
+    """Returns the converted body."""
+    if self._is_plain(body):
+      self.plain += 1
+      return self._convert_plain(body)
+    result = self.cache.lookup(body)
+    if result is None:
+      result = self._convert(body)
+      self.cache[body] = result
+    return result
+
+  def stats(self):
+    """Returns the summary of the converter usage as a dict."""
+    stats = self.cache.stats()
+    stats["plain"] = self.plain
+    return stats
+
+  def _is_plain(self, body):
+    raise NotImplementedError()
+
+  def _convert_plain(self, body):
+    raise NotImplementedError()
+
+  def _convert(self, body):
+    raise NotImplementedError()
+
+# Single line without HTML tags, entities or anything html2text would escape,
+# collapse or wrap, so that html2text leaves it intact.
+HTML2TEXT_PLAIN_RE = re.compile(r"^(?![-+\d=#>*\s])(?:[^\s<&\\`*_\[\]]| (?! |\Z))*\Z")
+
+class Html2TextConverter(ConverterBase):
+  """Converts HTML to text with html2text."""
+
+  def __init__(self, cache_size):
+    super(Html2TextConverter, self).__init__(cache_size)
+    self.converter = html2text.HTML2Text()
+
+  def _is_plain(self, body):
+    return len(body) <= self.converter.body_width and HTML2TEXT_PLAIN_RE.match(body)
+
+  def _convert_plain(self, body):
+    return body
+
+  def _convert(self, body):
+    text = self.converter.handle(body)
+    # html2text ends the converted text with two newlines, strip them.
+    if text.endswith("\n\n"):
+      text = text[:-2]
+    return text
+
+# Single line without anything Markdown would treat as formatting.
+MARKDOWN_PLAIN_RE = re.compile(r"^(?![-+\d=#>*\s])(?:[^\s\\`*_\[\]!<>&~]| )*(?<! )\Z")
+
+class MarkdownConverter(ConverterBase):
+  """Converts Markdown text to HTML."""
+
+  def __init__(self, cache_size):
+    super(MarkdownConverter, self).__init__(cache_size)
+    self.converter = markdown.Markdown()
+
+  def _is_plain(self, body):
+    return MARKDOWN_PLAIN_RE.match(body)
+
+  def _convert_plain(self, body):
+    return "<p>{0}</p>".format(body) if body else ""
+
+  def _convert(self, body):
+    # Markdown instance keeps the state of the last conversion, so must be reset.
+    return self.converter.reset().convert(body)
+
+CONVERTERS = {
+    "html2text": Html2TextConverter,
+    "markdown": MarkdownConverter}
+
+# Converters used by `convert_body` are only meant for large bodies, which rarely repeat.
+WORKER_CACHE_SIZE = 16
+
+_worker_local = threading.local()
+
+def create_converter(name, cache_size):
+  """Creates the converter with the given name, returns None if it's unknown."""
+  if name in CONVERTERS:
+    return CONVERTERS[name](cache_size)
+  return None
+
+class BodyConverters(object):
+  """
+  Converters of the message bodies, created on first use per network and name.
+
+  Large bodies are converted by the worker pool, so that these don't stall
+  the main loop.
+  """
+  def __init__(self, pool, cache_size, offload_threshold):
+    self.pool = pool
+    self.cache_size = cache_size
+    self.offload_threshold = offload_threshold
+    self.converters = {}
+
+  def get(self, network, name):
+    """Returns the converter with the given name for the network."""
+    key = (network, name)
+    converter = self.converters.get(key)
+    if not converter:
+      converter = create_converter(name, self.cache_size)
+      self.converters[key] = converter
+    return converter
+
+  def convert_ordered(self, key, network, name, body, callback):
+    """Converts the body with the converter `name`, if any, then calls `callback`
+    with the result after the callbacks of the preceding conversions with the same key."""
+    if name and body:
+      # The body is sent as is if it cannot be converted.
+      if len(body) >= self.offload_threshold:
+        self.pool.submit(
+            key, callback, convert_body, (name, body),
+            error_callback=lambda _: callback(body))
+      else:
+        self.pool.submit(
+            key, callback, self.get(network, name).convert, (body,), offload=False,
+            error_callback=lambda _: callback(body))
+    else:
+      self.pool.submit(key, lambda: callback(body))
+
+  def stats(self):
+    """Returns usage statistics for all converters."""
+    return {
+        "{0}/{1}".format(network, name): converter.stats()
+        for ((network, name), converter) in self.converters.items()}
+
+def convert_body(name, body):
+  """Converts the body with the converter of the calling thread, for worker pools.
+
+  Converters are not thread-safe, so each worker thread or process has its own ones."""
+  if not hasattr(_worker_local, "converters"):
+    _worker_local.converters = {}
+  if name not in _worker_local.converters:
+    _worker_local.converters[name] = create_converter(name, WORKER_CACHE_SIZE)
+  return _worker_local.converters[name].convert(body)
@@ -95,6 +95,11 @@ def main_context_invoke(callback):
   add_callback(callback, None)
   g_main_context_invoke(NULL, <GSourceFunc>on_onetime_cb, <gpointer>callback)
 
+def timeout_add(interval, callback):
+  tag = g_timeout_add(interval, <GSourceFunc>on_repeated_cb, <gpointer>callback)
+  add_callback(callback, tag)
+  return tag
+
 def timeout_add_seconds(interval, callback):
   tag = g_timeout_add_seconds(interval, <GSourceFunc>on_repeated_cb, <gpointer>callback)
   add_callback(callback, tag)
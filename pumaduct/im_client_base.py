@@ -41,6 +41,7 @@ class ImClientBase(metaclass=ABCMeta):
   * "new-file": network, user, conversation_id, contact,
       direction, description, file, time
   * "conversation-destroyed": network, user, conversation_id
+  * "chat-joined": network, user, conversation_id, chat_name
   * "contact-updated": network, user, contact, displayname
   * "request-input": network, user, title, primary, secondary,
       default_value, ok_callback, cancel_callback.
@@ -78,6 +79,14 @@ class ImClientBase(metaclass=ABCMeta):
   def create_conversation(self, network, user, contact):
     raise NotImplementedError()
 
+  def create_chat(self, network, user, chat_name, contacts):
+    """Joins (creating if needed) the multi-user chat and invites the contacts there.
+
+    Returns the conversation ID if the chat is already joined, otherwise
+    returns None and fires "chat-joined" callback once the chat is joined."""
+    del user, chat_name, contacts # Unused.
+    raise ClientError("Network '{0}' doesn't support chats".format(network))
+
   @abstractmethod
   def send_message(self, network, user, conversation, message):
     raise NotImplementedError()
@@ -19,18 +19,24 @@
 
 """Base layer for the bridge that provides the infrastructure for all other layers."""
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 import functools
 import logging
 import re
+import time
 import urllib.parse
 
-from cachetools import LRUCache
-
+from pumaduct.cache import StatsLRUCache
 from pumaduct.layers.layer_base import LayerBase
+from pumaduct.storage import maintain
+from pumaduct.storage_service import DEFAULT_STORAGE_BATCH_SIZE, StorageService
+from pumaduct.utils import intern_id
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_DB_MAINTENANCE_INTERVAL = 86400
+DEFAULT_DB_VACUUM_PAGES = 1000
+
 class InternalError(Exception):
   """Exception class indicating internal / logic errors in the code."""
   pass
@@ -42,6 +48,10 @@ class Account(object):
   Matrix user ID is stored as a key in the corresponding dictionary
   data structure, hence not present here.
   """
+  __slots__ = (
+      "id", "network", "ext_user", "password", "auth_token",
+      "config", "client", "connected", "contacts")
+
   def __init__(self, id_=None, network=None, ext_user=None, password=None,
                auth_token=None, config=None, client=None):
     """
@@ -61,7 +71,7 @@ class Account(object):
       stored in Matrix ID format, e.g. '@xmpp-user%jabber.org:localhost'.
     """
     self.id = id_ # pylint: disable=invalid-name
-    self.network = network
+    self.network = intern_id(network)
     self.ext_user = ext_user
     self.password = password
     self.auth_token = auth_token
@@ -76,6 +86,8 @@ class Room(object):
 
   Only the rooms that have at least one of the bridge-managed contacts are tracked.
   """
+  __slots__ = ("user", "conv_id", "chat_id", "members", "last_active")
+
   def __init__(self, user=None, conv_id=None):
     """
     :param user: Matrix ID of the user that either created or owns this room.
@@ -86,15 +98,39 @@ class Room(object):
     * `members`: tracks the set of members for this room on the external network. Only
       bridge-managed external users are stored here, not every member of the room. The
       contacts are stored in Matrix ID format.
+    * `chat_id`: client opaque conversation ID of the multi-user chat this room is
+      bridged to, if any.
+    * `last_active`: monotonic time of the last room access, used for idle rooms eviction.
     """
-    self.user = user
+    self.user = intern_id(user)
     self.conv_id = conv_id
+    self.chat_id = None
     self.members = set()
+    self.last_active = time.monotonic()
+
+class Ghost(object):
+  """
+  Represents the state of the Matrix user of the external contact, shared
+  by all accounts that have this contact.
+  """
+  __slots__ = ("profile_synced", "statuses", "presence")
+
+  def __init__(self):
+    """
+    * `profile_synced`: whether the Matrix user is registered and its profile is synced.
+    * `statuses`: last status of the contact reported by each account, keyed by account.
+    * `presence`: last status published to Matrix and its monotonic time, if any.
+    """
+    self.profile_synced = False
+    self.statuses = {}
+    self.presence = None
 
 class ClientsCallbackConfig(object):
   """
   Represents single instance of the callback registered with the clients.
   """
+  __slots__ = ("callback_id", "callback", "map_account", "dispatcher")
+
   def __init__(self, callback_id=None, callback=None, map_account=False):
     """
     :param callback_id: ID of the callback on the clients side.
@@ -111,6 +147,68 @@ class ClientsCallbackConfig(object):
     self.map_account = map_account
     self.dispatcher = None
 
+class ContactsMapping(object):
+  """
+  Network-scoped bidirectional mapping between external contacts and MXIDs.
+
+  Only the contacts that are present in `Account.contacts` of some account are
+  stored here: their translations are computed once, when the contact is added,
+  and are kept for as long as at least one account references the contact.
+  """
+  def __init__(self):
+    self.to_mxids = defaultdict(dict)
+    self.to_ext_contacts = defaultdict(dict)
+    # Maps (network, MXID) to all external IDs known to translate to this MXID.
+    self.ext_ids = {}
+    self.refs = Counter()
+
+  def add(self, network, contact, ext_contact, alias=None):
+    """Records the translations for the contact and adds the reference to it.
+
+    :param ext_contact: canonical external ID used for MXID -> external ID translation.
+    :param alias: optional external ID reported by the client, if different.
+    """
+    key = (network, contact)
+    ext_ids = self.ext_ids.setdefault(key, set())
+    for ext_id in (ext_contact, alias):
+      if ext_id:
+        ext_ids.add(ext_id)
+        self.to_mxids[network][ext_id] = contact
+    self.to_ext_contacts[network][contact] = ext_contact
+    self.refs[key] += 1
+
+  def remove(self, network, contact):
+    """Removes the reference to the contact, dropping its translations once unused.
+
+    Returns True if the translations were dropped."""
+    key = (network, contact)
+    if key not in self.refs:
+      return False
+    self.refs[key] -= 1
+    if self.refs[key] <= 0:
+      del self.refs[key]
+      for ext_id in self.ext_ids.pop(key):
+        # The external ID might have been taken over by another contact since.
+        if self.to_mxids[network].get(ext_id) == contact:
+          del self.to_mxids[network][ext_id]
+      del self.to_ext_contacts[network][contact]
+      if not self.to_ext_contacts[network]:
+        del self.to_mxids[network], self.to_ext_contacts[network]
+      return True
+    return False
+
+  def get_mxid(self, network, ext_contact):
+    """Returns MXID for the known external contact or None."""
+    if network in self.to_mxids:
+      return self.to_mxids[network].get(ext_contact)
+    return None
+
+  def get_ext_contact(self, network, contact):
+    """Returns external contact for the known MXID or None."""
+    if network in self.to_ext_contacts:
+      return self.to_ext_contacts[network].get(contact)
+    return None
+
 class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
   """Base layer for the bridge that provides the infrastructure for all other layers."""
 
@@ -124,33 +222,129 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
       "m.room.power_levels",
       "m.room.join_rules",
       "m.room.history_visibility",
-      "m.room.guest_access"])
+      "m.room.guest_access",
+      "m.receipt"])
+  # Keys of the transaction the ephemeral events are pushed under, as per
+  # the appservice ephemeral events proposal (MSC2409), unstable one first.
+  EPHEMERAL_EVENTS_KEYS = ("de.sorunome.msc2409.ephemeral", "ephemeral")
   ADMIN_POWER_LEVEL = 100
+  ROOMS_EVICTION_CHECKS = 4
 
   def __init__(self, conf, glib, matrix_client, clients,
-               db_session, account_storage, message_storage):
+               db_session, account_storage, message_storage, sent_event_storage):
     self.glib = glib
     self.matrix_client = matrix_client
     self.clients = clients
-    self.db_session = db_session
+    # All DB access goes through the storage service, so that it doesn't block the main loop.
+    self.storage = StorageService(
+        glib, db_session,
+        conf["storage_thread"] if "storage_thread" in conf else True,
+        conf["storage_batch_size"] if "storage_batch_size" in conf
+        else DEFAULT_STORAGE_BATCH_SIZE)
     self.account_storage = account_storage
     self.message_storage = message_storage
+    self.sent_event_storage = sent_event_storage
     self.networks = conf["networks"]
     self.hs_host = _parse_hs_host(conf["hs_server"])
     self.users_blacklist = conf["users_blacklist"]
     self.users_whitelist = conf["users_whitelist"]
     self.accounts = defaultdict(list)
-    self.rooms = defaultdict(Room)
+    self.rooms = {}
+    # Number of the tracked rooms each contact is a member of.
+    self.member_rooms = Counter()
+    # IDs of the rooms bridged to the multi-user chats, keyed by (user, chat ID).
+    self.chat_rooms = {}
     self.transaction_callbacks = defaultdict(list)
     self.clients_callbacks = defaultdict(list)
-    self.mxids_to_ext_contacts = LRUCache(maxsize=conf["max_cache_items"])
-    self.ext_contacts_to_mxids = LRUCache(maxsize=conf["max_cache_items"])
-    self.senders_access = LRUCache(maxsize=conf["max_cache_items"])
+    self.rooms_callbacks = defaultdict(list)
+    # Rooms that weren't accessed for that long are dropped from memory, they're
+    # restored on demand from Matrix server state or stored offline messages.
+    if "room_idle_timeout" in conf:
+      self.room_idle_timeout = conf["room_idle_timeout"]
+    else:
+      self.room_idle_timeout = None
+    self.rooms_eviction_cb = None
+    self.db_maintenance_interval = (
+        conf["db_maintenance_interval"] if "db_maintenance_interval" in conf
+        else DEFAULT_DB_MAINTENANCE_INTERVAL)
+    self.db_vacuum_pages = (
+        conf["db_vacuum_pages"] if "db_vacuum_pages" in conf else DEFAULT_DB_VACUUM_PAGES)
+    self.db_maintenance_cb = None
+    # Translations for the contacts of known accounts are kept in 'contacts_mapping',
+    # bounded caches below are used only for the IDs that are not on any contacts list.
+    self.contacts_mapping = ContactsMapping()
+    # State of the contacts Matrix users, shared by all accounts having the contact.
+    self.ghosts = {}
+    self.mxids_to_ext_contacts = StatsLRUCache(
+        maxsize=_get_cache_size(conf, "mxids_cache_items"))
+    self.ext_contacts_to_mxids = StatsLRUCache(
+        maxsize=_get_cache_size(conf, "ext_contacts_cache_items"))
+    self.senders_access = StatsLRUCache(
+        maxsize=_get_cache_size(conf, "senders_access_cache_items"))
     if "user_power_level" in conf:
       self.user_power_level = conf["user_power_level"]
     else:
       self.user_power_level = None
 
+  def __enter__(self):
+    self.storage.__enter__()
+
+  def __exit__(self, type_, value, traceback):
+    self.storage.__exit__(type_, value, traceback)
+
+  def start(self):
+    if self.room_idle_timeout:
+      # Check a few times per timeout, so that rooms don't linger for too long past it.
+      self.rooms_eviction_cb = self.glib.timeout_add_seconds(
+          max(1, self.room_idle_timeout // BaseLayer.ROOMS_EVICTION_CHECKS),
+          self.on_evict_idle_rooms)
+    if self.db_maintenance_interval:
+      self.db_maintenance_cb = self.glib.timeout_add_seconds(
+          self.db_maintenance_interval, self.on_db_maintenance)
+
+  def stop(self):
+    if self.rooms_eviction_cb:
+      self.glib.source_remove(self.rooms_eviction_cb)
+      self.rooms_eviction_cb = None
+    if self.db_maintenance_cb:
+      self.glib.source_remove(self.db_maintenance_cb)
+      self.db_maintenance_cb = None
+    logger.info("Caches statistics: {0}", self.get_caches_stats())
+
+  def on_db_maintenance(self):
+    """Schedules periodic DB maintenance on the storage thread."""
+    self.storage.submit(functools.partial(maintain, vacuum_pages=self.db_vacuum_pages))
+    # Continue calling this callback.
+    return True
+
+  def get_caches_stats(self):
+    """Returns usage statistics for all bounded caches."""
+    return {
+        "mxids_to_ext_contacts": self.mxids_to_ext_contacts.stats(),
+        "ext_contacts_to_mxids": self.ext_contacts_to_mxids.stats(),
+        "senders_access": self.senders_access.stats()}
+
+  def add_contact(self, account, ext_contact, contact):
+    """Adds the contact to the account contacts and pins its MXID translation.
+
+    Returns the ghost of the contact."""
+    if contact not in account.contacts:
+      account.contacts.add(contact)
+      self.contacts_mapping.add(
+          account.network, contact,
+          self._mxid_to_ext_contact(account.network, contact), ext_contact)
+    return self.ghosts.setdefault(contact, Ghost())
+
+  def remove_contacts(self, account):
+    """Removes all account contacts, unpinning their translations and
+    dropping their ghosts if not used elsewhere."""
+    for contact in account.contacts:
+      if self.contacts_mapping.remove(account.network, contact):
+        self.ghosts.pop(contact, None)
+      elif contact in self.ghosts:
+        self.ghosts[contact].statuses.pop(account, None)
+    account.contacts.clear()
+
   def add_clients_callback(self, callback_id, callback, map_account=True):
     """Adds new callback to the event 'callback_id' for all clients."""
     cb_config = ClientsCallbackConfig(callback_id, callback, map_account)
@@ -183,6 +377,107 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
       for cb_config in self.clients_callbacks[callback_id]:
         cb_config.dispatcher(*args)
 
+  def add_rooms_callback(self, callback_id, callback):
+    """Adds callback for rooms lifecycle events.
+
+    Supported callbacks:
+    * "room-removed": room_id, room, evicted - the room was either left or,
+      if evicted is True, evicted as idle.
+    * "member-added": room_id, room, contact - the contact became the member of the room.
+    * "room-missing": user, contact, room_id - the room for the user and contact (or
+      the room with given ID, if room_id is set) is not in memory, the callback is
+      expected to restore it if it's known to Matrix server."""
+    self.rooms_callbacks[callback_id].append(callback)
+
+  def remove_rooms_callback(self, callback_id, callback):
+    """Removes previously added rooms callback."""
+    if callback_id in self.rooms_callbacks:
+      if callback in self.rooms_callbacks[callback_id]:
+        self.rooms_callbacks[callback_id].remove(callback)
+        return
+    raise ValueError("Callback '{0}' not found, cannot remove".format(callback_id))
+
+  def get_room(self, room_id):
+    """Returns the room with given ID or None if it's not tracked, marking it as active."""
+    room = self.rooms.get(room_id)
+    if room:
+      room.last_active = time.monotonic()
+    return room
+
+  def add_room(self, room_id, user):
+    """Returns the room with given ID, starting to track it if necessary."""
+    room = self.get_room(room_id)
+    if not room:
+      room = Room(user)
+      self.rooms[room_id] = room
+    elif not room.user:
+      room.user = intern_id(user)
+    return room
+
+  def add_room_member(self, room_id, user, contact):
+    """Returns the room with given ID, starting to track it if necessary and
+    adding the contact to its members."""
+    room = self.add_room(room_id, user)
+    if contact not in room.members:
+      room.members.add(contact)
+      self.member_rooms[contact] += 1
+      self._dispatch_rooms_callbacks("member-added", room_id, room, contact)
+    return room
+
+  def remove_room_member(self, room_id, contact):
+    """Removes the contact from the members of the room with given ID, if it's tracked."""
+    room = self.rooms.get(room_id)
+    if room and contact in room.members:
+      room.members.remove(contact)
+      self._on_member_removed(contact)
+
+  def set_room_chat(self, room_id, chat_id):
+    """Bridges the room with given ID to the chat with given conversation ID,
+    or unbridges it if `chat_id` is None."""
+    room = self.rooms.get(room_id)
+    if room:
+      if room.chat_id:
+        self.chat_rooms.pop((room.user, room.chat_id), None)
+      room.chat_id = chat_id
+      if chat_id:
+        self.chat_rooms[(room.user, chat_id)] = room_id
+
+  def find_chat_room(self, user, chat_id):
+    """Returns the ID of the user's room bridged to the chat with given
+    conversation ID or None if there is no such room."""
+    return self.chat_rooms.get((user, chat_id))
+
+  def has_rooms(self, contact):
+    """Returns whether the contact is a member of any tracked room."""
+    return contact in self.member_rooms
+
+  def remove_room(self, room_id, evicted=False):
+    """Stops tracking the room with given ID, `evicted` is True if it's still
+    usable and is dropped from memory only."""
+    room = self.rooms.pop(room_id, None)
+    if room:
+      for contact in room.members:
+        self._on_member_removed(contact)
+      if room.chat_id:
+        self.chat_rooms.pop((room.user, room.chat_id), None)
+      self._dispatch_rooms_callbacks("room-removed", room_id, room, evicted)
+
+  def restore_room(self, user, contact=None, room_id=None):
+    """Requests restoring the rooms for the user and contact or the room
+    with given ID that are not in memory."""
+    self._dispatch_rooms_callbacks("room-missing", user, contact, room_id)
+
+  def on_evict_idle_rooms(self):
+    """Drops rooms that were not accessed for longer than configured timeout."""
+    deadline = time.monotonic() - self.room_idle_timeout
+    idle_room_ids = [
+        room_id for room_id, room in self.rooms.items() if room.last_active < deadline]
+    for room_id in idle_room_ids:
+      self.remove_room(room_id, evicted=True)
+    if idle_room_ids:
+      logger.debug("Evicted {0} idle rooms, {1} remained", len(idle_room_ids), len(self.rooms))
+    return True
+
   def add_transaction_callback(self, event_type, callback):
     """Adds transaction callback for the given event type."""
     self.transaction_callbacks[event_type].append(callback)
@@ -196,30 +491,15 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
     raise ValueError("Callback '{0}' not found, cannot remove".format(event_type))
 
   def process_transaction(self, transaction_id, transaction):
-    """Processes all transaction events by dispatching these to the appropriate callbacks."""
-    for event in transaction["events"]:
-      if "type" not in event:
-        logger.warning(
-            "The event is missing required attributes, "
-            "discarding the event {0}", event)
-        continue
-      if "sender" in event and not self._is_sender_allowed(event["sender"]):
-        logger.warning(
-            "According to our ACLs, the sender '{0}' is not allowed - "
-            "discarding the event {1}", event["sender"], event)
-        continue
-      if event["type"] in self.transaction_callbacks:
-        for callback in self.transaction_callbacks[event["type"]]:
-          try:
-            callback(transaction_id, event)
-          except: # pylint: disable=bare-except
-            logger.exception(
-                "Exception when processing "
-                "transaction '{0}', event {1}:", transaction_id, event)
-      elif event["type"] in BaseLayer.IGNORED_EVENTS:
-        pass
-      else:
-        logger.error("Unknown event in transaction, ignoring: {0}", event)
+    """Processes all transaction events by dispatching these to the appropriate callbacks.
+
+    Ephemeral events (typing, presence, receipts) pushed along are dispatched the same way."""
+    self._dispatch_transaction_events(transaction_id, transaction["events"])
+    # Servers might push the same events under both keys during the transition.
+    for key in BaseLayer.EPHEMERAL_EVENTS_KEYS:
+      if key in transaction:
+        self._dispatch_transaction_events(transaction_id, transaction[key])
+        break
     return True
 
   def ensure_room(self, user, contact, conv_id):
@@ -227,18 +507,22 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
 
     First tries to find one and then, if not found, creates it."""
     room_id = self._find_room(user, contact, conv_id)
+    if not room_id:
+      # The room might exist, but could have been evicted - try to restore it.
+      self.restore_room(user, contact)
+      room_id = self._find_room(user, contact, conv_id)
     if room_id:
+      room = self.get_room(room_id)
       # If conv id for this room is not set - associate the current conv id with this room.
-      if not self.rooms[room_id].conv_id:
-        self.rooms[room_id].conv_id = conv_id
+      if not room.conv_id:
+        room.conv_id = conv_id
       return room_id
     # Note that even though it's external contact that creates the room, from the point of
     # view of self.rooms data structure our local matrix user is always an implicit member /
     # owner of the group and the 'contact' has to be stored as a 'member'.
     room_id = self.matrix_client.create_room(contact, [user])
-    self.rooms[room_id].user = user
-    self.rooms[room_id].conv_id = conv_id
-    self.rooms[room_id].members.add(contact)
+    room = self.add_room_member(room_id, user, contact)
+    room.conv_id = conv_id
     if self.user_power_level:
       # Make sure to also set contact power level to admin, as if we don't include
       # the contact, Synapse resets its power level to 0 and if contact's power level
@@ -252,9 +536,29 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
 
   def ext_contact_to_mxid(self, network, ext_contact):
     """Translates external network contact format to Matrix ID."""
-    if ext_contact in self.ext_contacts_to_mxids:
-      return self.ext_contacts_to_mxids[ext_contact]
+    contact = self.contacts_mapping.get_mxid(network, ext_contact)
+    if contact:
+      return contact
+    contact = self.ext_contacts_to_mxids.lookup((network, ext_contact))
+    if contact:
+      return contact
+    contact = self._ext_contact_to_mxid(network, ext_contact)
+    self.ext_contacts_to_mxids[(network, ext_contact)] = contact
+    return contact
 
+  def mxid_to_ext_contact(self, network, contact):
+    """Translates Matrix ID to external network contact format."""
+    ext_contact = self.contacts_mapping.get_ext_contact(network, contact)
+    if ext_contact:
+      return ext_contact
+    ext_contact = self.mxids_to_ext_contacts.lookup((network, contact))
+    if ext_contact:
+      return ext_contact
+    ext_contact = self._mxid_to_ext_contact(network, contact)
+    self.mxids_to_ext_contacts[(network, contact)] = ext_contact
+    return ext_contact
+
+  def _ext_contact_to_mxid(self, network, ext_contact):
     if network in self.networks:
       net_conf = self.networks[network]
       match = re.match(net_conf["ext_pattern"], ext_contact)
@@ -270,18 +574,13 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
           contact = "@{0}%{1}:{2}".format(user_prefix, matches["host"], self.hs_host)
         else:
           contact = "@{0}:{1}".format(user_prefix, self.hs_host)
-        self.ext_contacts_to_mxids[ext_contact] = contact
-        return contact
+        return intern_id(contact)
       else:
         raise ValueError("Cannot parse external contact '{0}'".format(ext_contact))
     else:
       raise ValueError("Unknown network '{0}'".format(network))
 
-  def mxid_to_ext_contact(self, network, contact):
-    """Translates Matrix ID to external network contact format."""
-    if contact in self.mxids_to_ext_contacts:
-      return self.mxids_to_ext_contacts[contact]
-
+  def _mxid_to_ext_contact(self, network, contact):
     if network in self.networks:
       net_conf = self.networks[network]
       match = BaseLayer.RE_CONTACT_MXID.match(contact)
@@ -296,9 +595,7 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
         if matches["prefix"] != net_conf["prefix"]:
           raise ValueError("Unexpected service prefix: expected '{0}', got '{1}'".format(
               net_conf["prefix"], matches["prefix"]))
-        ext_contact = net_conf["ext_format"].format(**matches)
-        self.mxids_to_ext_contacts[contact] = ext_contact
-        return ext_contact
+        return net_conf["ext_format"].format(**matches)
       else:
         raise ValueError("Cannot parse Matrix ID '{0}'".format(contact))
     else:
@@ -328,6 +625,31 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
           return True
     return False
 
+  def _dispatch_transaction_events(self, transaction_id, events):
+    for event in events:
+      if "type" not in event:
+        logger.warning(
+            "The event is missing required attributes, "
+            "discarding the event {0}", event)
+        continue
+      if "sender" in event and not self._is_sender_allowed(event["sender"]):
+        logger.warning(
+            "According to our ACLs, the sender '{0}' is not allowed - "
+            "discarding the event {1}", event["sender"], event)
+        continue
+      if event["type"] in self.transaction_callbacks:
+        for callback in self.transaction_callbacks[event["type"]]:
+          try:
+            callback(transaction_id, event)
+          except: # pylint: disable=bare-except
+            logger.exception(
+                "Exception when processing "
+                "transaction '{0}', event {1}:", transaction_id, event)
+      elif event["type"] in BaseLayer.IGNORED_EVENTS:
+        pass
+      else:
+        logger.error("Unknown event in transaction, ignoring: {0}", event)
+
   def _find_room_single_pass(self, user, contact, conv_id):
     for room_id, room in self.rooms.items():
       if (contact in room.members and user == room.user and
@@ -340,6 +662,19 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
       room_id = self._find_room_single_pass(user, contact, None)
     return room_id
 
+  def _on_member_removed(self, contact):
+    self.member_rooms[contact] -= 1
+    if self.member_rooms[contact] <= 0:
+      del self.member_rooms[contact]
+
+  def _dispatch_rooms_callbacks(self, callback_id, *args):
+    for callback in self.rooms_callbacks[callback_id]:
+      try:
+        callback(*args)
+      except: # pylint: disable=bare-except
+        logger.exception(
+            "Exception while processing rooms callback '{0}':", callback_id)
+
   def _callback_dispatcher(self, cb_config, *args):
     logger.debug(
         "In _callback_dispatcher for callback '{0}' with args '{1}'",
@@ -362,8 +697,9 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
           "callback '{0}':", cb_config.callback_id)
 
   def _is_sender_allowed(self, sender):
-    if sender in self.senders_access:
-      return self.senders_access[sender]
+    allowed = self.senders_access.lookup(sender)
+    if allowed is not None:
+      return allowed
     for blacklist in self.users_blacklist:
       if re.match(blacklist.format(hs_host=self.hs_host), sender):
         self.senders_access[sender] = False
@@ -375,6 +711,12 @@ class BaseLayer(LayerBase): # pylint: disable=too-many-instance-attributes
     self.senders_access[sender] = False
     return False
 
+def _get_cache_size(conf, name):
+  # Per-cache sizes are optional and fall back to the common setting.
+  if name in conf:
+    return conf[name]
+  return conf["max_cache_items"]
+
 def _parse_hs_host(hs_server):
   parts = urllib.parse.urlparse(hs_server)
   ind = parts.netloc.find(":")
@@ -24,6 +24,7 @@ import urllib.parse
 
 from pumaduct.layers.layer_base import LayerBase
 from pumaduct.layers.base import Account
+from pumaduct.utils import intern_id
 
 logger = logging.getLogger(__name__)
 
@@ -41,13 +42,17 @@ class ConnectionLayer(LayerBase):
     self.sync_contacts_profiles_changes = conf["sync_contacts_profiles_changes"]
 
   def __enter__(self):
-    for account in self.base.db_session.query(self.base.account_storage).all():
-      net_conf = self.base.networks[account.network]
+    account_storage = self.base.account_storage
+    stored_accounts = self.base.storage.call(lambda db_session: [
+        (account.user, account.id, account.network, account.ext_user,
+         account.password, account.auth_token)
+        for account in db_session.query(account_storage).all()])
+    for (user, account_id, network, ext_user, password, auth_token) in stored_accounts:
+      net_conf = self.base.networks[network]
       client = self.base.clients[net_conf["client"]]
       if "enabled" not in net_conf or net_conf["enabled"]:
-        self.base.accounts[account.user].append(
-            Account(account.id, account.network, account.ext_user, account.password,
-                    account.auth_token, net_conf, client))
+        self.base.accounts[intern_id(user)].append(
+            Account(account_id, network, ext_user, password, auth_token, net_conf, client))
 
     self.base.add_clients_callback("user-signed-on", self.on_user_signed_on)
     self.base.add_clients_callback("user-signed-off", self.on_user_signed_off)
@@ -62,6 +67,9 @@ class ConnectionLayer(LayerBase):
     self.base.remove_clients_callback("contact-updated", self.on_contact_updated)
     self.base.remove_clients_callback("new-auth-token", self.on_new_auth_token)
 
+    for accounts in self.base.accounts.values():
+      for account in accounts:
+        self.base.remove_contacts(account)
     self.base.accounts.clear()
 
   def start(self):
@@ -132,10 +140,11 @@ class ConnectionLayer(LayerBase):
   def on_new_auth_token(self, user, account, auth_token):
     """Stores new auth token for subsequent reuse."""
     del user # Unused.
-    stored_account = self.base.db_session.query(
-        self.base.account_storage).get(account.id)
-    stored_account.auth_token = auth_token
-    self.base.db_session.commit()
+    account_storage = self.base.account_storage
+    account_id = account.id
+    def update_auth_token(db_session):
+      db_session.query(account_storage).get(account_id).auth_token = auth_token
+    self.base.storage.submit(update_auth_token)
     account.auth_token = auth_token
 
   def on_connection_error( # pylint: disable=no-self-use
@@ -155,10 +164,17 @@ class ConnectionLayer(LayerBase):
     # update callback, to avoid excessive load on Matrix server, as some
     # plugins generate high volume of on_contact_updated calls.
     if contact not in account.contacts:
-      account.contacts.add(contact)
+      ghost = self.base.add_contact(account, ext_contact, contact)
+      # The contact might be shared with other accounts, its profile is synced only once.
+      if ghost.profile_synced:
+        return
       # Register the user on Matrix for this contact, if it's not yet available.
-      if not self.base.matrix_client.has_user(contact):
-        self.base.matrix_client.register_user(contact)
+      # If that fails, the next account having the contact retries.
+      if (not self.base.matrix_client.has_user(contact) and
+          not self.base.matrix_client.register_user(contact)):
+        logger.error("Failed to register Matrix user for the contact '{0}'", contact)
+        return
+      ghost.profile_synced = True
       # Update contact profile on Matrix.
       profile = self.base.matrix_client.get_user_profile(contact)
       if (display_name and ("displayname" not in profile or
@@ -59,8 +59,7 @@ class InfoLayer(LayerBase):
     result = ""
     for account in self.base.accounts[sender]:
       status = ("online" if account.connected else "offline")
-      msgs_count = self.messages.get_messages_to_client(
-          sender, account).count()
+      msgs_count = self.messages.count_messages_to_client(sender, account)
       result += (
           "* Network: '{0}', user: '{1}', status: '{2}', "
           "number of contacts: {3}, number of offline "
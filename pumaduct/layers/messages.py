@@ -19,24 +19,74 @@
 
 """Handles messages delivery both to clients and Matrix."""
 
+# The delivery paths share the ordering and the offline queue bookkeeping,
+# so these are kept in one module.
+# pylint: disable=too-many-lines
+
 import base64
-from datetime import datetime
-import json
+from collections import Counter
+from datetime import datetime, timedelta
+import functools
+import hashlib
+import io
 import logging
+from time import monotonic
 import urllib.parse
 
-import html2text
-import magic
-import markdown
-
+from pumaduct.converters import CONVERTERS, BodyConverters
 from pumaduct.im_client_base import ClientError
 from pumaduct.layers.layer_base import LayerBase
 from pumaduct.layers.base import InternalError
-from pumaduct.utils import get_event_datetime, query_json_path
+from pumaduct.media_info import DEFAULT_THUMBNAIL_SIZE, MediaInfo, get_media_info
+from pumaduct.media_spool import MediaSpool
+from pumaduct.media_transfers import (
+    DEFAULT_MEDIA_TRANSFERS_PATH, DEFAULT_MEDIA_TRANSFERS_QUOTA,
+    DEFAULT_MEDIA_TRANSFER_TIMEOUT, DEFAULT_MEDIA_TRANSFER_WORKERS, MediaTransfers)
+from pumaduct.message_queue import create_message_queue
+from pumaduct.retry_schedule import RetrySchedule
+from pumaduct.sent_events import SentEventsStore
+from pumaduct.utils import get_bookkeeping_limits, get_event_datetime, query_json_path
+from pumaduct.worker_pool import WorkerPool
 
 logger = logging.getLogger(__name__)
 
-class MessagesLayer(LayerBase):
+DEFAULT_OFFLINE_MESSAGES_PAGE_SIZE = 100
+DEFAULT_MEDIA_SPOOL_PATH = "/var/lib/synapse/pumaduct-media"
+DEFAULT_OFFLINE_MESSAGES_TTL = 30 * 86400
+DEFAULT_OFFLINE_MESSAGES_EXPIRY_INTERVAL = 3600
+DEFAULT_OFFLINE_MESSAGES_EXPIRY_BATCH_SIZE = 500
+DEFAULT_OFFLINE_MESSAGES_MAX_DELIVERY_INTERVAL = 3600
+DEFAULT_CONVERSION_WORKERS = 2
+DEFAULT_CONVERSION_OFFLOAD_THRESHOLD = 65536
+DEFAULT_CLIENT_THUMBNAIL_SIZE = (800, 600)
+DEFAULT_CHAT_NAME_FORMAT = "pumaduct-{room_hash}"
+DEFAULT_COALESCE_MAX_DELAY_MS = 2000
+DEFAULT_COALESCE_MAX_LENGTH = 4096
+
+class Burst(object):
+  """Consecutive messages from the same sender to the room that are coalesced
+  into a single Matrix event."""
+  __slots__ = (
+      "account", "user", "contact", "time", "deadline", "length",
+      "bodies", "text_bodies", "timer")
+
+  def __init__(self, account, user, contact, time, deadline):
+    self.account = account
+    self.user = user
+    self.contact = contact
+    # Time of the first message, the event is sent with it.
+    self.time = time
+    # Monotonic time the burst must be flushed at, however many messages arrive.
+    self.deadline = deadline
+    self.length = 0
+    # Bodies are appended once converted, in the order of the messages.
+    self.bodies = []
+    self.text_bodies = []
+    self.timer = None
+
+# Self-contained parts of the state are kept by the helpers (media spool
+# and transfers, retries, converters), the rest is shared by the delivery paths.
+class MessagesLayer(LayerBase): # pylint: disable=too-many-instance-attributes
   """
   Handles messages delivery both to clients and Matrix.
 
@@ -45,13 +95,90 @@ class MessagesLayer(LayerBase):
   def __init__(self, conf, base_layer):
     self.base = base_layer
     self.offline_delivery_interval = conf["offline_messages_delivery_interval"]
+    self.queue = create_message_queue(
+        conf, self.base.glib, self.base.storage, self.base.message_storage,
+        conf["offline_messages_page_size"] if "offline_messages_page_size" in conf
+        else DEFAULT_OFFLINE_MESSAGES_PAGE_SIZE)
+    # Depths of offline messages queues, so that checking them doesn't need
+    # storage roundtrips: keyed by (sender, network, ext_user) for clients queues.
+    # If the queue is shared with other instances, these are re-counted periodically.
+    self.queue_depths_cb = None
+    self.clients_queue_depths = Counter()
+    self.matrix_queue_depth = 0
     self.pending_deliveries_to_clients = set()
-    # Ideally this should be persisted, so that if AS is restarted between
-    # the message is sent and transaction arrives, AS can still handle it correctly.
-    self.sent_ids = set()
+    # Queue pages are read without blocking the main loop, so the deliveries
+    # take a while: (user, account) of the ones in progress to clients.
+    self.deliveries_to_clients = set()
+    self.delivering_to_matrix = False
+    # Offline messages that could not be delivered for that long are discarded.
+    self.offline_messages_ttls = {
+        "client": (conf["offline_messages_to_clients_ttl"]
+                   if "offline_messages_to_clients_ttl" in conf
+                   else DEFAULT_OFFLINE_MESSAGES_TTL),
+        "matrix": (conf["offline_messages_to_matrix_ttl"]
+                   if "offline_messages_to_matrix_ttl" in conf
+                   else DEFAULT_OFFLINE_MESSAGES_TTL)}
+    self.offline_messages_expiry_interval = (
+        conf["offline_messages_expiry_interval"] if "offline_messages_expiry_interval" in conf
+        else DEFAULT_OFFLINE_MESSAGES_EXPIRY_INTERVAL)
+    self.offline_messages_expiry_batch_size = (
+        conf["offline_messages_expiry_batch_size"]
+        if "offline_messages_expiry_batch_size" in conf
+        else DEFAULT_OFFLINE_MESSAGES_EXPIRY_BATCH_SIZE)
+    self.offline_messages_expiry_cb = None
+    # This is persisted, so that if AS is restarted between the message
+    # is sent and transaction arrives, AS can still handle it correctly.
+    self.sent_ids = SentEventsStore(
+        self.base.storage, self.base.sent_event_storage,
+        *get_bookkeeping_limits(conf))
+    self.sent_ids_expiry_cb = None
+    self.media_spool = MediaSpool(
+        conf["media_spool_path"] if "media_spool_path" in conf
+        else DEFAULT_MEDIA_SPOOL_PATH)
     self.offline_delivery_to_matrix_cb = None
-    self.offline_delivery_to_clients_cb = None
-    self.html2text = html2text.HTML2Text()
+    # Retries of deliveries to clients are scheduled per (user, account),
+    # with the interval doubling after each unsuccessful attempt.
+    self.delivery_to_clients_retries = RetrySchedule(
+        self.base.glib, self.offline_delivery_interval,
+        conf["offline_messages_max_delivery_interval"]
+        if "offline_messages_max_delivery_interval" in conf
+        else DEFAULT_OFFLINE_MESSAGES_MAX_DELIVERY_INTERVAL)
+    # Conversion of large bodies and content type detection of large files are
+    # performed by the workers, so that these don't stall the main loop.
+    self.conversion_pool = WorkerPool(
+        self.base.glib,
+        conf["conversion_workers"] if "conversion_workers" in conf
+        else DEFAULT_CONVERSION_WORKERS,
+        conf["conversion_workers_processes"] if "conversion_workers_processes" in conf
+        else False)
+    self.converters = BodyConverters(
+        self.conversion_pool,
+        conf["converted_bodies_cache_items"] if "converted_bodies_cache_items" in conf
+        else conf["max_cache_items"],
+        conf["conversion_offload_threshold"] if "conversion_offload_threshold" in conf
+        else DEFAULT_CONVERSION_OFFLOAD_THRESHOLD)
+    # Media is streamed between Matrix and the clients by its own workers,
+    # spooling the downloads on disk.
+    self.media_transfers = MediaTransfers(
+        self.base.matrix_client,
+        conf["media_transfers_path"] if "media_transfers_path" in conf
+        else DEFAULT_MEDIA_TRANSFERS_PATH,
+        conf["media_transfer_workers"] if "media_transfer_workers" in conf
+        else DEFAULT_MEDIA_TRANSFER_WORKERS,
+        conf["media_transfers_quota"] if "media_transfers_quota" in conf
+        else DEFAULT_MEDIA_TRANSFERS_QUOTA,
+        conf["media_transfer_timeout"] if "media_transfer_timeout" in conf
+        else DEFAULT_MEDIA_TRANSFER_TIMEOUT)
+    # Thumbnails of the images sent to Matrix are generated once at bridge time,
+    # so that Matrix clients don't need to download full images for previews.
+    self.thumbnail_size = (
+        tuple(conf["media_thumbnail_size"]) if "media_thumbnail_size" in conf
+        else DEFAULT_THUMBNAIL_SIZE)
+    # Bursts of messages from the clients being coalesced, keyed by room_id.
+    self.bursts = {}
+    # Rooms waiting for their multi-user chats to be joined,
+    # keyed by (network, ext_user, chat name).
+    self.pending_chats = {}
 
   def __enter__(self):
     self.base.add_clients_callback("user-signed-on", self.on_user_signed_on)
@@ -59,50 +186,99 @@ class MessagesLayer(LayerBase):
     self.base.add_clients_callback("new-image", self.on_new_image)
     self.base.add_clients_callback("new-file", self.on_new_file)
     self.base.add_clients_callback("conversation-destroyed", self.on_conversation_destroyed)
+    self.base.add_clients_callback("chat-joined", self.on_chat_joined)
+    self.media_transfers.__enter__()
+    self.conversion_pool.__enter__()
 
   def __exit__(self, type_, value, traceback):
+    # Transfers must be done before the pool completes the remaining callbacks.
+    self.media_transfers.__exit__(type_, value, traceback)
+    self.conversion_pool.__exit__(type_, value, traceback)
     self.base.remove_clients_callback("user-signed-on", self.on_user_signed_on)
     self.base.remove_clients_callback("new-message", self.on_new_message)
     self.base.remove_clients_callback("new-image", self.on_new_image)
     self.base.remove_clients_callback("new-file", self.on_new_file)
     self.base.remove_clients_callback("conversation-destroyed", self.on_conversation_destroyed)
+    self.base.remove_clients_callback("chat-joined", self.on_chat_joined)
 
   def start(self):
+    self.queue.start()
+    self._load_queue_depths()
+    # Blobs might have been left behind if we were stopped between storing
+    # the blob and the message referencing it.
+    self.media_spool.collect_garbage(self.queue.referenced_blob_ids())
+    self.sent_ids.load()
+    self.sent_ids_expiry_cb = self.base.glib.timeout_add_seconds(
+        self.sent_ids.ttl, self.on_expire_sent_ids)
+    self.offline_messages_expiry_cb = self.base.glib.timeout_add_seconds(
+        self.offline_messages_expiry_interval, self.on_expire_offline_messages)
+    if self.queue.shared:
+      self.queue_depths_cb = self.base.glib.timeout_add_seconds(
+          self.offline_delivery_interval, self.on_count_queue_depths)
     # Attempt delivering offline messages to Matrix server, if any.
     self._attempt_delivery_to_matrix()
-    if self.get_messages_to_matrix().count():
-      self._schedule_delivery_to_matrix()
 
   def stop(self):
+    for room_id in list(self.bursts):
+      self._flush_burst(room_id)
+
+    if self.sent_ids_expiry_cb:
+      self.base.glib.source_remove(self.sent_ids_expiry_cb)
+      self.sent_ids_expiry_cb = None
+
     if self.offline_delivery_to_matrix_cb:
       self.base.glib.source_remove(self.offline_delivery_to_matrix_cb)
       self.offline_delivery_to_matrix_cb = None
 
-    if self.offline_delivery_to_clients_cb:
-      self.base.glib.source_remove(self.offline_delivery_to_clients_cb)
-      self.offline_delivery_to_clients_cb = None
+    if self.offline_messages_expiry_cb:
+      self.base.glib.source_remove(self.offline_messages_expiry_cb)
+      self.offline_messages_expiry_cb = None
+
+    if self.queue_depths_cb:
+      self.base.glib.source_remove(self.queue_depths_cb)
+      self.queue_depths_cb = None
+
+    self.delivery_to_clients_retries.clear()
+    self.queue.stop()
+    logger.info("Converters statistics: {0}", self.get_converters_stats())
+
+  def get_converters_stats(self):
+    """Returns usage statistics for all converters."""
+    return self.converters.stats()
 
   def on_user_signed_on(self, user, account):
-    """Schedules offline messages delivery on user sign on, if necessary."""
-    self._attempt_delivery_to_client(user, account)
-    # Check if we need to schedule offline messages delivery.
-    if self.get_messages_to_client(user, account).count():
-      self.pending_deliveries_to_clients.add((user, account))
-      self._schedule_delivery_to_clients()
-    # The same, but for offline messages that were recorded without account.
-    if self.get_messages_to_client(user, None).count():
+    """Delivers offline messages on user sign on, scheduling retries if necessary."""
+    # The account is reachable again, so start retries from the shortest interval.
+    self.delivery_to_clients_retries.reset((user, account))
+    self._attempt_delivery_to_client(user, account, backoff=False)
+    # Offline messages that were recorded without account are delivered separately.
+    if self.count_messages_to_client(user, None):
       self.pending_deliveries_to_clients.add((user, None))
-      self._schedule_delivery_to_clients()
+      self._schedule_delivery_to_client(user, None)
 
   def on_new_message(
       self, user, account, conv_id, ext_contact, direction, body, time):
     """Routes the message received from the client to the relevant Matrix room."""
     contact = self.base.ext_contact_to_mxid(account.network, ext_contact)
-    room_id = self.base.ensure_room(user, contact, conv_id)
+    room_id = self.base.find_chat_room(user, conv_id)
+    if room_id:
+      # Only the messages of the room members can be relayed to the room.
+      if direction != "recv" or contact not in self.base.get_room(room_id).members:
+        logger.debug(
+            "Skipping the message in the chat of the room '{0}' from '{1}'", room_id, contact)
+        return
+    else:
+      room_id = self.base.ensure_room(user, contact, conv_id)
     if direction == "recv":
       contact, user = user, contact
-    payload = self._create_matrix_text_payload(account, body)
-    self.send_message_to_matrix(account, room_id, user, contact, time, payload)
+    if "coalesce_interval_ms" in account.config and account.config["coalesce_interval_ms"]:
+      self._coalesce_message(account, room_id, user, contact, body, time)
+      return
+    self.converters.convert_ordered(
+        room_id, account.network, self._get_converter_name(account, "convert_to_text"), body,
+        lambda text_body: self.send_message_to_matrix(
+            account, room_id, user, contact, time,
+            self._create_matrix_text_payload(account, body, text_body)))
 
   def on_new_image(
       self, user, account, conv_id, ext_contact, direction, description, content, time):
@@ -120,10 +296,20 @@ class MessagesLayer(LayerBase):
 
   def on_conversation_destroyed(self, user, account, conv_id):
     """Clears removed conversation id from our internal datastructures."""
-    del user, account # Unused.
+    del account # Unused.
     for _, room in self.base.rooms.items():
       if room.conv_id == conv_id:
         room.conv_id = None
+    self.base.set_room_chat(self.base.find_chat_room(user, conv_id), None)
+
+  def on_chat_joined(self, user, account, conv_id, chat_name):
+    """Associates the joined chat with its room and delivers the messages queued for it."""
+    room_id = self.pending_chats.pop((account.network, account.ext_user, chat_name), None)
+    room = self.base.get_room(room_id) if room_id else None
+    if room:
+      logger.debug("Chat '{0}' of the room '{1}' is joined", chat_name, room_id)
+      self.base.set_room_chat(room_id, conv_id)
+      self.on_attempt_delivery_to_client(user, account)
 
   def process_transaction_message(self, transaction_id, event):
     """Processes messagereceived from Matrix.
@@ -136,12 +322,19 @@ class MessagesLayer(LayerBase):
     room_id = event["room_id"]
     payload = query_json_path(event, "content")
     if sender in self.base.accounts:
-      if event["event_id"] in self.sent_ids:
-        self.sent_ids.remove(event["event_id"])
+      if self.sent_ids.pop(event["event_id"]):
         return
-      if room_id in self.base.rooms:
-        for member in self.base.rooms[room_id].members:
-          self.send_message_to_client(room_id, sender, member, payload)
+      room = self.base.get_room(room_id)
+      if not room:
+        self.base.restore_room(sender, room_id=room_id)
+        room = self.base.get_room(room_id)
+      if room:
+        account = self._get_chat_account(sender, room)
+        if account:
+          self._send_message_to_chat_ordered(room_id, sender, account, payload)
+        else:
+          for member in list(room.members):
+            self._send_message_to_client_ordered(room_id, sender, member, payload)
       else:
         # Unknown room_id - potentially we're not currently tracking
         # the recipient contact, so we cannot determine the exact account to use.
@@ -168,10 +361,17 @@ class MessagesLayer(LayerBase):
           account, room_id, sender, recipient, time, payload)
     return result
 
-  def send_message_to_client(
-      self, room_id, sender, recipient, payload, offline=False):
-    """Sends the message to the client contact."""
-    account = self.base.find_account_for_contact(sender, recipient)
+  def send_message_to_client( # pylint: disable=too-many-arguments
+      self, room_id, sender, recipient, payload, offline=False, rendered_body=None,
+      content_path=None, account=None):
+    """Sends the message to the client contact.
+
+    For text messages, `rendered_body` is the body already rendered for the
+    client, if any. For media messages, `content_path` is the path of the
+    already downloaded media, if any. `account` is the account of the sender
+    suitable for the recipient, it's looked up if not given."""
+    if not account:
+      account = self.base.find_account_for_contact(sender, recipient)
     # This function is called only when the recipient is known, so
     # the account should always be retrievable.
     if not account:
@@ -180,21 +380,17 @@ class MessagesLayer(LayerBase):
           "{0} and recipient {1}".format(sender, recipient))
     if account.connected:
       try:
-        if not self.base.rooms[room_id].conv_id:
+        room = self._get_delivery_room(room_id, sender, recipient)
+        if not room.conv_id:
           ext_contact = self.base.mxid_to_ext_contact(account.network, recipient)
           conv_id = account.client.create_conversation(
               account.network, account.ext_user, ext_contact)
-          self.base.rooms[room_id].conv_id = conv_id
+          room.conv_id = conv_id
         else:
-          conv_id = self.base.rooms[room_id].conv_id
-        if payload["msgtype"] == "m.text":
-          rendered_body = _render_payload_for_client(account, payload)
-          if account.client.send_message(
-              account.network, account.ext_user, conv_id, rendered_body):
-            return True
-        elif payload["msgtype"] in ("m.image", "m.file"):
-          if self._send_file_to_client(account, conv_id, payload):
-            return True
+          conv_id = room.conv_id
+        if self._send_payload_to_conversation(
+            account, conv_id, payload, rendered_body, content_path):
+          return True
       except ClientError:
         logger.exception("Client failure while attempting to deliver the message")
     # If the message wasn't delivered and it's not offline delivery retry - store it.
@@ -203,70 +399,177 @@ class MessagesLayer(LayerBase):
           account, room_id, sender, recipient, payload)
     return False
 
-  def on_attempt_delivery_to_clients(self):
-    """Attempts delivering all pending offline messages to clients."""
-    # Keep track of accounts we've delivered to successfully.
-    delivered_to_clients = set()
-    msgs_before = 0
-    msgs_after = 0
-    # Iterate over all accounts and try to deliver for each one.
-    for (user, account) in self.pending_deliveries_to_clients:
-      msgs_before += self.get_messages_to_client(user, account).count()
-      self._attempt_delivery_to_client(user, account)
-      # If we're successful - put this account onto cleanup queue.
-      remaining_msgs = self.get_messages_to_client(user, account).count()
-      msgs_after += remaining_msgs
-      if not remaining_msgs:
-        delivered_to_clients.add((user, account))
-    # Delete all accounts from the queue for which delivery was successful.
-    for (user, account) in delivered_to_clients:
-      self.pending_deliveries_to_clients.remove((user, account))
-    # If there are no more deliveries left - clean up the callback and return 'False'
-    # below for the callback to stop being called.
-    if not self.pending_deliveries_to_clients:
-      self.offline_delivery_to_clients_cb = None
-    logger.debug(
-        "Attempted delivery of {0} offline messages to client, "
-        "{1} of them remained", msgs_before, msgs_after)
-    return bool(self.pending_deliveries_to_clients)
+  def send_message_to_chat( # pylint: disable=too-many-arguments
+      self, room_id, sender, account, payload, offline=False, rendered_body=None,
+      content_path=None):
+    """Sends the message once to the multi-user chat the room is bridged to.
+
+    If the chat is not joined yet, the message is stored as offline one
+    and is delivered once the chat is joined."""
+    if account.connected:
+      try:
+        conv_id = self._ensure_chat(room_id, account)
+        if conv_id and self._send_payload_to_conversation(
+            account, conv_id, payload, rendered_body, content_path):
+          return True
+      except ClientError:
+        logger.exception("Client failure while attempting to deliver the message to the chat")
+    if not offline:
+      self._store_offline_message_to_clients(account, room_id, sender, None, payload)
+    return False
+
+  def on_expire_sent_ids(self):
+    """Discards the IDs of sent events that Matrix server never echoed back."""
+    self.sent_ids.expire()
+    # Continue calling this callback.
+    return True
+
+  def on_expire_offline_messages(self):
+    """Discards offline messages that are past their TTL."""
+    now = datetime.utcnow()
+    for (destination, ttl) in self.offline_messages_ttls.items():
+      if ttl:
+        self._expire_offline_messages(destination, now - timedelta(seconds=ttl))
+    # Continue calling this callback.
+    return True
+
+  def on_count_queue_depths(self):
+    """Re-counts the depths of the queue shared with other instances."""
+    self.queue.depths(callback=self._on_queue_depths_counted)
+    # Continue calling this callback.
+    return True
+
+  def on_attempt_delivery_to_client(self, user, account):
+    """Attempts delivering pending offline messages to the client for given user and account."""
+    self.cancel_delivery_to_client(user, account)
+    if account and not account.connected:
+      # Sign on will trigger the delivery, no need to keep polling meanwhile.
+      logger.debug(
+          "Account '{0}' of user '{1}' is not connected, postponing delivery",
+          account.ext_user, user)
+      return
+    self._attempt_delivery_to_client(user, account, backoff=True)
+
+  def cancel_delivery_to_client(self, user, account):
+    """Cancels scheduled retry of offline messages delivery for given user and account."""
+    self.delivery_to_clients_retries.cancel((user, account))
+
+  def stop_delivery_to_client(self, user, account):
+    """Stops offline messages delivery for the removed account, forgetting its retries state."""
+    self.delivery_to_clients_retries.reset((user, account))
+    self.pending_deliveries_to_clients.discard((user, account))
 
   def on_attempt_delivery_to_matrix(self):
     """Attempts delivering all pending offline messages to Matrix."""
-    msgs_before = self.get_messages_to_matrix().count()
+    # The attempt reschedules itself once done, if anything remains.
+    self.offline_delivery_to_matrix_cb = None
     self._attempt_delivery_to_matrix()
-    remaining_msgs = self.get_messages_to_matrix().count()
+    return False
+
+  def count_messages_to_client(self, user, account):
+    """Returns the number of offline messages to the client for given user and account."""
+    return self.clients_queue_depths[_client_queue_key(user, account)]
+
+  def _load_queue_depths(self):
+    self._set_queue_depths(self.queue.depths())
+
+  def _on_queue_depths_counted(self, depths):
+    self._set_queue_depths(depths)
+    # Other instances might have queued the messages for us meanwhile.
+    if self.matrix_queue_depth:
+      self._schedule_delivery_to_matrix()
+    for (sender, network, ext_user) in list(self.clients_queue_depths):
+      if network is None:
+        if sender not in self.base.accounts:
+          continue
+        account = None
+      else:
+        (user, account) = self.base.find_user_and_account(network, ext_user)
+        if user != sender:
+          # The account is served by another instance.
+          continue
+      self.pending_deliveries_to_clients.add((sender, account))
+      self._schedule_delivery_to_client(sender, account)
+
+  def _set_queue_depths(self, depths):
+    self.clients_queue_depths.clear()
+    self.matrix_queue_depth = 0
+    for destination, sender, network, ext_user, count in depths:
+      if destination == "client":
+        self.clients_queue_depths[(sender, network, ext_user)] += count
+      else:
+        self.matrix_queue_depth += count
     logger.debug(
-        "Attempted delivery of {0} offline messages to Matrix, "
-        "{1} of them remained", msgs_before, remaining_msgs)
-    if not remaining_msgs:
-      self.offline_delivery_to_matrix_cb = None
-    return bool(remaining_msgs)
-
-  def get_messages_to_client(self, user, account):
-    """Retrieves all offline messages to the client for given user and account."""
-    msg = self.base.message_storage
-    return self.base.db_session.query(msg).filter(
-        msg.network == (account.network if account else None),
-        msg.ext_user == (account.ext_user if account else None),
-        msg.sender == user,
-        msg.destination == "client").order_by(msg.time)
-
-  def get_messages_to_matrix(self):
-    """Retrieves all offline messages to Matrix."""
-    msg = self.base.message_storage
-    return self.base.db_session.query(msg).filter(
-        msg.destination == "matrix").order_by(msg.time)
-
-  def _attempt_delivery_to_client(self, user, account):
-    for message in self.get_messages_to_client(user, account):
-      payload = json.loads(message.payload)
-      if not message.recipient:
+        "Loaded offline messages queues: {0} messages to clients, {1} to Matrix",
+        sum(self.clients_queue_depths.values()), self.matrix_queue_depth)
+
+  def _attempt_delivery_to_client(self, user, account, backoff):
+    if (user, account) in self.deliveries_to_clients:
+      # The delivery in progress reschedules itself if anything remains.
+      return
+    self.deliveries_to_clients.add((user, account))
+    self.queue.walk_pages_to_client(
+        *_client_queue_key(user, account),
+        functools.partial(self._process_page_to_client, user, account),
+        functools.partial(
+            self._on_client_delivery_attempted, user, account,
+            self.count_messages_to_client(user, account), backoff))
+
+  def _process_page_to_client(self, user, account, page):
+    """Returns True if the delivery failed and should not continue."""
+    delivered_ids = []
+    finished = self._deliver_page_to_client(user, page, delivered_ids)
+    self.queue.remove(delivered_ids)
+    key = _client_queue_key(user, account)
+    self.clients_queue_depths[key] -= len(delivered_ids)
+    if self.clients_queue_depths[key] <= 0:
+      del self.clients_queue_depths[key]
+    return finished
+
+  def _on_client_delivery_attempted(self, user, account, msgs_before, backoff):
+    self.deliveries_to_clients.discard((user, account))
+    self.queue.commit()
+    if account and account not in self.base.accounts.get(user, ()):
+      # The account was unregistered meanwhile.
+      return
+    remaining_msgs = self.count_messages_to_client(user, account)
+    logger.debug(
+        "Attempted delivery of {0} offline messages to client for user '{1}', "
+        "{2} of them remained", msgs_before, user, remaining_msgs)
+    if remaining_msgs:
+      self.pending_deliveries_to_clients.add((user, account))
+      self._schedule_delivery_to_client(user, account, backoff=backoff)
+    else:
+      self.pending_deliveries_to_clients.discard((user, account))
+      self.delivery_to_clients_retries.reset((user, account))
+
+  def _deliver_page_to_client(self, user, page, delivered_ids):
+    """Returns True if the delivery failed and should not continue."""
+    for message in page:
+      payload = message.payload
+      if payload is None:
+        logger.error("Dropping the offline message {0} with undecodable payload", message.id)
+      elif not message.recipient:
         if not message.room_id:
           raise InternalError( # pragma: no cover, this is only to detect potential
               # logical errors in the code - no known triggering scenario.
               "Inconsistent offline message: both recipient and room_id are null!")
-        if message.room_id in self.base.rooms:
-          for member in self.base.rooms[message.room_id].members:
+        room = self.base.get_room(message.room_id)
+        if not room:
+          self.base.restore_room(message.sender, room_id=message.room_id)
+          room = self.base.get_room(message.room_id)
+        account = self._get_chat_account(message.sender, room) if room else None
+        if account:
+          logger.debug(
+              "Attempting offline message delivery to chat: "
+              "room_id '{0}', sender '{1}', payload '{2}'",
+              message.room_id, message.sender, message.payload)
+          if not self.send_message_to_chat(
+              message.room_id, message.sender, account, payload, offline=True):
+            logger.debug("Delivery failed, keeping the message")
+            return True
+        elif room:
+          for member in list(room.members):
             logger.debug(
                 "Attempting offline message delivery to client without recipient: "
                 "room_id '{0}', sender '{1}', member '{2}', payload '{3}'",
@@ -274,8 +577,7 @@ class MessagesLayer(LayerBase):
             if not self.send_message_to_client(
                 message.room_id, message.sender, member, payload, offline=True):
               logger.debug("Delivery failed, keeping the message")
-              self.base.db_session.commit()
-              return
+              return True
         else:
           # Room / contact is still not available - continue.
           # Note: 'coverage' fails to record the execution of this branch if there's
@@ -291,53 +593,145 @@ class MessagesLayer(LayerBase):
         if not self.send_message_to_client(
             room_id, message.sender, message.recipient, payload, offline=True):
           logger.debug("Delivery failed, keeping the message")
-          break
+          return True
       # If we got up until here - the delivery was successful, so it's fine to discard this message.
-      self.base.db_session.delete(message)
-    self.base.db_session.commit()
+      delivered_ids.append(message.id)
+    return False
 
   # Matrix server becomes available 'as a whole', not for particlar account only - therefore,
   # there's no sense in trying to do per-user delivery, just try flushing everything in one go.
   def _attempt_delivery_to_matrix(self):
-    for message in self.get_messages_to_matrix():
+    if self.delivering_to_matrix:
+      # The delivery in progress reschedules itself if anything remains.
+      return
+    self.delivering_to_matrix = True
+    blob_ids = set()
+    self.queue.walk_pages_to_matrix(
+        functools.partial(self._process_page_to_matrix, blob_ids),
+        functools.partial(
+            self._on_matrix_delivery_attempted, blob_ids, self.matrix_queue_depth))
+
+  def _process_page_to_matrix(self, blob_ids, page):
+    """Returns True if the delivery failed and should not continue."""
+    delivered = []
+    finished = self._deliver_page_to_matrix(page, delivered)
+    self.queue.remove([message.id for message in delivered])
+    blob_ids.update(message.blob_id for message in delivered if message.blob_id)
+    # The depth might have been re-counted meanwhile.
+    self.matrix_queue_depth = max(self.matrix_queue_depth - len(delivered), 0)
+    return finished
+
+  def _on_matrix_delivery_attempted(self, blob_ids, msgs_before):
+    self.delivering_to_matrix = False
+    self.queue.commit()
+    self._release_blobs(blob_ids)
+    logger.debug(
+        "Attempted delivery of {0} offline messages to Matrix, "
+        "{1} of them remained", msgs_before, self.matrix_queue_depth)
+    if self.matrix_queue_depth:
+      self._schedule_delivery_to_matrix()
+
+  def _expire_offline_messages(self, destination, before):
+    # Expire in small batches, so that other operations can proceed in between.
+    self.queue.expire(
+        destination, before, self.offline_messages_expiry_batch_size,
+        functools.partial(self._on_offline_messages_expired, destination, before))
+
+  def _on_offline_messages_expired(self, destination, before, expired):
+    for message in expired:
+      if destination == "client":
+        key = (message.sender, message.network, message.ext_user)
+        self.clients_queue_depths[key] -= 1
+        if self.clients_queue_depths[key] <= 0:
+          del self.clients_queue_depths[key]
+      else:
+        self.matrix_queue_depth -= 1
+    self._release_blobs(set(message.blob_id for message in expired if message.blob_id))
+    if expired:
+      logger.info(
+          "Discarded {0} offline messages to {1} queued before {2}",
+          len(expired), destination, before)
+    if len(expired) == self.offline_messages_expiry_batch_size:
+      self._expire_offline_messages(destination, before)
+
+  def _release_blobs(self, blob_ids):
+    """Removes the blobs from the media spool unless other messages still reference them."""
+    if blob_ids:
+      self.media_spool.start_release(blob_ids)
+      self.queue.referenced_blob_ids(
+          blob_ids, callback=functools.partial(self.media_spool.finish_release, blob_ids))
+
+  def _upload_blob(self, blob_id, content_type):
+    """Returns the URL of the uploaded blob or None, raises FileNotFoundError
+    if the blob is missing from the media spool."""
+    with self.media_spool.open(blob_id) as blob:
+      return self.base.matrix_client.upload_content(content_type, blob)
+
+  def _deliver_page_to_matrix(self, page, delivered):
+    """Returns True if the delivery failed and should not continue."""
+    for message in page:
+      if message.payload is None:
+        logger.error("Dropping the offline message {0} with undecodable payload", message.id)
+        delivered.append(message)
+        continue
       room_id = self.base.ensure_room(message.recipient, message.sender, None)
-      payload = json.loads(message.payload)
+      # Queued payload must stay intact in case the delivery fails.
+      payload = dict(message.payload)
       logger.debug(
           "Attempting offline message delivery to matrix: "
           "room_id '{0}', sender '{1}', recipient '{2}', time '{3}', payload '{4}'",
           room_id, message.sender, message.recipient, message.time, payload)
-      if "content" in payload:
+      if message.blob_id:
+        try:
+          url = self._upload_blob(message.blob_id, payload["content-type"])
+        except FileNotFoundError:
+          # Retrying won't bring the media back, so just drop the message
+          # instead of blocking the rest of the queue behind it.
+          logger.error(
+              "Blob '{0}' is missing from the media spool, dropping the message",
+              message.blob_id)
+          delivered.append(message)
+          continue
+        if url:
+          payload["url"] = url
+          del payload["content-type"]
+        else:
+          return True
+      elif "content" in payload:
+        # Media of the messages stored before the media spool was introduced.
         url = self.base.matrix_client.upload_content(
             payload["content-type"], base64.b64decode(payload["content"].encode("ascii")))
         if url:
           payload["url"] = url
           del payload["content"], payload["content-type"]
         else:
-          break
+          return True
       if not self.send_message_to_matrix(
           None, room_id, message.sender, message.recipient,
           message.time, payload, offline=True):
-        break
-      self.base.db_session.delete(message)
-    self.base.db_session.commit()
+        return True
+      delivered.append(message)
+    return False
 
   def _schedule_delivery_to_matrix(self):
     if not self.offline_delivery_to_matrix_cb:
       self.offline_delivery_to_matrix_cb = self.base.glib.timeout_add_seconds(
           self.offline_delivery_interval, self.on_attempt_delivery_to_matrix)
 
-  def _schedule_delivery_to_clients(self):
-    if not self.offline_delivery_to_clients_cb:
-      self.offline_delivery_to_clients_cb = self.base.glib.timeout_add_seconds(
-          self.offline_delivery_interval, self.on_attempt_delivery_to_clients)
+  def _schedule_delivery_to_client(self, user, account, backoff=False):
+    # Disconnected accounts are retried on sign on instead.
+    if account and not account.connected:
+      return
+    self.delivery_to_clients_retries.schedule(
+        (user, account), lambda: self.on_attempt_delivery_to_client(user, account), backoff)
 
   def _store_offline_message_to_matrix( # pylint: disable=invalid-name
-      self, account, room_id, sender, recipient, time, payload):
+      self, account, room_id, sender, recipient, time, payload, blob_id=None):
     logger.debug(
         "Storing offline message to matrix for network '{0}', ext user '{1}' "
         "from sender '{2}' to room_id '{3}' and recipient '{4}' at time '{5}': '{6}'",
         account.network, account.ext_user, sender, room_id, recipient, time, payload)
-    stored_msg = self.base.message_storage(
+    self.queue.put(
         network=(account.network if account else None),
         ext_user=(account.ext_user if account else None),
         room_id=room_id,
@@ -345,9 +739,9 @@ class MessagesLayer(LayerBase):
         recipient=recipient,
         time=time,
         destination="matrix",
-        payload=json.dumps(payload))
-    self.base.db_session.add(stored_msg)
-    self.base.db_session.commit()
+        payload=payload,
+        blob_id=blob_id)
+    self.matrix_queue_depth += 1
     self._schedule_delivery_to_matrix()
 
   def _store_offline_message_to_clients( # pylint: disable=invalid-name
@@ -356,7 +750,7 @@ class MessagesLayer(LayerBase):
         "Storing offline message to client for network '{0}', ext user '{1}' "
         "from room_id '{2}', sender '{3}' to recipient '{4}': '{5}'",
         account.network, account.ext_user, room_id, sender, recipient, payload)
-    stored_msg = self.base.message_storage(
+    self.queue.put(
         network=account.network,
         ext_user=account.ext_user,
         room_id=room_id,
@@ -364,11 +758,10 @@ class MessagesLayer(LayerBase):
         recipient=recipient,
         time=datetime.utcnow(),
         destination="client",
-        payload=json.dumps(payload))
-    self.base.db_session.add(stored_msg)
-    self.base.db_session.commit()
+        payload=payload)
+    self.clients_queue_depths[_client_queue_key(sender, account)] += 1
     self.pending_deliveries_to_clients.add((sender, account))
-    self._schedule_delivery_to_clients()
+    self._schedule_delivery_to_client(sender, account)
 
   def _store_offline_message_to_clients_without_account( # pylint: disable=invalid-name
       self, room_id, sender, time, payload):
@@ -376,7 +769,7 @@ class MessagesLayer(LayerBase):
         "Storing offline message to client without account from "
         "sender '{0}' to room id '{1}' at time '{2}': '{3}'",
         sender, room_id, time, payload)
-    stored_msg = self.base.message_storage(
+    self.queue.put(
         network=None,
         ext_user=None,
         room_id=room_id,
@@ -384,28 +777,15 @@ class MessagesLayer(LayerBase):
         recipient=None,
         time=time,
         destination="client",
-        payload=json.dumps(payload))
-    self.base.db_session.add(stored_msg)
-    self.base.db_session.commit()
+        payload=payload)
+    self.clients_queue_depths[(sender, None, None)] += 1
     self.pending_deliveries_to_clients.add((sender, None))
-    self._schedule_delivery_to_clients()
+    self._schedule_delivery_to_client(sender, None)
 
-  def _create_matrix_text_payload(self, account, body):
-    text_body = body
+  def _create_matrix_text_payload(self, account, body, text_body):
     formatted_body = None
     fmt = None
     if account:
-      if "convert_to_text" in account.config:
-        if account.config["convert_to_text"] == "html2text":
-          text_body = self.html2text.handle(body)
-          # html2text ends the converted text with two newlines, strip them.
-          if text_body.endswith("\n\n"):
-            text_body = text_body[:-2]
-        else:
-          logger.error(
-              "PuMaDuct misconfiguration: converter to text '{0}'"
-              " for the network '{1}' is unknown.",
-              account.config["convert_to_text"], account.network)
       if "format" in account.config:
         fmt = account.config["format"]
         formatted_body = body
@@ -415,6 +795,60 @@ class MessagesLayer(LayerBase):
       payload["formatted_body"] = formatted_body
     return payload
 
+  def _coalesce_message(self, account, room_id, user, contact, body, time):
+    """Adds the message to the burst of the room, flushing the burst first
+    if it cannot be extended with this message."""
+    max_length = (
+        account.config["coalesce_max_length"] if "coalesce_max_length" in account.config
+        else DEFAULT_COALESCE_MAX_LENGTH)
+    now = monotonic()
+    burst = self.bursts.get(room_id)
+    if burst and (burst.user != user or burst.contact != contact or
+                  burst.length + len(body) > max_length or now >= burst.deadline):
+      self._flush_burst(room_id)
+      burst = None
+    if not burst:
+      max_delay = (
+          account.config["coalesce_max_delay_ms"] if "coalesce_max_delay_ms" in account.config
+          else DEFAULT_COALESCE_MAX_DELAY_MS)
+      burst = Burst(account, user, contact, time, now + max_delay / 1000.0)
+      self.bursts[room_id] = burst
+    burst.length += len(body)
+    if burst.timer:
+      self.base.glib.source_remove(burst.timer)
+    interval = min(account.config["coalesce_interval_ms"], (burst.deadline - now) * 1000.0)
+    burst.timer = self.base.glib.timeout_add(
+        max(int(interval), 0), lambda: self._on_burst_timeout(room_id))
+    def append(text_body):
+      burst.bodies.append(body)
+      burst.text_bodies.append(text_body)
+    self.converters.convert_ordered(
+        room_id, account.network, self._get_converter_name(account, "convert_to_text"), body,
+        append)
+
+  def _on_burst_timeout(self, room_id):
+    # The source is removed by returning 'False', so just forget about it.
+    self.bursts[room_id].timer = None
+    self._flush_burst(room_id)
+    return False
+
+  def _flush_burst(self, room_id):
+    """Sends the burst of the room, if any, once its messages are converted."""
+    burst = self.bursts.pop(room_id, None)
+    if not burst:
+      return
+    if burst.timer:
+      self.base.glib.source_remove(burst.timer)
+      burst.timer = None
+    def send():
+      # Formatted bodies are HTML, where the line breaks must be explicit.
+      separator = "<br>" if "format" in burst.account.config else "\n"
+      self.send_message_to_matrix(
+          burst.account, room_id, burst.user, burst.contact, burst.time,
+          self._create_matrix_text_payload(
+              burst.account, separator.join(burst.bodies), "\n".join(burst.text_bodies)))
+    self.conversion_pool.submit(room_id, send)
+
   def _send_file_to_matrix(
       self, user, account, conv_id, ext_contact, direction,
       description, content, time, msgtype):
@@ -422,45 +856,250 @@ class MessagesLayer(LayerBase):
     room_id = self.base.ensure_room(user, contact, conv_id)
     if direction == "recv":
       contact, user = user, contact
+    # The media must follow the text that preceded it.
+    self._flush_burst(room_id)
     payload = {"body": description, "msgtype": msgtype}
     # We don't know the actual content type, so try to guess.
-    content_type = magic.from_buffer(content, mime=True)
-    url = self.base.matrix_client.upload_content(content_type, content)
+    send = functools.partial(
+        self._send_file_content_to_matrix,
+        account, room_id, user, contact, time, payload, content)
+    self.conversion_pool.submit(
+        room_id, send, get_media_info, (content, msgtype == "m.image", self.thumbnail_size),
+        offload=len(content) >= self.converters.offload_threshold,
+        error_callback=lambda _: send(MediaInfo(
+            "application/octet-stream",
+            {"mimetype": "application/octet-stream", "size": len(content)})))
+
+  def _send_file_content_to_matrix(
+      self, account, room_id, user, contact, time, payload, content, media_info):
+    payload["info"] = dict(media_info.info)
+    on_uploaded = functools.partial(
+        self._on_file_uploaded_to_matrix,
+        account, room_id, user, contact, time, payload, content, media_info)
+    self.conversion_pool.submit(
+        room_id, on_uploaded, self._upload_media, (content, media_info),
+        offload=self.media_transfers.executor is not None,
+        executor=self.media_transfers.executor,
+        error_callback=lambda _: on_uploaded((None, None, None)))
+
+  def _upload_media(self, content, media_info):
+    """Uploads the media and its thumbnail, returns their URLs and, if the upload
+    failed, the temporary file to spool the media from and its blob ID.
+
+    Failure to upload the thumbnail is not fatal, its URL is None then."""
+    # The content is written to the file of its own, so that the upload can stream
+    # it from the disk and it can be moved to the media spool if the upload fails.
+    tmp_path = self.media_spool.write_temp(content)
+    try:
+      url = self.media_transfers.upload(
+          media_info.content_type, functools.partial(open, tmp_path, "rb"))
+    except:
+      self.media_spool.remove_temp(tmp_path)
+      raise
+    if not url:
+      return (None, None, (tmp_path, hashlib.sha256(content).hexdigest()))
+    self.media_spool.remove_temp(tmp_path)
+    thumbnail_url = None
+    if media_info.thumbnail:
+      thumbnail_url = self.media_transfers.upload(
+          media_info.thumbnail_info["mimetype"],
+          functools.partial(io.BytesIO, media_info.thumbnail))
+    return (url, thumbnail_url, None)
+
+  def _on_file_uploaded_to_matrix(
+      self, account, room_id, user, contact, time, payload, content, media_info, result):
+    (url, thumbnail_url, spooled) = result
     if url:
       payload["url"] = url
+      if thumbnail_url:
+        payload["info"]["thumbnail_url"] = thumbnail_url
+        payload["info"]["thumbnail_info"] = media_info.thumbnail_info
       self.send_message_to_matrix(account, room_id, user, contact, time, payload)
     else:
-      payload["content"] = base64.b64encode(content).decode("ascii")
-      payload["content-type"] = content_type
+      # The media is normally already written by the worker, which might have failed though.
+      blob_id = (
+          self.media_spool.add(*spooled) if spooled else self.media_spool.put(content))
+      # The thumbnail is not kept for offline messages, these are sent without it.
+      payload["content-type"] = media_info.content_type
       self._store_offline_message_to_matrix(
-          account, room_id, user, contact, time, payload)
+          account, room_id, user, contact, time, payload, blob_id=blob_id)
 
-  def _send_file_to_client(self, account, conv_id, payload):
-    parts = urllib.parse.urlparse(payload["url"])
-    content = self.base.matrix_client.download_content(parts.netloc, parts.path)
-    if content:
-      if payload["msgtype"] == "m.image":
-        send_fun = account.client.send_image
-      else:
-        send_fun = account.client.send_file
-      if send_fun(account.network, account.ext_user, conv_id, payload["body"], content):
-        return True
+  def _get_delivery_room(self, room_id, sender, recipient):
+    """Returns the room to deliver the message sent to the room with given ID by.
+
+    The room might have been evicted while the message was waiting for delivery,
+    it's restored then. If it's gone, e.g. as the user has left it, the message
+    is delivered via the room the user and the recipient use now."""
+    room = self.base.get_room(room_id)
+    if not room:
+      self.base.restore_room(sender, room_id=room_id)
+      room = self.base.get_room(room_id)
+    if not room or recipient not in room.members:
+      room = self.base.get_room(self.base.ensure_room(sender, recipient, None))
+    return room
+
+  def _send_payload_to_conversation(self, account, conv_id, payload, rendered_body, content_path):
+    if payload["msgtype"] == "m.text":
+      if rendered_body is None:
+        rendered_body = self._render_payload_for_client(account, payload)
+      return bool(account.client.send_message(
+          account.network, account.ext_user, conv_id, rendered_body))
+    if payload["msgtype"] in ("m.image", "m.file"):
+      return self._send_file_to_client(account, conv_id, payload, content_path)
     return False
 
-def _render_payload_for_client(account, payload):
-  body = query_json_path(payload, "body")
-  fmt = query_json_path(payload, "format")
-  formatted_body = query_json_path(payload, "formatted_body")
-  rendered_body = body
-  if "format" in account.config and fmt and account.config["format"] == fmt:
-    rendered_body = formatted_body
-  else:
-    if "convert_from_text" in account.config:
-      if account.config["convert_from_text"] == "markdown":
-        rendered_body = markdown.markdown(body)
-      else:
-        logger.error(
-            "PuMaDuct misconfiguration: from text converter '{0}'"
-            " for the network '{1}' is unknown.",
-            account.config["convert_from_text"], account.network)
-  return rendered_body
+  def _get_chat_account(self, sender, room):
+    """Returns the account to send the messages of the sender to the room with
+    via the multi-user chat, or None if the room is not bridged to one.
+
+    Only the rooms with several members, all reachable by the same account
+    of the network that has chats enabled, are bridged to the chats."""
+    if len(room.members) < 2 or sender not in self.base.accounts:
+      return None
+    for account in self.base.accounts[sender]:
+      if ("chats" in account.config and account.config["chats"] and
+          room.members <= account.contacts):
+        return account
+    return None
+
+  def _ensure_chat(self, room_id, account):
+    """Returns the conversation ID of the chat the room is bridged to,
+    or None if the chat is still being joined."""
+    room = self.base.get_room(room_id)
+    if not room or not room.members:
+      return None
+    if room.chat_id:
+      return room.chat_id
+    chat_name_format = (
+        account.config["chat_name_format"] if "chat_name_format" in account.config
+        else DEFAULT_CHAT_NAME_FORMAT)
+    chat_name = chat_name_format.format(
+        room_hash=hashlib.sha1(room_id.encode("utf8")).hexdigest()[:12])
+    contacts = [
+        self.base.mxid_to_ext_contact(account.network, member)
+        for member in sorted(room.members)]
+    conv_id = account.client.create_chat(
+        account.network, account.ext_user, chat_name, contacts)
+    if conv_id:
+      self.base.set_room_chat(room_id, conv_id)
+    else:
+      self.pending_chats[(account.network, account.ext_user, chat_name)] = room_id
+    return conv_id
+
+  def _send_file_to_client(self, account, conv_id, payload, content_path=None):
+    """Sends the media to the client, downloading it first unless `content_path` is given."""
+    if content_path is None:
+      content_path = self._download_file(account, payload)
+      if content_path is None:
+        return False
+      try:
+        return self._send_file_to_client(account, conv_id, payload, content_path)
+      finally:
+        self.media_transfers.release(content_path)
+    if payload["msgtype"] == "m.image":
+      send_fun = account.client.send_image
+    else:
+      send_fun = account.client.send_file
+    with open(content_path, "rb") as content:
+      return bool(send_fun(account.network, account.ext_user, conv_id, payload["body"], content))
+
+  def _download_file(self, account, payload):
+    """Downloads the media for the client, returns the path of the spooled file or None."""
+    parts = urllib.parse.urlparse(payload["url"])
+    thumbnail_size = self._get_client_thumbnail_size(account, payload)
+    if thumbnail_size:
+      path = self.media_transfers.download(parts.netloc, parts.path, thumbnail_size)
+      if path is not None:
+        return path
+      # Not every image can be thumbnailed by the server, try the original then.
+    return self.media_transfers.download(parts.netloc, parts.path)
+
+  def _get_client_thumbnail_size(self, account, payload): # pylint: disable=no-self-use
+    """Returns the size of the thumbnail to send to the client instead of the image,
+    if the network limits the size of images and the image might exceed it."""
+    if payload["msgtype"] != "m.image" or "max_image_size" not in account.config:
+      return None
+    size = query_json_path(payload, "info", "size")
+    if isinstance(size, int) and size <= account.config["max_image_size"]:
+      return None
+    return (tuple(account.config["image_thumbnail_size"])
+            if "image_thumbnail_size" in account.config else DEFAULT_CLIENT_THUMBNAIL_SIZE)
+
+  def _send_file_ordered(self, room_id, account, payload, send, store_offline):
+    """Downloads the media by the transfer workers, then sends it
+    after the preceding messages in the room."""
+    def on_downloaded(content_path):
+      if content_path is None:
+        store_offline()
+        return
+      try:
+        send(content_path=content_path)
+      finally:
+        self.media_transfers.release(content_path)
+    self.conversion_pool.submit(
+        room_id, on_downloaded, self._download_file, (account, payload),
+        offload=self.media_transfers.executor is not None,
+        executor=self.media_transfers.executor,
+        error_callback=lambda _: store_offline())
+
+  def _send_message_to_client_ordered(self, room_id, sender, recipient, payload):
+    """Sends the message to the client contact after the preceding ones in the room."""
+    account = self.base.find_account_for_contact(sender, recipient)
+    self._send_ordered(
+        room_id, account, payload,
+        functools.partial(
+            self.send_message_to_client, room_id, sender, recipient, payload, account=account),
+        functools.partial(
+            self._store_offline_message_to_clients, account, room_id, sender, recipient, payload))
+
+  def _send_message_to_chat_ordered(self, room_id, sender, account, payload):
+    """Sends the message to the chat the room is bridged to after the preceding ones."""
+    self._send_ordered(
+        room_id, account, payload,
+        functools.partial(self.send_message_to_chat, room_id, sender, account, payload),
+        functools.partial(
+            self._store_offline_message_to_clients, account, room_id, sender, None, payload))
+
+  def _send_ordered(self, room_id, account, payload, send, store_offline):
+    """Calls `send` after the preceding messages in the room are sent.
+
+    Large text bodies are rendered for the client by the conversion pool,
+    media is downloaded by the transfer workers."""
+    if account and payload.get("msgtype") == "m.text":
+      (name, body) = self._get_client_rendering(account, payload)
+      self.converters.convert_ordered(
+          room_id, account.network, name, body,
+          lambda rendered_body: send(rendered_body=rendered_body))
+    elif account and account.connected and payload.get("msgtype") in ("m.image", "m.file"):
+      self._send_file_ordered(room_id, account, payload, send, store_offline)
+    else:
+      self.conversion_pool.submit(room_id, send)
+
+  def _render_payload_for_client(self, account, payload):
+    (name, body) = self._get_client_rendering(account, payload)
+    return self.converters.get(account.network, name).convert(body) if name and body else body
+
+  def _get_client_rendering(self, account, payload):
+    """Returns the name of the converter to render the payload for the client
+    (None if no conversion is needed) and the body to convert."""
+    body = query_json_path(payload, "body")
+    fmt = query_json_path(payload, "format")
+    formatted_body = query_json_path(payload, "formatted_body")
+    if "format" in account.config and fmt and account.config["format"] == fmt:
+      return (None, formatted_body)
+    return (self._get_converter_name(account, "convert_from_text"), body)
+
+  def _get_converter_name(self, account, option):
+    """Returns the name of the converter configured for the account network, if it's known."""
+    if option not in account.config:
+      return None
+    name = account.config[option]
+    if name not in CONVERTERS:
+      logger.error(
+          "PuMaDuct misconfiguration: converter '{0}' ('{1}') for the network '{2}' is unknown.",
+          name, option, account.network)
+      return None
+    return name
+
+def _client_queue_key(user, account):
+  return (user, account.network, account.ext_user) if account else (user, None, None)
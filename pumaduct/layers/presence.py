@@ -19,13 +19,23 @@
 
 """Handles presences changes and their routing between clients and Matrix."""
 
+from collections import deque
 import logging
+import math
+import time
 
 from pumaduct.layers.layer_base import LayerBase
 from pumaduct.utils import query_json_path
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_PRESENCE_REFRESH_TICK_INTERVAL = 1
+DEFAULT_PRESENCE_DEBOUNCE_INTERVAL = 5
+DEFAULT_PRESENCE_OFFLINE_GRACE_PERIOD = 60
+
+# Statuses ranked by availability, unknown ones rank as 'offline'.
+STATUS_RANKS = {"online": 2, "unavailable": 1}
+
 class PresenceLayer(LayerBase):
   """
   Handles presences changes and their routing between clients and Matrix.
@@ -34,8 +44,42 @@ class PresenceLayer(LayerBase):
     self.base = base_layer
     self.service = service_layer
     self.presence_refresh_interval = conf["presence_refresh_interval"]
+    # The refresh is spread over the interval: every tick refreshes the next
+    # slice of contacts, sized so that all of them are covered once per interval.
+    self.presence_refresh_tick_interval = min(
+        conf["presence_refresh_tick_interval"] if "presence_refresh_tick_interval" in conf
+        else DEFAULT_PRESENCE_REFRESH_TICK_INTERVAL, self.presence_refresh_interval)
     self.presence_refresh_cb = None
+    # (account, contact) remaining to refresh in the current sweep and its monotonic start time.
+    self.presence_refresh_queue = deque()
+    self.presence_refresh_started = None
+    self.presence_refresh_slice = 1
     self.presence_list = set()
+    # Contacts statuses changing again within that interval after being published
+    # are published once the interval passes, so that flapping is not propagated.
+    self.presence_debounce_interval = (
+        conf["presence_debounce_interval"] if "presence_debounce_interval" in conf
+        else DEFAULT_PRESENCE_DEBOUNCE_INTERVAL)
+    # Contacts of the accounts with connection errors are set 'offline' only
+    # if the account doesn't reconnect within that period.
+    self.presence_offline_grace_period = (
+        conf["presence_offline_grace_period"] if "presence_offline_grace_period" in conf
+        else DEFAULT_PRESENCE_OFFLINE_GRACE_PERIOD)
+    # Statuses waiting for the debounce interval to pass, keyed by contact.
+    self.pending_presences = {}
+    self.pending_presences_cb = None
+    self.offline_grace_cbs = {}
+    # If set, presence is published only for the contacts in the tracked rooms
+    # and the ones it was already published for, so that it never becomes stale.
+    # Other contacts get their presence published once they're added to a room.
+    self.presence_interest_only = (
+        conf["presence_interest_only"] if "presence_interest_only" in conf else False)
+    # If set, Matrix server pushes users presence in the transactions, so
+    # the presence list is not used and users presence is not polled.
+    self.receive_ephemeral_events = (
+        conf["receive_ephemeral_events"] if "receive_ephemeral_events" in conf else False)
+    # Last presence of the users pushed by Matrix server.
+    self.users_presences = {}
 
   def __enter__(self):
     self.base.add_clients_callback("user-signed-on", self.on_user_signed_on)
@@ -44,6 +88,7 @@ class PresenceLayer(LayerBase):
     self.base.add_clients_callback("contact-status-changed", self.on_contact_status_changed)
 
     self.base.add_transaction_callback("m.presence", self.on_transaction_presence)
+    self.base.add_rooms_callback("member-added", self.on_member_added)
 
   def __exit__(self, type_, value, traceback):
     self.base.matrix_client.set_user_presence(self.service.user, "offline")
@@ -54,25 +99,27 @@ class PresenceLayer(LayerBase):
     self.base.remove_clients_callback("contact-status-changed", self.on_contact_status_changed)
 
     self.base.remove_transaction_callback("m.presence", self.on_transaction_presence)
+    self.base.remove_rooms_callback("member-added", self.on_member_added)
 
   def start(self):
     self.presence_refresh_cb = self.base.glib.timeout_add_seconds(
-        self.presence_refresh_interval, self.on_presence_refresh)
+        self.presence_refresh_tick_interval, self.on_presence_refresh)
 
-    # Determine which users are on our presence list.
-    presence_list = self.base.matrix_client.get_presence_list(self.service.user)
-    for presence in presence_list:
-      user = query_json_path(presence, "content", "user_id")
-      if user is not None:
-        self.presence_list.add(user)
+    if not self.receive_ephemeral_events:
+      # Determine which users are on our presence list.
+      presence_list = self.base.matrix_client.get_presence_list(self.service.user)
+      for presence in presence_list:
+        user = query_json_path(presence, "content", "user_id")
+        if user is not None:
+          self.presence_list.add(user)
 
-    # Add to presence list everybody who's not yet on it.
-    for user in self.base.accounts:
-      if user not in self.presence_list:
-        logger.info(
-            "Service {0} doesn't have the presence for user {1}, requesting",
-            self.service.user, user)
-        self.base.matrix_client.add_to_presence_list(user, self.service.user)
+      # Add to presence list everybody who's not yet on it.
+      for user in self.base.accounts:
+        if user not in self.presence_list:
+          logger.info(
+              "Service {0} doesn't have the presence for user {1}, requesting",
+              self.service.user, user)
+          self.base.matrix_client.add_to_presence_list(user, self.service.user)
 
     self.base.matrix_client.set_user_presence(self.service.user, "online")
 
@@ -80,21 +127,38 @@ class PresenceLayer(LayerBase):
     if self.presence_refresh_cb:
       self.base.glib.source_remove(self.presence_refresh_cb)
       self.presence_refresh_cb = None
+    self.presence_refresh_queue.clear()
+    self.presence_refresh_started = None
+
+    if self.pending_presences_cb:
+      self.base.glib.source_remove(self.pending_presences_cb)
+      self.pending_presences_cb = None
+    self.pending_presences.clear()
+
+    for cb_id in self.offline_grace_cbs.values():
+      self.base.glib.source_remove(cb_id)
+    self.offline_grace_cbs.clear()
 
   def on_user_signed_on(self, user, account):
     """Syncs the presence between client and Matrix for user and contacts."""
     # Check that the user is on our presence list.
     # Might not be the case if the account was just registered.
-    if user not in self.presence_list:
+    if not self.receive_ephemeral_events and user not in self.presence_list:
       logger.info(
           "Service {0} doesn't have the presence for user {1}, requesting",
           self.service.user, user)
       if self.base.matrix_client.add_to_presence_list(user, self.service.user):
         self.presence_list.add(user)
 
+    # Reconnected within the grace period, statuses that didn't change won't be republished.
+    self._cancel_offline_grace(account)
+
     # Mirror back to the client the presence of this user.
-    presence = self.base.matrix_client.get_non_managed_user_presence(
-        user, self.service.user)
+    if self.receive_ephemeral_events:
+      presence = self.users_presences.get(user)
+    else:
+      presence = self.base.matrix_client.get_non_managed_user_presence(
+          user, self.service.user)
     if presence is not None:
       account.client.set_account_status(
           account.network, account.ext_user, presence)
@@ -104,12 +168,20 @@ class PresenceLayer(LayerBase):
 
   def on_user_signed_off(self, user, account):
     """Sets contacts statuses for the user to 'offline'."""
-    self._set_contacts_statuses(user, account, "offline")
+    # Signing off after the connection error is handled by the grace period.
+    if account not in self.offline_grace_cbs:
+      self._set_contacts_statuses(user, account, "offline")
 
   def on_connection_error(self, user, account, reason, description):
-    """Sets contacts statuses for the user to 'offline'."""
+    """Sets contacts statuses for the user to 'offline' unless the account
+    reconnects within the grace period."""
     del reason, description # Unused.
-    self._set_contacts_statuses(user, account, "offline")
+    if not self.presence_offline_grace_period:
+      self._set_contacts_statuses(user, account, "offline")
+    elif account not in self.offline_grace_cbs:
+      self.offline_grace_cbs[account] = self.base.glib.timeout_add_seconds(
+          self.presence_offline_grace_period,
+          lambda: self._on_offline_grace_timeout(user, account))
     # Allow reconnect.
     return True
 
@@ -117,34 +189,147 @@ class PresenceLayer(LayerBase):
     """Routes contact status change to Matrix."""
     del user # Unused.
     contact = self.base.ext_contact_to_mxid(account.network, ext_contact)
-    self.base.matrix_client.set_user_presence(contact, status)
+    status = self._get_ghost_status(account, contact, status)
+    if self.presence_interest_only and not self._is_interesting(contact):
+      return
+    last = self._get_published_presence(contact)
+    if last and last[0] == status and contact not in self.pending_presences:
+      return
+    if last and time.monotonic() - last[1] < self.presence_debounce_interval:
+      self.pending_presences[contact] = status
+      if not self.pending_presences_cb:
+        self.pending_presences_cb = self.base.glib.timeout_add_seconds(
+            self.presence_debounce_interval, self.on_publish_pending_presences)
+      return
+    self.pending_presences.pop(contact, None)
+    self._set_presence(contact, status)
+
+  def on_publish_pending_presences(self):
+    """Publishes the statuses that were held back by debouncing."""
+    self.pending_presences_cb = None
+    pending_presences = self.pending_presences
+    self.pending_presences = {}
+    for contact, status in pending_presences.items():
+      self._set_presence(contact, status)
+    # The source is removed by returning 'False'.
+    return False
 
   def on_presence_refresh(self):
-    """Refresh the presence for all contacts of all accounts on Matrix server."""
-    for user, accounts in self.base.accounts.items():
-      for account in accounts:
-        # Set Matrix presence for all contacts of this user.
-        for contact in account.contacts:
-          ext_contact = self.base.mxid_to_ext_contact(account.network, contact)
-          status = account.client.get_contact_status(
-              account.network, account.ext_user, ext_contact)
-          self.on_contact_status_changed(user, account, ext_contact, status)
-    self.base.matrix_client.set_user_presence(self.service.user, "online")
+    """Refreshes the presence of the next slice of contacts on Matrix server."""
+    if not self.presence_refresh_queue:
+      now = time.monotonic()
+      # The sweep might finish early, e.g. if there are only a few contacts,
+      # the next one starts only once the interval passes anyway.
+      if (self.presence_refresh_started is not None and
+          now - self.presence_refresh_started < self.presence_refresh_interval):
+        return True
+      self.presence_refresh_started = now
+      self._start_presence_refresh()
+    for _ in range(min(self.presence_refresh_slice, len(self.presence_refresh_queue))):
+      (account, contact) = self.presence_refresh_queue.popleft()
+      # Skip the contacts removed since the sweep started.
+      if contact not in account.contacts:
+        continue
+      ext_contact = self.base.mxid_to_ext_contact(account.network, contact)
+      status = account.client.get_contact_status(
+          account.network, account.ext_user, ext_contact)
+      status = self._get_ghost_status(account, contact, status)
+      # Matrix server expires the presence, so it's refreshed even if it didn't change.
+      self.pending_presences.pop(contact, None)
+      self._set_presence(contact, status, force=True)
     # Continue calling this callback.
     return True
 
+  def on_member_added(self, room_id, room, contact):
+    """Publishes the presence of the contact that wasn't published as no room had it."""
+    del room_id # Unused.
+    if not self.presence_interest_only or self._get_published_presence(contact):
+      return
+    account = self.base.find_account_for_contact(room.user, contact)
+    if account and account.connected:
+      ext_contact = self.base.mxid_to_ext_contact(account.network, contact)
+      status = account.client.get_contact_status(
+          account.network, account.ext_user, ext_contact)
+      self._set_presence(contact, self._get_ghost_status(account, contact, status))
+
   def on_transaction_presence(self, transaction_id, event):
     """Routes user presence changes from Matrix to the client."""
     del transaction_id # Unused.
-    user = query_json_path(event, "content", "user_id")
+    # Pushed ephemeral events have the user as the sender.
+    user = query_json_path(event, "content", "user_id") or query_json_path(event, "sender")
     presence = query_json_path(event, "content", "presence")
-    if user in self.base.accounts:
+    if user in self.base.accounts and presence is not None:
+      self.users_presences[user] = presence
       for account in self.base.accounts[user]:
         account.client.set_account_status(account.network, account.ext_user, presence)
 
+  def _start_presence_refresh(self):
+    # Contacts shared by several accounts are refreshed only once.
+    contacts = set()
+    for accounts in self.base.accounts.values():
+      for account in accounts:
+        for contact in self._filter_interesting(account.contacts):
+          if contact not in contacts:
+            contacts.add(contact)
+            self.presence_refresh_queue.append((account, contact))
+    self.presence_refresh_slice = max(1, math.ceil(
+        len(self.presence_refresh_queue) * self.presence_refresh_tick_interval /
+        self.presence_refresh_interval))
+    logger.debug(
+        "Refreshing the presence of {0} contacts, {1} per tick",
+        len(self.presence_refresh_queue), self.presence_refresh_slice)
+    self.base.matrix_client.set_user_presence(self.service.user, "online")
+
+  def _get_ghost_status(self, account, contact, status):
+    """Records the status of the contact reported by the account and returns
+    the status to publish: the contact might be shared with other accounts,
+    so it's the most available of the statuses they report."""
+    ghost = self.base.ghosts.get(contact)
+    if not ghost:
+      return status
+    ghost.statuses[account] = status
+    return max(ghost.statuses.values(), key=lambda value: STATUS_RANKS.get(value, 0))
+
+  def _get_published_presence(self, contact):
+    """Returns the last status published for the contact and its monotonic time, if any.
+
+    It's kept by the ghost, so that it's dropped together with it."""
+    ghost = self.base.ghosts.get(contact)
+    return ghost.presence if ghost else None
+
+  def _is_interesting(self, contact):
+    return self.base.has_rooms(contact) or self._get_published_presence(contact)
+
+  def _filter_interesting(self, contacts):
+    """Returns the contacts presence should be published for."""
+    if not self.presence_interest_only:
+      return contacts
+    return [contact for contact in contacts if self._is_interesting(contact)]
+
+  def _set_presence(self, contact, status, force=False):
+    last = self._get_published_presence(contact)
+    if not force and last and last[0] == status:
+      return
+    if self.base.matrix_client.set_user_presence(contact, status):
+      ghost = self.base.ghosts.get(contact)
+      if ghost:
+        ghost.presence = (status, time.monotonic())
+
+  def _cancel_offline_grace(self, account):
+    cb_id = self.offline_grace_cbs.pop(account, None)
+    if cb_id:
+      self.base.glib.source_remove(cb_id)
+
+  def _on_offline_grace_timeout(self, user, account):
+    # The source is removed by returning 'False', so just forget about it.
+    del self.offline_grace_cbs[account]
+    if not account.connected:
+      self._set_contacts_statuses(user, account, "offline")
+    return False
+
   def _set_contacts_statuses(self, user, account, status):
     # Set Matrix presence for all contacts of this user.
-    for contact in account.contacts:
+    for contact in self._filter_interesting(account.contacts):
       ext_contact = self.base.mxid_to_ext_contact(account.network, contact)
       if not status:
         new_status = account.client.get_contact_status(
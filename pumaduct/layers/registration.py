@@ -19,6 +19,7 @@
 
 """Handles users registeration / unregistration."""
 
+import functools
 import logging
 
 from collections import defaultdict
@@ -38,6 +39,8 @@ FATAL_REGISTRATION_ERRORS = set([
 class Registration(object):
   """Represents one registration request on the external network by Matrix user."""
 
+  __slots__ = ("room_id", "password")
+
   def __init__(self, room_id=None, password=None):
     """
     :param room_id: ID of the service room the registration is taking place in.
@@ -91,22 +94,37 @@ class RegistrationLayer(LayerBase):
         stored_account = self.base.account_storage(
             user=user, network=network, ext_user=ext_user,
             password=reg.password)
-        self.base.db_session.add(stored_account)
-        self.base.db_session.commit()
-        net_conf = self.base.networks[network]
-        client = self.base.clients[net_conf["client"]]
-        account = Account(
-            stored_account.id, stored_account.network,
-            stored_account.ext_user, stored_account.password,
-            stored_account.auth_token, net_conf, client)
-        self.base.accounts[user].append(account)
-        self.service.send_message(
-            reg.room_id, user, "Successfully registered "
-            "{0} on the network {1}".format(user, network))
-        self.base.dispatch_callbacks("user-signed-on", network, ext_user)
+        def store_account(db_session):
+          db_session.add(stored_account)
+          db_session.flush()
+          return stored_account.id
+        self.base.storage.submit(
+            store_account,
+            functools.partial(self.on_account_stored, reg, user, network, ext_user),
+            functools.partial(self.on_account_store_failed, reg, user, network, ext_user))
       else:
         raise InternalError("Room id '{0}' not found in service rooms!".format(reg.room_id))
 
+  def on_account_stored(self, reg, user, network, ext_user, account_id):
+    """Completes the registration once the account is stored."""
+    net_conf = self.base.networks[network]
+    client = self.base.clients[net_conf["client"]]
+    account = Account(
+        account_id, network, ext_user, reg.password, None, net_conf, client)
+    self.base.accounts[user].append(account)
+    self.service.send_message(
+        reg.room_id, user, "Successfully registered "
+        "{0} on the network {1}".format(user, network))
+    self.base.dispatch_callbacks("user-signed-on", network, ext_user)
+
+  def on_account_store_failed(self, reg, user, network, ext_user, error):
+    """Reports the registration failure if the account cannot be stored."""
+    net_conf = self.base.networks[network]
+    self.base.clients[net_conf["client"]].logout(network, ext_user)
+    self.service.send_message(
+        reg.room_id, user, "Failed to register {0} on network {1}: "
+        "cannot store the account: '{2}'".format(user, network, error))
+
   def on_connection_error_without_account( # pylint: disable=invalid-name
       self, network, ext_user, reason, description):
     """Discard the pending registration if this connection error is permanent."""
@@ -195,14 +213,15 @@ class RegistrationLayer(LayerBase):
     # Therefore, just clean up the accounts table and remove
     # its cached version. Offline messages stay intact and will
     # be garbage-collected once they expire.
-    self.base.db_session.query(self.base.account_storage).filter(
-        self.base.account_storage.id == account.id).delete()
-    self.base.db_session.commit()
+    account_storage = self.base.account_storage
+    account_id = account.id
+    self.base.storage.submit(lambda db_session: db_session.query(account_storage).filter(
+        account_storage.id == account_id).delete())
+    self.base.remove_contacts(account)
     self.base.accounts[user].remove(account)
     if not self.base.accounts[user]:
       del self.base.accounts[user]
-    if (user, account) in self.messages.pending_deliveries_to_clients:
-      self.messages.pending_deliveries_to_clients.remove((user, account))
+    self.messages.stop_delivery_to_client(user, account)
     self.service.send_message(
         room_id, sender, "Unregistered account {0} for the user {1} "
         "on the network {2}.".format(args[2], user, args[1]))
@@ -21,8 +21,10 @@
 
 import logging
 
+from cachetools import TTLCache
+
 from pumaduct.layers.layer_base import LayerBase
-from pumaduct.utils import query_json_path
+from pumaduct.utils import get_bookkeeping_limits, intern_id, query_json_path
 
 logger = logging.getLogger(__name__)
 
@@ -34,20 +36,28 @@ class RoomStateLayer(LayerBase):
   * Handles room membership events.
   """
   def __init__(self, conf, base_layer, service_layer):
-    del conf # Unused.
     self.base = base_layer
     self.service = service_layer
-    self.contact_rooms_populated = set()
+    # Expiring entries here just means the rooms for the contact are re-fetched
+    # from Matrix server on the next contact update.
+    self.contact_rooms_populated = TTLCache(*get_bookkeeping_limits(conf))
+    # Members of the rooms evicted from memory, keyed by room_id: expiring entries
+    # here means the room is restored from Matrix server state on the next contact update.
+    self.evicted_rooms = TTLCache(*get_bookkeeping_limits(conf))
 
   def __enter__(self):
     self.base.add_clients_callback("user-signed-on", self.on_user_signed_on)
     self.base.add_clients_callback("contact-updated", self.on_contact_updated)
     self.base.add_transaction_callback("m.room.member", self.on_transaction_membership)
+    self.base.add_rooms_callback("room-removed", self.on_room_removed)
+    self.base.add_rooms_callback("room-missing", self.on_room_missing)
 
   def __exit__(self, type_, value, traceback):
     self.base.remove_clients_callback("user-signed-on", self.on_user_signed_on)
     self.base.remove_clients_callback("contact-updated", self.on_contact_updated)
     self.base.remove_transaction_callback("m.room.member", self.on_transaction_membership)
+    self.base.remove_rooms_callback("room-removed", self.on_room_removed)
+    self.base.remove_rooms_callback("room-missing", self.on_room_missing)
 
   def start(self):
     # Initiate rooms processing for service user, as it won't happen automatically.
@@ -67,7 +77,22 @@ class RoomStateLayer(LayerBase):
     del display_name # Unused.
     contact = self.base.ext_contact_to_mxid(account.network, ext_contact)
     if (user, contact) not in self.contact_rooms_populated:
-      self.contact_rooms_populated.add((user, contact))
+      self._populate_contact_rooms(user, contact)
+
+  def on_room_removed(self, room_id, room, evicted):
+    """Makes sure rooms for the members of the removed room are re-fetched when needed."""
+    for member in room.members:
+      self.contact_rooms_populated.pop((room.user, member), None)
+    # Rooms that were left are not usable anymore, so there's nothing to restore.
+    if evicted and room.members:
+      self.evicted_rooms[room_id] = frozenset(room.members)
+
+  def on_room_missing(self, user, contact, room_id):
+    """Restores the rooms for the user and contact or the room
+    with given ID from Matrix server state."""
+    if room_id:
+      self._restore_evicted_room(user, room_id)
+    elif contact and (user, contact) not in self.contact_rooms_populated:
       self._populate_contact_rooms(user, contact)
 
   def on_transaction_membership(self, transaction_id, event):
@@ -87,8 +112,8 @@ class RoomStateLayer(LayerBase):
     # account implies that they don't require any further request / confirmation to join
     # the room. This is likely the case for all 1:1 chats but might not be the case for
     # multi-user chats.
-    sender = event["sender"]
-    invited_user = event["state_key"]
+    sender = intern_id(event["sender"])
+    invited_user = intern_id(event["state_key"])
     room_id = event["room_id"]
     if invited_user == self.service.user:
       if self.base.matrix_client.join_room(room_id, invited_user):
@@ -96,9 +121,7 @@ class RoomStateLayer(LayerBase):
     elif self.base.find_account_for_contact(sender, invited_user):
       if not self._room_has_member(room_id, invited_user):
         if self.base.matrix_client.join_room(room_id, invited_user):
-          if room_id not in self.base.rooms:
-            self.base.rooms[room_id].user = sender
-          self.base.rooms[room_id].members.add(invited_user)
+          self.base.add_room_member(room_id, sender, invited_user)
 
   def _handle_leave_event(self, event):
     # We assume that we don't need to send any notification to the external
@@ -114,8 +137,15 @@ class RoomStateLayer(LayerBase):
             "Tried to remove service user '{0}' from the room '{1}' "
             "but no service room with this ID was found", left_user, room_id)
     elif self.base.find_account_for_contact(sender, left_user):
+      self.evicted_rooms.pop(room_id, None)
       if self._room_has_member(room_id, left_user):
-        self.base.rooms[room_id].members.remove(left_user)
+        self.base.remove_room_member(room_id, left_user)
+        # No bridged contacts left - there's nothing we can do with this room anymore.
+        if not self.base.get_room(room_id).members:
+          self.base.remove_room(room_id)
+    elif room_id in self.base.rooms and self.base.rooms[room_id].user == left_user:
+      # The room owner has left the room, the room is not usable for bridging anymore.
+      self.base.remove_room(room_id)
 
   def _handle_join_event(self, event):
     sender = event["sender"]
@@ -136,19 +166,37 @@ class RoomStateLayer(LayerBase):
   def _room_has_member(self, room_id, member):
     return room_id in self.base.rooms and member in self.base.rooms[room_id].members
 
+  def _restore_evicted_room(self, user, room_id):
+    members = self.evicted_rooms.pop(room_id, None)
+    if not members:
+      return
+    # Any bridged member can see the room membership, so normally
+    # the first one is enough to confirm the room is still usable.
+    for member in members:
+      joined = self.base.matrix_client.get_room_members(room_id, member)
+      if joined is not None:
+        break
+    else:
+      logger.info("Cannot retrieve members of the evicted room '{0}'", room_id)
+      return
+    if user in joined:
+      for member in members & joined:
+        if self.base.find_account_for_contact(user, member):
+          self.base.add_room_member(room_id, user, member)
+
   def _populate_contact_rooms(self, user, contact):
+    self.contact_rooms_populated[(user, contact)] = True
     state = self._get_rooms_state(contact)
     for room_id, members in _get_joined_members(state):
       if user in members and contact in members:
-        self.base.rooms[room_id].user = user
-        self.base.rooms[room_id].members.add(contact)
+        self.base.add_room_member(room_id, user, contact)
 
   def _populate_service_rooms(self):
     state = self._get_rooms_state(self.service.user)
     for room_id, members in _get_joined_members(state):
       if self.service.user in members and len(members) > 1:
         members.remove(self.service.user)
-        self.service.rooms[room_id].user = members.pop()
+        self.service.rooms[room_id].user = intern_id(members.pop())
 
   def _get_rooms_state(self, contact):
     # There seems to be no easy way to just get the current state of the room, or
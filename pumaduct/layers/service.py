@@ -26,6 +26,7 @@ from collections import defaultdict, namedtuple
 from datetime import datetime
 
 from pumaduct.layers.layer_base import LayerBase
+from pumaduct.utils import intern_id
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +36,8 @@ class ServiceRoom(object):
 
   We track only Matrix user and service user, no other members in this room are expected.
   """
+  __slots__ = ("user", "data")
+
   def __init__(self, user=None):
     """
     :param user: MXID of the user this service room is for.
@@ -42,7 +45,7 @@ class ServiceRoom(object):
     These fields are set later, once the necessary information is available:
     * `data`: key-value storage to track temporary state in the room by the layers using it.
     """
-    self.user = user
+    self.user = intern_id(user)
     self.data = {}
 
 ServiceCallbackConfig = namedtuple("ServiceCallbackConfig", ["callback", "description"])
@@ -101,7 +104,7 @@ class ServiceLayer(LayerBase):
       if room.user == user:
         return room_id
     room_id = self.base.matrix_client.create_room(self.user, [user])
-    self.rooms[room_id].user = user
+    self.rooms[room_id].user = intern_id(user)
     return room_id
 
   def send_message(self, room_id, user, text):
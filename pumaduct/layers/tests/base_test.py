@@ -19,7 +19,9 @@
 
 """Tests BaseLayer functionality."""
 
-from pumaduct.layers.base import _parse_hs_host
+from unittest.mock import Mock
+
+from pumaduct.layers.base import ContactsMapping, _parse_hs_host
 from pumaduct.layers.tests.common import LayerTestCommon
 
 class BaseLayerTest(LayerTestCommon):
@@ -114,6 +116,20 @@ class BaseLayerTest(LayerTestCommon):
       self.backend.process_transaction(
           1, {"events": [{"sender": "@test:localhost", "type": "m.room.create"}]})
 
+  def test_transaction_ephemeral_events(self):
+    self.backend = self.create_backend()
+    callback = Mock()
+    event = {"sender": "@test:localhost", "type": "m.typing"}
+    with self.backend:
+      self.backend.base.add_transaction_callback("m.typing", callback)
+      # The same events under both keys are dispatched only once.
+      self.backend.process_transaction(1, {
+          "events": [], "de.sorunome.msc2409.ephemeral": [event], "ephemeral": [event]})
+      callback.assert_called_once_with(1, event)
+      self.backend.process_transaction(2, {"events": [], "ephemeral": [event]})
+      callback.assert_called_with(2, event)
+      self.backend.base.remove_transaction_callback("m.typing", callback)
+
   def test_transaction_missing_required_attributes(self):
     self.backend = self.create_backend()
     with self.backend:
@@ -173,3 +189,77 @@ class BaseLayerTest(LayerTestCommon):
       self.mc.set_users_power_levels.assert_called_with(
           "room_id0", "@xmpp-test2:localhost",
           {"@test:localhost": 75, "@xmpp-test2:localhost": 100})
+
+  def test_member_rooms(self):
+    self.backend = self.create_backend()
+    base = self.backend.base
+    base.add_room_member("room_id1", "@test:localhost", "@xmpp-test2:localhost")
+    base.add_room_member("room_id1", "@test:localhost", "@xmpp-test2:localhost")
+    base.add_room_member("room_id2", "@test:localhost", "@xmpp-test2:localhost")
+    base.add_room_member("room_id2", "@test:localhost", "@xmpp-test3:localhost")
+    self.assertEqual(base.member_rooms["@xmpp-test2:localhost"], 2)
+    base.remove_room("room_id1")
+    self.assertTrue(base.has_rooms("@xmpp-test2:localhost"))
+    base.remove_room_member("room_id2", "@xmpp-test2:localhost")
+    base.remove_room_member("room_id2", "@xmpp-test2:localhost")
+    self.assertFalse(base.has_rooms("@xmpp-test2:localhost"))
+    base.remove_room("room_id2")
+    self.assertFalse(base.has_rooms("@xmpp-test3:localhost"))
+    self.assertEqual(base.member_rooms, {})
+
+  def test_chat_rooms(self):
+    self.backend = self.create_backend()
+    base = self.backend.base
+    base.add_room_member("room_id1", "@test:localhost", "@xmpp-test2:localhost")
+    base.add_room_member("room_id2", "@test:localhost", "@xmpp-test2:localhost")
+    base.set_room_chat("room_id1", 456)
+    self.assertEqual(base.find_chat_room("@test:localhost", 456), "room_id1")
+    self.assertIsNone(base.find_chat_room("@test2:localhost", 456))
+    base.set_room_chat("room_id1", 789)
+    self.assertIsNone(base.find_chat_room("@test:localhost", 456))
+    self.assertEqual(base.find_chat_room("@test:localhost", 789), "room_id1")
+    base.set_room_chat("room_id2", 456)
+    base.set_room_chat("room_id2", None)
+    self.assertIsNone(base.find_chat_room("@test:localhost", 456))
+    base.remove_room("room_id1", evicted=True)
+    self.assertEqual(base.chat_rooms, {})
+
+  def test_contacts_mapping_pinned(self):
+    self.create_account()
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      account = self.backend.base.accounts["@test:localhost"][0]
+      # Thrash the bounded caches: known contacts should still be served
+      # from the pinned mapping and not touch the caches at all.
+      for i in range(3):
+        self.backend.base.ext_contact_to_mxid("prpl-jabber", "other{0}@localhost".format(i))
+      misses = self.backend.base.ext_contacts_to_mxids.misses
+      self.assertEqual(
+          self.backend.base.ext_contact_to_mxid("prpl-jabber", "test2@localhost"),
+          "@xmpp-test2:localhost")
+      self.assertEqual(
+          self.backend.base.mxid_to_ext_contact("prpl-jabber", "@xmpp-test2:localhost"),
+          "test2@localhost")
+      self.assertEqual(self.backend.base.ext_contacts_to_mxids.misses, misses)
+      self.assertEqual(len(self.backend.base.ext_contacts_to_mxids), 1)
+      # Mapping is scoped by network.
+      self.assertIsNone(self.backend.base.contacts_mapping.get_mxid(
+          "prpl-other", "test2@localhost"))
+      # Removing the contacts unpins the translations.
+      self.backend.base.remove_contacts(account)
+      self.assertIsNone(self.backend.base.contacts_mapping.get_mxid(
+          "prpl-jabber", "test2@localhost"))
+      self.assertIn("senders_access", self.backend.base.get_caches_stats())
+
+  def test_contacts_mapping_alias_taken_over(self):
+    mapping = ContactsMapping()
+    mapping.add("prpl-jabber", "@xmpp-a:localhost", "a@localhost", "alias@localhost")
+    mapping.add("prpl-jabber", "@xmpp-b:localhost", "b@localhost", "alias@localhost")
+    self.assertTrue(mapping.remove("prpl-jabber", "@xmpp-a:localhost"))
+    # The alias now belongs to the other contact and must be kept.
+    self.assertEqual(
+        mapping.get_mxid("prpl-jabber", "alias@localhost"), "@xmpp-b:localhost")
+    self.assertIsNone(mapping.get_mxid("prpl-jabber", "a@localhost"))
+    self.assertTrue(mapping.remove("prpl-jabber", "@xmpp-b:localhost"))
+    self.assertIsNone(mapping.get_mxid("prpl-jabber", "alias@localhost"))
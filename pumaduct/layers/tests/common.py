@@ -19,6 +19,8 @@
 
 """Common functionality for all layers tests."""
 
+import shutil
+import tempfile
 import unittest
 
 from unittest.mock import create_autospec
@@ -32,7 +34,7 @@ from pumaduct import logger_format
 from pumaduct import matrix_client
 from pumaduct import purple_client
 
-from pumaduct.storage import Base, Account, Message
+from pumaduct.storage import Base, Account, Message, SentEvent
 
 class BackendWithStopOnExit(backend.Backend):
   """Wrapper for PuMaDuct backend that calls stop() on exit."""
@@ -74,7 +76,13 @@ class LayerTestCommon(unittest.TestCase):
         "users_blacklist": ["^@spammer:{hs_host}$"],
         "users_whitelist": ["^@[^:]+:{hs_host}$"],
         "hs_server": "https://localhost:8448",
-        "offline_messages_delivery_interval": 1
+        "offline_messages_delivery_interval": 1,
+        # Perform DB operations synchronously, so that their effects are visible right away.
+        "storage_thread": False,
+        "media_spool_path": tempfile.mkdtemp(prefix="pumaduct-media-"),
+        # Transfer media synchronously, so that its effects are visible right away.
+        "media_transfer_workers": 0,
+        "media_transfers_path": tempfile.mkdtemp(prefix="pumaduct-transfers-")
     }
     self.db_session = sessionmaker(bind=engine)()
     self.pc.get_contact_icon.return_value = ("png", "PNG")
@@ -101,9 +109,11 @@ class LayerTestCommon(unittest.TestCase):
     clients = {"purple": self.pc}
     return BackendWithStopOnExit(
         self.conf, self.glib, self.mc, clients,
-        self.db_session, Account, Message)
+        self.db_session, Account, Message, SentEvent)
 
   def tearDown(self):
+    shutil.rmtree(self.conf["media_spool_path"])
+    shutil.rmtree(self.conf["media_transfers_path"])
     self.db_session = None
     Base.metadata.bind = None
     logger_format.clean()
@@ -19,7 +19,10 @@
 
 """Tests ConnnectionLayer functionality."""
 
+from unittest.mock import call
+
 from pumaduct.layers.tests.common import LayerTestCommon
+from pumaduct.storage import Account
 
 class ConnectionTest(LayerTestCommon):
   """Tests ConnnectionLayer functionality."""
@@ -60,3 +63,54 @@ class ConnectionTest(LayerTestCommon):
           "@xmpp-test2:localhost",
           self.backend.base.accounts["@test:localhost"][0].contacts)
       self.mc.register_user.assert_called_with("@xmpp-test2:localhost")
+
+  def test_shared_contact_synced_once(self):
+    self.create_account()
+    self.db_session.add(Account(
+        user="@test3:localhost", network="prpl-jabber",
+        ext_user="test3@localhost", password="password"))
+    self.db_session.commit()
+    self.mc.has_user.return_value = False
+    self.mc.get_user_profile.return_value = {}
+    self.pc.get_contacts.return_value = [("test2@localhost", "Test2")]
+    self.backend = self.create_backend()
+    with self.backend:
+      self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test@localhost")
+      self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test3@localhost")
+      for user in ("@test:localhost", "@test3:localhost"):
+        self.assertIn("@xmpp-test2:localhost", self.backend.base.accounts[user][0].contacts)
+      self.mc.register_user.assert_called_with("@xmpp-test2:localhost")
+      self.assertEqual(
+          self.mc.get_user_profile.call_args_list.count(call("@xmpp-test2:localhost")), 1)
+      self.assertEqual(
+          self.mc.set_user_display_name.call_args_list.count(
+              call("@xmpp-test2:localhost", "Test2")), 1)
+      # The ghost is dropped once no account has the contact.
+      for user in ("@test:localhost", "@test3:localhost"):
+        self.assertIn("@xmpp-test2:localhost", self.backend.base.ghosts)
+        self.backend.base.remove_contacts(self.backend.base.accounts[user][0])
+      self.assertNotIn("@xmpp-test2:localhost", self.backend.base.ghosts)
+
+  def test_shared_contact_registration_failed(self):
+    self.create_account()
+    self.db_session.add(Account(
+        user="@test3:localhost", network="prpl-jabber",
+        ext_user="test3@localhost", password="password"))
+    self.db_session.commit()
+    self.mc.has_user.return_value = False
+    self.mc.register_user.return_value = False
+    self.mc.get_user_profile.return_value = {}
+    self.pc.get_contacts.return_value = [("test2@localhost", "Test2")]
+    self.backend = self.create_backend()
+    with self.backend:
+      with self.assertLogs("pumaduct.layers.connection", level="ERROR"):
+        self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test@localhost")
+      self.assertNotIn(call("@xmpp-test2:localhost"), self.mc.get_user_profile.call_args_list)
+      self.assertFalse(self.backend.base.ghosts["@xmpp-test2:localhost"].profile_synced)
+      # The other account having the contact retries the registration.
+      self.mc.register_user.return_value = True
+      self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test3@localhost")
+      self.assertEqual(
+          self.mc.register_user.call_args_list.count(call("@xmpp-test2:localhost")), 2)
+      self.mc.set_user_display_name.assert_called_with("@xmpp-test2:localhost", "Test2")
+      self.assertTrue(self.backend.base.ghosts["@xmpp-test2:localhost"].profile_synced)
@@ -19,14 +19,25 @@
 
 """Tests MessagesLayer functionality."""
 
+import base64
 import copy
+import hashlib
+import json
 import logging
-from datetime import datetime
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest.mock import ANY, patch
+
+import html2text
 
 from pumaduct.im_client_base import ClientError
 from pumaduct.layers.base import InternalError
 from pumaduct.layers.tests.common import LayerTestCommon
-from pumaduct.storage import Message
+from pumaduct.payload_codec import PayloadCodec
+from pumaduct.storage import Message, SentEvent
 
 # pylint: disable=duplicate-code
 
@@ -76,6 +87,14 @@ INVITE_AND_MESSAGE_EVENTS = {
     ]
 }
 
+GROUP_INVITE_AND_MESSAGE_EVENTS = {
+    "events": [
+        INVITE_EVENTS["events"][0],
+        dict(INVITE_EVENTS["events"][0], event_id="event_id2", state_key="@xmpp-test3:localhost"),
+        MESSAGE_EVENTS["events"][0]
+    ]
+}
+
 INITIAL_SYNC_CONTACT_STATE = {
     "next_batch": "abc123",
     "rooms": {
@@ -139,6 +158,35 @@ FILE_EVENTS = {
 IMAGE_DATA = b"\x47\x49\x46\x38\x39\x61\x01\x00\x01\x00\x00\x00\x00\x3b"
 FILE_DATA = b"\x01\x02\x03\x04\x05"
 
+# The image data is too truncated for the dimensions to be known.
+IMAGE_INFO = {"mimetype": "image/gif", "size": len(IMAGE_DATA)}
+
+def downloading(data):
+  """Returns replacement of the function downloading the content into the file object
+  passed as the last argument, which downloads `data`, failing if it's None."""
+  def download_content(*args, **kwargs):
+    del kwargs # Unused.
+    if data is None:
+      return None
+    args[-1].write(data)
+    return True
+  return download_content
+
+def reading(calls, result):
+  """Returns replacement of the function taking the content as the last argument,
+  which records its arguments with the file content read and returns `result`."""
+  def read_content(*args, **kwargs):
+    del kwargs # Unused.
+    content = args[-1]
+    calls.append(args[:-1] + (content.read() if hasattr(content, "read") else content,))
+    return result
+  return read_content
+
+def attempt_deliveries_to_clients(messages):
+  """Attempts delivering all pending offline messages to clients right away."""
+  for (user, account) in list(messages.pending_deliveries_to_clients):
+    messages.on_attempt_delivery_to_client(user, account)
+
 class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-methods
   """Tests MessagesLayer functionality."""
 
@@ -157,6 +205,42 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
           "room_id0", "@xmpp-test2:localhost",
           dt, {"msgtype": "m.text", "body": "Test message."})
 
+  def test_route_purple_message_burst(self):
+    self.create_account()
+    self.mc.create_room.return_value = "room_id0"
+    self.glib.timeout_add.return_value = 1
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    self.backend = self.create_backend()
+    self.backend.base.networks["prpl-jabber"]["coalesce_interval_ms"] = 500
+    self.backend.base.networks["prpl-jabber"]["coalesce_max_length"] = 20
+    with self.backend:
+      self.send_signon_callbacks()
+      for (body, seconds) in (("Line 1", 0), ("Line 2", 1), ("Line 3", 2)):
+        self.backend.base.dispatch_callbacks(
+            "new-message", "prpl-jabber", "test@localhost", 123,
+            "test2@localhost", "recv", body, dt + timedelta(seconds=seconds))
+      self.mc.send_message.assert_not_called()
+      self.assertEqual(self.glib.source_remove.call_count, 2)
+      # The window is restarted by every message, the last timeout flushes the burst.
+      self.glib.timeout_add.call_args[0][1]()
+      self.mc.send_message.assert_called_once_with(
+          "room_id0", "@xmpp-test2:localhost",
+          dt, {"msgtype": "m.text", "body": "Line 1\nLine 2\nLine 3"})
+      # Messages exceeding the maximum length start the new burst.
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "recv", "Long line 1", dt)
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "recv", "Long line 2", dt)
+      self.mc.send_message.assert_called_with(
+          "room_id0", "@xmpp-test2:localhost",
+          dt, {"msgtype": "m.text", "body": "Long line 1"})
+    # Pending bursts are flushed on stop.
+    self.mc.send_message.assert_called_with(
+        "room_id0", "@xmpp-test2:localhost",
+        dt, {"msgtype": "m.text", "body": "Long line 2"})
+
   def test_route_purple_message_postprocess(self):
     self.create_account()
     self.mc.create_room.return_value = "room_id0"
@@ -176,6 +260,35 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
           dt, {"msgtype": "m.text", "body": "**Test** message.", "format": "some-format",
                "formatted_body": "<html><span><strong>Test</strong> message.</span></html>"})
 
+  def test_route_purple_message_offloaded_conversion(self):
+    self.create_account()
+    self.mc.create_room.return_value = "room_id0"
+    self.conf["conversion_offload_threshold"] = 100
+    self.backend = self.create_backend()
+    self.backend.base.networks["prpl-jabber"]["convert_to_text"] = "html2text"
+    invoked = []
+    self.glib.main_context_invoke.side_effect = invoked.append
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    with self.backend:
+      self.send_signon_callbacks()
+      large_body = "<p>{0}</p>".format("<b>Large</b> message. " * 10)
+      for body in (large_body, "Small message."):
+        self.backend.base.dispatch_callbacks(
+            "new-message", "prpl-jabber", "test@localhost", 123,
+            "test2@localhost", "recv", body, dt)
+      # The small message must wait for the large one, converted by the worker.
+      self.mc.send_message.assert_not_called()
+      for _ in range(100):
+        if invoked:
+          break
+        time.sleep(0.01)
+      self.assertEqual(len(invoked), 1)
+      invoked[0]()
+      self.assertEqual(
+          [call[0][3]["body"] for call in self.mc.send_message.call_args_list],
+          [html2text.HTML2Text().handle(large_body).rstrip("\n"), "Small message."])
+      self.assertEqual(self.backend.messages.conversion_pool.pending, {})
+
   def test_route_purple_message_unknown_postprocessor(self):
     self.create_account()
     self.mc.create_room.return_value = "room_id0"
@@ -232,6 +345,22 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
         self.pc.send_message.assert_called_with(
             "prpl-jabber", "test@localhost", 123, "Test message.")
 
+  def test_route_matrix_message_failed_conversion(self):
+    self.create_account()
+    self.pc.create_conversation.return_value = 123
+    self.backend = self.create_backend()
+    self.backend.base.networks["prpl-jabber"]["convert_from_text"] = "markdown"
+    events = copy.deepcopy(INVITE_AND_MESSAGE_EVENTS)
+    events["events"][1]["content"]["body"] = "**Test** message."
+    with self.backend:
+      self.send_signon_callbacks()
+      with patch("markdown.Markdown.convert", side_effect=ValueError("Bad markup")):
+        with self.assertLogs("pumaduct.worker_pool", level="ERROR"):
+          self.backend.process_transaction(1, events)
+      # The message is still sent, just not converted.
+      self.pc.send_message.assert_called_with(
+          "prpl-jabber", "test@localhost", 123, "**Test** message.")
+
   def test_route_matrix_message_matching_format(self):
     self.create_account()
     self.pc.create_conversation.return_value = 123
@@ -257,6 +386,46 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
           "conversation-destroyed", "prpl-jabber", "test@localhost", 123)
       self.assertIsNone(self.backend.base.rooms["room_id1"].conv_id)
 
+  def test_route_matrix_message_to_chat(self):
+    self.create_account()
+    self.pc.create_chat.return_value = None
+    self.glib.timeout_add_seconds.return_value = 1
+    self.backend = self.create_backend()
+    self.backend.base.networks["prpl-jabber"]["chats"] = True
+    chat_name = "pumaduct-" + hashlib.sha1(b"room_id1").hexdigest()[:12]
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.base.dispatch_callbacks(
+          "contact-updated", "prpl-jabber", "test@localhost", "test3@localhost", "Test3")
+      self.backend.process_transaction(1, GROUP_INVITE_AND_MESSAGE_EVENTS)
+      self.pc.create_chat.assert_called_once_with(
+          "prpl-jabber", "test@localhost", chat_name, ["test2@localhost", "test3@localhost"])
+      # The message waits for the chat to be joined as the single offline message.
+      self.pc.create_conversation.assert_not_called()
+      self.pc.send_message.assert_not_called()
+      self.assertEqual(self.db_session.query(Message).count(), 1)
+      self.backend.base.dispatch_callbacks(
+          "chat-joined", "prpl-jabber", "test@localhost", 456, chat_name)
+      self.pc.send_message.assert_called_once_with(
+          "prpl-jabber", "test@localhost", 456, "Test message.")
+      self.assertEqual(self.db_session.query(Message).count(), 0)
+      self.backend.process_transaction(2, MESSAGE_EVENTS)
+      self.pc.create_chat.assert_called_once()
+      self.assertEqual(self.pc.send_message.call_count, 2)
+      # Messages of the chat members are relayed to the room.
+      dt = datetime(1970, 1, 1, 3, 25, 45)
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 456,
+          "test3@localhost", "recv", "Test reply.", dt)
+      self.mc.send_message.assert_called_with(
+          "room_id1", "@xmpp-test3:localhost",
+          dt, {"msgtype": "m.text", "body": "Test reply."})
+      self.mc.create_room.assert_not_called()
+      self.backend.base.dispatch_callbacks(
+          "conversation-destroyed", "prpl-jabber", "test@localhost", 456)
+      self.assertIsNone(self.backend.base.rooms["room_id1"].chat_id)
+      self.assertEqual(self.backend.base.chat_rooms, {})
+
   def test_route_to_purple_message_offline(self):
     self.create_account()
     self.pc.create_conversation.return_value = 123
@@ -269,12 +438,13 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       # We won't check the content of the message here, as it's checked
       # below for the final message anyhow.
       self.assertEqual(self.db_session.query(Message).count(), 1)
-      self.assertEqual(self.backend.messages.offline_delivery_to_clients_cb, 1)
+      # Account is offline, so no retries are scheduled until it signs on.
+      self.assertEqual(self.backend.messages.delivery_to_clients_retries.cbs, {})
       self.assertEqual(len(self.backend.messages.pending_deliveries_to_clients), 1)
       # Attempt delivery, but account is still offline - nothing should change here.
-      self.backend.messages.on_attempt_delivery_to_clients()
+      attempt_deliveries_to_clients(self.backend.messages)
       self.assertEqual(self.db_session.query(Message).count(), 1)
-      self.assertEqual(self.backend.messages.offline_delivery_to_clients_cb, 1)
+      self.assertEqual(self.backend.messages.delivery_to_clients_retries.cbs, {})
       self.assertEqual(len(self.backend.messages.pending_deliveries_to_clients), 1)
       # Bring account online - delivery should be performed automatically.
       self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test@localhost")
@@ -283,12 +453,29 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       self.pc.send_message.assert_called_with(
           "prpl-jabber", "test@localhost", 123, "Test message.")
       self.assertEqual(self.db_session.query(Message).count(), 0)
-      self.assertEqual(self.backend.messages.offline_delivery_to_clients_cb, 1)
-      # Should do nothing, just clear the callback.
-      self.backend.messages.on_attempt_delivery_to_clients()
-      self.assertEqual(self.backend.messages.offline_delivery_to_clients_cb, None)
+      self.assertEqual(self.backend.messages.delivery_to_clients_retries.cbs, {})
       self.assertEqual(len(self.backend.messages.pending_deliveries_to_clients), 0)
 
+  def test_route_to_purple_message_offline_room_left(self):
+    self.create_account()
+    self.pc.create_conversation.return_value = 123
+    self.mc.create_room.return_value = "room_id2"
+    self.backend = self.create_backend()
+    with self.backend:
+      self.backend.base.dispatch_callbacks(
+          "contact-updated", "prpl-jabber", "test@localhost", "test2@localhost", "Test2")
+      self.backend.process_transaction(1, INVITE_AND_MESSAGE_EVENTS)
+      self.assertEqual(self.db_session.query(Message).count(), 1)
+      # The room is gone by the time the message is delivered.
+      self.backend.base.remove_room("room_id1")
+      self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test@localhost")
+      self.pc.send_message.assert_called_with(
+          "prpl-jabber", "test@localhost", 123, "Test message.")
+      self.assertEqual(self.db_session.query(Message).count(), 0)
+      # The message is delivered via the current room, the one that was left is not tracked.
+      self.assertNotIn("room_id1", self.backend.base.rooms)
+      self.assertIn("@xmpp-test2:localhost", self.backend.base.rooms["room_id2"].members)
+
   def test_route_to_purple_message_client_exception(self):
     self.create_account()
     self.pc.create_conversation.return_value = 123
@@ -317,7 +504,38 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       args = self.glib.timeout_add_seconds.call_args[0]
       self.assertEqual(args[0], 1)
       self.assertEqual(self.db_session.query(Message).count(), 1)
-      self.assertEqual(self.backend.messages.offline_delivery_to_clients_cb, 1)
+      self.assertEqual(
+          list(self.backend.messages.delivery_to_clients_retries.cbs.values()), [1])
+
+  def test_route_to_purple_message_delivery_backoff(self):
+    self.create_account()
+    self.conf["offline_messages_max_delivery_interval"] = 4
+    self.pc.send_message.return_value = False
+    self.glib.timeout_add_seconds.return_value = 1
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.process_transaction(1, INVITE_AND_MESSAGE_EVENTS)
+      self.assertEqual(self.db_session.query(Message).count(), 1)
+      # Each failed retry should double the interval, up to the configured maximum.
+      intervals = []
+      for _ in range(4):
+        (interval, callback) = self.glib.timeout_add_seconds.call_args[0]
+        intervals.append(interval)
+        self.assertFalse(callback())
+      self.assertEqual(intervals, [1, 2, 4, 4])
+      # Disconnected account shouldn't be retried until it signs on again.
+      (_, callback) = self.glib.timeout_add_seconds.call_args[0]
+      self.backend.base.dispatch_callbacks("user-signed-off", "prpl-jabber", "test@localhost")
+      self.glib.timeout_add_seconds.reset_mock()
+      self.assertFalse(callback())
+      self.glib.timeout_add_seconds.assert_not_called()
+      self.assertEqual(self.backend.messages.delivery_to_clients_retries.cbs, {})
+      # Sign on should restart retries from the shortest interval.
+      self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test@localhost")
+      # Contacts presences republished right after going offline are debounced meanwhile.
+      self.glib.timeout_add_seconds.assert_any_call(1, ANY)
+      self.assertEqual(self.db_session.query(Message).count(), 1)
 
   def test_route_to_purple_message_without_account_no_room(self):
     self.backend = self.create_backend()
@@ -329,7 +547,7 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       self.backend.process_transaction(1, MESSAGE_EVENTS)
       self.send_signon_callbacks()
       with self.assertLogs(level=logging.DEBUG) as log_cm:
-        self.backend.messages.on_attempt_delivery_to_clients()
+        attempt_deliveries_to_clients(self.backend.messages)
         self.assertIn("skipping delivery", log_cm.output[0])
         self.assertEqual(self.db_session.query(Message).count(), 1)
       # Join the room and attempt delivery, but send_message will return False -
@@ -337,13 +555,13 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       self.pc.send_message.return_value = False
       self.backend.process_transaction(2, INVITE_EVENTS)
       with self.assertLogs(level=logging.DEBUG) as log_cm:
-        self.backend.messages.on_attempt_delivery_to_clients()
+        attempt_deliveries_to_clients(self.backend.messages)
         self.assertIn("Delivery failed", log_cm.output[1])
       self.assertEqual(self.db_session.query(Message).count(), 1)
       # Retry, but send_message will return True -
       # should be successful now.
       self.pc.send_message.return_value = True
-      self.backend.messages.on_attempt_delivery_to_clients()
+      attempt_deliveries_to_clients(self.backend.messages)
       self.pc.create_conversation.assert_called_with(
           "prpl-jabber", "test@localhost", "test2@localhost")
       self.pc.send_message.assert_called_with(
@@ -394,6 +612,123 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       self.assertEqual(self.db_session.query(Message).count(), 0)
       self.assertEqual(self.backend.messages.offline_delivery_to_matrix_cb, None)
 
+  def test_route_to_matrix_messages_offline_paged(self):
+    self.create_account()
+    self.conf["offline_messages_page_size"] = 2
+    self.mc.send_message.return_value = False
+    self.mc.create_room.return_value = "room_id0"
+    self.glib.timeout_add_seconds.return_value = 1
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      for i in range(5):
+        self.backend.base.dispatch_callbacks(
+            "new-message", "prpl-jabber", "test@localhost", 123,
+            "test2@localhost", "recv", "Test message {0}.".format(i), dt)
+      self.assertEqual(self.db_session.query(Message).count(), 5)
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 5)
+    self.mc.reset_mock()
+    # Let Matrix accept only the first three messages.
+    self.mc.send_message.side_effect = [True] * 3 + [False] * 10
+    with self.backend:
+      self.assertEqual(
+          [c[0][3]["body"] for c in self.mc.send_message.call_args_list],
+          ["Test message {0}.".format(i) for i in range(4)])
+      self.assertEqual(self.db_session.query(Message).count(), 2)
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 2)
+      self.mc.send_message.side_effect = None
+      self.mc.send_message.return_value = True
+      self.backend.messages.on_attempt_delivery_to_matrix()
+      self.assertEqual(self.db_session.query(Message).count(), 0)
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 0)
+      self.assertEqual(self.backend.messages.offline_delivery_to_matrix_cb, None)
+
+  def test_route_to_matrix_message_offline_journal(self):
+    self.create_account()
+    journal_path = tempfile.mkdtemp(prefix="pumaduct-queue-")
+    self.addCleanup(shutil.rmtree, journal_path)
+    self.conf["offline_queue_backend"] = "journal"
+    self.conf["offline_queue_journal_path"] = journal_path
+    self.mc.send_message.return_value = False
+    self.mc.create_room.return_value = "room_id0"
+    self.glib.timeout_add_seconds.return_value = 1
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "recv", "Test message.", dt)
+      self.assertEqual(self.db_session.query(Message).count(), 0)
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 1)
+    # The message should be replayed from the journal on restart and delivered.
+    self.mc.reset_mock()
+    self.mc.send_message.return_value = True
+    self.backend = self.create_backend()
+    with self.backend:
+      self.mc.send_message.assert_called_with(
+          "room_id0", "@xmpp-test2:localhost",
+          dt, {"msgtype": "m.text", "body": "Test message."})
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 0)
+      self.assertEqual(self.backend.messages.offline_delivery_to_matrix_cb, None)
+
+  def test_route_to_matrix_messages_offline_shared(self):
+    self.create_account()
+    self.conf["offline_queue_claim_lease"] = 60
+    self.conf["offline_queue_worker_id"] = "worker1"
+    self.mc.create_room.return_value = "room_id0"
+    self.mc.send_message.return_value = True
+    self.glib.timeout_add_seconds.return_value = 1
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 0)
+      # Another instance queues the message, which is noticed on the next re-count.
+      self.db_session.add(Message(
+          network="prpl-jabber", ext_user="test@localhost", room_id="room_id0",
+          sender="@xmpp-test2:localhost", recipient="@test:localhost", time=dt,
+          destination="matrix", payload=json.dumps({"msgtype": "m.text", "body": "Test"})))
+      self.db_session.commit()
+      self.glib.timeout_add_seconds.assert_any_call(
+          1, self.backend.messages.on_count_queue_depths)
+      self.assertTrue(self.backend.messages.on_count_queue_depths())
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 1)
+      self.assertEqual(self.backend.messages.offline_delivery_to_matrix_cb, 1)
+      self.backend.messages.on_attempt_delivery_to_matrix()
+      self.assertEqual(self.db_session.query(Message).count(), 0)
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 0)
+
+  def test_offline_messages_expiry(self):
+    self.create_account()
+    self.conf["offline_messages_to_clients_ttl"] = 3600
+    self.conf["offline_messages_to_matrix_ttl"] = 7200
+    self.conf["offline_messages_expiry_batch_size"] = 1
+    now = datetime.utcnow()
+    for (destination, age) in (
+        ("client", 3000), ("client", 4000), ("client", 5000),
+        ("matrix", 4000), ("matrix", 8000)):
+      self.db_session.add(Message(
+          network="prpl-jabber", ext_user="test@localhost", room_id="room_id1",
+          sender="@test:localhost", recipient="@xmpp-test2:localhost",
+          time=now - timedelta(seconds=age), destination=destination, payload="{}"))
+    self.db_session.commit()
+    self.mc.send_message.return_value = False
+    self.backend = self.create_backend()
+    with self.backend:
+      account = self.backend.base.accounts["@test:localhost"][0]
+      self.assertEqual(self.backend.messages.count_messages_to_client(
+          "@test:localhost", account), 3)
+      self.assertTrue(self.backend.messages.on_expire_offline_messages())
+      self.assertEqual(self.backend.messages.count_messages_to_client(
+          "@test:localhost", account), 1)
+      self.assertEqual(self.backend.messages.matrix_queue_depth, 1)
+      remaining = sorted(
+          (message.destination, (now - message.time).total_seconds())
+          for message in self.db_session.query(Message))
+      self.assertEqual(remaining, [("client", 3000), ("matrix", 4000)])
+
   def test_route_purple_message_sent(self):
     self.create_account()
     self.mc.create_room.return_value = "room_id1"
@@ -414,6 +749,56 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       # sending it via libpurple as it was delivered from libpurple.
       self.pc.send_message.assert_not_called()
 
+  def test_route_purple_message_sent_echo_after_restart(self):
+    self.create_account()
+    self.mc.create_room.return_value = "room_id1"
+    self.mc.send_message.return_value = "event_id0"
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "sent", "Test message.", dt)
+      self.assertEqual(self.db_session.query(SentEvent).count(), 1)
+    # Echo arrives only after the restart - it should still be recognized.
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.assertIn("event_id0", self.backend.messages.sent_ids)
+      self.backend.process_transaction(1, SENT_MESSAGE_EVENTS)
+      self.pc.send_message.assert_not_called()
+      self.assertEqual(self.db_session.query(SentEvent).count(), 0)
+      self.assertNotIn("event_id0", self.backend.messages.sent_ids)
+
+  def test_sent_events_expiry(self):
+    self.backend = self.create_backend()
+    self.db_session.add(SentEvent(event_id="event_id0", time=datetime(1970, 1, 1)))
+    self.db_session.commit()
+    with self.backend:
+      # Expired event IDs should not be restored on start.
+      self.assertNotIn("event_id0", self.backend.messages.sent_ids)
+      self.assertEqual(self.db_session.query(SentEvent).count(), 0)
+      self.backend.messages.sent_ids.add("event_id1")
+      self.assertTrue(self.backend.messages.on_expire_sent_ids())
+      self.assertIn("event_id1", self.backend.messages.sent_ids)
+      self.assertEqual(self.db_session.query(SentEvent).count(), 1)
+
+  def test_sent_events_restored_expiry(self):
+    self.backend = self.create_backend()
+    ttl = self.backend.messages.sent_ids.ttl
+    self.db_session.add(SentEvent(
+        event_id="event_id0", time=datetime.utcnow() - timedelta(seconds=ttl - 60)))
+    self.db_session.commit()
+    with self.backend:
+      sent_ids = self.backend.messages.sent_ids
+      self.assertIn("event_id0", sent_ids)
+      sent_ids.add("event_id1")
+      # Restored event IDs keep the time they were stored at, rather than getting a fresh TTL.
+      sent_ids.recent.expire(time.monotonic() + 120)
+      self.assertNotIn("event_id0", sent_ids)
+      self.assertIn("event_id1", sent_ids)
+
   def test_messages_errors(self):
     self.create_account()
     self.backend = self.create_backend()
@@ -428,35 +813,41 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
     self.create_account()
     self.mc.create_room.return_value = "room_id0"
     dt = datetime(1970, 1, 1, 3, 25, 45)
-    self.mc.upload_content.return_value = "test-url"
+    uploads = []
+    self.mc.upload_content.side_effect = reading(uploads, "test-url")
     self.backend = self.create_backend()
     with self.backend:
       self.send_signon_callbacks()
       self.backend.base.dispatch_callbacks(
           "new-image", "prpl-jabber", "test@localhost", 123,
           "test2@localhost", "recv", "Test image", IMAGE_DATA, dt)
-      self.mc.upload_content.assert_called_with("image/gif", IMAGE_DATA)
+      self.assertEqual(uploads[-1], ("image/gif", IMAGE_DATA))
+      # The content is streamed from the temporary file, which is not spooled after the upload.
+      self.assertEqual(self.backend.messages.media_spool.blob_ids(), set())
+      self.assertEqual(os.listdir(self.backend.messages.media_spool.temp_path), [])
       self.mc.create_room.assert_called_with("@xmpp-test2:localhost", ["@test:localhost"])
       self.mc.send_message.assert_called_with(
           "room_id0", "@xmpp-test2:localhost",
-          dt, {"msgtype": "m.image", "body": "Test image", "url": "test-url"})
+          dt, {"msgtype": "m.image", "body": "Test image", "url": "test-url", "info": IMAGE_INFO})
 
   def test_route_purple_file(self):
     self.create_account()
     self.mc.create_room.return_value = "room_id0"
     dt = datetime(1970, 1, 1, 3, 25, 45)
-    self.mc.upload_content.return_value = "test-url"
+    uploads = []
+    self.mc.upload_content.side_effect = reading(uploads, "test-url")
     self.backend = self.create_backend()
     with self.backend:
       self.send_signon_callbacks()
       self.backend.base.dispatch_callbacks(
           "new-file", "prpl-jabber", "test@localhost", 123,
           "test2@localhost", "recv", "Test file", FILE_DATA, dt)
-      self.mc.upload_content.assert_called_with("application/octet-stream", FILE_DATA)
+      self.assertEqual(uploads[-1], ("application/octet-stream", FILE_DATA))
       self.mc.create_room.assert_called_with("@xmpp-test2:localhost", ["@test:localhost"])
       self.mc.send_message.assert_called_with(
           "room_id0", "@xmpp-test2:localhost",
-          dt, {"msgtype": "m.file", "body": "Test file", "url": "test-url"})
+          dt, {"msgtype": "m.file", "body": "Test file", "url": "test-url",
+               "info": {"mimetype": "application/octet-stream", "size": len(FILE_DATA)}})
 
   def test_route_purple_image_offline(self):
     self.create_account()
@@ -469,19 +860,97 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
       self.backend.base.dispatch_callbacks(
           "new-image", "prpl-jabber", "test@localhost", 123,
           "test2@localhost", "recv", "Test image", IMAGE_DATA, dt)
-      # upload_content failed, the image should be stored offline.
+      # upload_content failed, the image should be stored offline in the media spool.
       self.mc.send_message.assert_not_called()
-      self.assertEqual(self.db_session.query(Message).count(), 1)
+      message = self.db_session.query(Message).one()
+      self.assertEqual(message.payload, "")
+      self.assertNotIn("content", PayloadCodec().decode(message.payload_data))
+      self.assertEqual(self.backend.messages.media_spool.blob_ids(), set([message.blob_id]))
+      self.assertEqual(os.listdir(self.backend.messages.media_spool.temp_path), [])
       # Attempt redelivery - should still fail and the image should be kept offline.
       self.backend.messages.on_attempt_delivery_to_matrix()
       self.mc.send_message.assert_not_called()
       self.assertEqual(self.db_session.query(Message).count(), 1)
-      # Allow upload_content to succeed and attempt re-delivery - should be fine now.
-      self.mc.upload_content.return_value = "test-url"
+      # Allow upload_content to succeed and attempt re-delivery - should be fine now,
+      # with the image streamed from the media spool.
+      uploads = []
+      def upload_content(content_type, data):
+        uploads.append((content_type, data.read()))
+        return "test-url"
+      self.mc.upload_content.side_effect = upload_content
       self.backend.messages.on_attempt_delivery_to_matrix()
       self.assertEqual(self.db_session.query(Message).count(), 0)
-      self.mc.upload_content.assert_called_with("image/gif", IMAGE_DATA)
+      self.assertEqual(uploads, [("image/gif", IMAGE_DATA)])
+      self.assertEqual(self.backend.messages.media_spool.blob_ids(), set())
       self.mc.create_room.assert_called_with("@xmpp-test2:localhost", ["@test:localhost"])
+      self.mc.send_message.assert_called_with(
+          "room_id0", "@xmpp-test2:localhost",
+          dt, {"msgtype": "m.image", "body": "Test image", "url": "test-url", "info": IMAGE_INFO})
+
+  def test_route_purple_image_offline_missing_blob(self):
+    self.create_account()
+    self.mc.create_room.return_value = "room_id0"
+    self.mc.upload_content.return_value = None
+    self.mc.send_message.return_value = None
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.base.dispatch_callbacks(
+          "new-image", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "recv", "Test image", IMAGE_DATA, datetime(1970, 1, 1))
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "recv", "Test message.", datetime(1970, 1, 1))
+      self.assertEqual(self.db_session.query(Message).count(), 2)
+      message = self.db_session.query(Message).filter(Message.blob_id.isnot(None)).one()
+      self.backend.messages.media_spool.remove(message.blob_id)
+      # The message with the missing media is dropped, the next one is still delivered.
+      self.mc.upload_content.return_value = "test-url"
+      self.mc.send_message.return_value = "event_id0"
+      with self.assertLogs() as log_cm:
+        self.backend.messages.on_attempt_delivery_to_matrix()
+        self.assertIn("is missing from the media spool", log_cm.output[0])
+      self.assertEqual(self.db_session.query(Message).count(), 0)
+      self.assertEqual(self.mc.send_message.call_args[0][3]["body"], "Test message.")
+
+  def test_route_to_matrix_message_offline_undecodable(self):
+    self.create_account()
+    self.mc.create_room.return_value = "room_id0"
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    for (payload_data, body) in ((b"\xff\x00\x00", "Broken."), (None, "Test message.")):
+      self.db_session.add(Message(
+          network="prpl-jabber", ext_user="test@localhost", room_id="room_id0",
+          sender="@xmpp-test2:localhost", recipient="@test:localhost", time=dt,
+          destination="matrix", payload_data=payload_data,
+          payload=json.dumps({"msgtype": "m.text", "body": body})))
+    self.db_session.commit()
+    self.backend = self.create_backend()
+    with self.assertLogs("pumaduct.message_queue", level="ERROR"):
+      with self.backend:
+        # The message that cannot be decoded is dropped, not blocking the rest of the queue.
+        self.assertEqual(self.db_session.query(Message).count(), 0)
+        self.mc.send_message.assert_called_once_with(
+            "room_id0", "@xmpp-test2:localhost",
+            dt, {"msgtype": "m.text", "body": "Test message."})
+        self.assertEqual(self.backend.messages.matrix_queue_depth, 0)
+
+  def test_route_purple_image_offline_inline_content(self):
+    # Messages stored before the media spool was introduced have the content inline.
+    self.create_account()
+    self.mc.create_room.return_value = "room_id0"
+    self.mc.upload_content.return_value = "test-url"
+    dt = datetime(1970, 1, 1, 3, 25, 45)
+    self.db_session.add(Message(
+        network="prpl-jabber", ext_user="test@localhost", room_id="room_id0",
+        sender="@xmpp-test2:localhost", recipient="@test:localhost", time=dt,
+        destination="matrix", payload=json.dumps({
+            "msgtype": "m.image", "body": "Test image", "content-type": "image/gif",
+            "content": base64.b64encode(IMAGE_DATA).decode("ascii")})))
+    self.db_session.commit()
+    self.backend = self.create_backend()
+    with self.backend:
+      self.assertEqual(self.db_session.query(Message).count(), 0)
+      self.mc.upload_content.assert_called_with("image/gif", IMAGE_DATA)
       self.mc.send_message.assert_called_with(
           "room_id0", "@xmpp-test2:localhost",
           dt, {"msgtype": "m.image", "body": "Test image", "url": "test-url"})
@@ -489,57 +958,91 @@ class MessagesLayerTest(LayerTestCommon): # pylint: disable=too-many-public-meth
   def test_route_matrix_image(self):
     self.create_account()
     self.pc.create_conversation.return_value = 123
-    self.mc.download_content.return_value = IMAGE_DATA
+    self.mc.download_content.side_effect = downloading(IMAGE_DATA)
+    sent = []
+    self.pc.send_image.side_effect = reading(sent, True)
     self.backend = self.create_backend()
     with self.backend:
       self.send_signon_callbacks()
       self.backend.process_transaction(1, INVITE_EVENTS)
       self.backend.process_transaction(1, IMAGE_EVENTS)
-      self.mc.download_content.assert_called_with("localhost", "/image-url")
+      self.assertEqual(self.mc.download_content.call_args[0][:2], ("localhost", "/image-url"))
       self.pc.create_conversation.assert_called_with(
           "prpl-jabber", "test@localhost", "test2@localhost")
-      self.pc.send_image.assert_called_with(
-          "prpl-jabber", "test@localhost", 123, "Test image", IMAGE_DATA)
+      self.assertEqual(sent, [("prpl-jabber", "test@localhost", 123, "Test image", IMAGE_DATA)])
+      # The downloaded media should be released once sent.
+      self.assertEqual(os.listdir(self.backend.messages.media_transfers.downloads_path), [])
+      self.assertEqual(self.backend.messages.media_transfers.usage, 0)
+
+  def test_route_matrix_image_thumbnail(self):
+    # The network limits the size of images, so the thumbnail is sent instead.
+    self.conf["networks"]["prpl-jabber"]["max_image_size"] = 10
+    self.conf["networks"]["prpl-jabber"]["image_thumbnail_size"] = [64, 48]
+    self.create_account()
+    self.pc.create_conversation.return_value = 123
+    self.mc.download_thumbnail.side_effect = downloading(b"thumbnail")
+    sent = []
+    self.pc.send_image.side_effect = reading(sent, True)
+    events = copy.deepcopy(IMAGE_EVENTS)
+    events["events"][0]["content"]["info"] = {"size": 20, "mimetype": "image/gif"}
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.process_transaction(1, INVITE_EVENTS)
+      self.backend.process_transaction(1, events)
+      self.assertEqual(
+          self.mc.download_thumbnail.call_args[0][:4], ("localhost", "/image-url", 64, 48))
+      self.mc.download_content.assert_not_called()
+      self.assertEqual(sent, [("prpl-jabber", "test@localhost", 123, "Test image", b"thumbnail")])
+      # Images fitting into the limit are sent as is.
+      self.mc.download_content.side_effect = downloading(IMAGE_DATA)
+      events["events"][0]["content"]["info"]["size"] = 5
+      events["events"][0]["event_id"] = "event_id2"
+      self.backend.process_transaction(2, events)
+      self.assertEqual(sent[-1], ("prpl-jabber", "test@localhost", 123, "Test image", IMAGE_DATA))
+      self.assertEqual(self.mc.download_thumbnail.call_count, 1)
 
   def test_route_matrix_file(self):
     self.create_account()
     self.pc.create_conversation.return_value = 123
-    self.mc.download_content.return_value = FILE_DATA
+    self.mc.download_content.side_effect = downloading(FILE_DATA)
+    sent = []
+    self.pc.send_file.side_effect = reading(sent, True)
     self.backend = self.create_backend()
     with self.backend:
       self.send_signon_callbacks()
       self.backend.process_transaction(1, INVITE_EVENTS)
       self.backend.process_transaction(1, FILE_EVENTS)
-      self.mc.download_content.assert_called_with("localhost", "/file-url")
+      self.assertEqual(self.mc.download_content.call_args[0][:2], ("localhost", "/file-url"))
       self.pc.create_conversation.assert_called_with(
           "prpl-jabber", "test@localhost", "test2@localhost")
-      self.pc.send_file.assert_called_with(
-          "prpl-jabber", "test@localhost", 123, "Test file", FILE_DATA)
+      self.assertEqual(sent, [("prpl-jabber", "test@localhost", 123, "Test file", FILE_DATA)])
 
   def test_route_matrix_image_offline(self):
     self.create_account()
     self.pc.create_conversation.return_value = 123
-    self.mc.download_content.return_value = None
+    self.mc.download_content.side_effect = downloading(None)
+    sent = []
+    self.pc.send_image.side_effect = reading(sent, False)
     self.backend = self.create_backend()
     with self.backend:
       self.send_signon_callbacks()
       self.backend.process_transaction(1, INVITE_EVENTS)
       self.backend.process_transaction(1, IMAGE_EVENTS)
       # download_content failed - the image should be stored offline.
-      self.mc.download_content.assert_called_with("localhost", "/image-url")
+      self.assertEqual(self.mc.download_content.call_args[0][:2], ("localhost", "/image-url"))
       self.pc.send_image.assert_not_called()
       self.assertEqual(self.db_session.query(Message).count(), 1)
       # download_content will succeed, but now send_image will fail - the image
       # should still be kept offline.
-      self.mc.download_content.return_value = IMAGE_DATA
-      self.pc.send_image.return_value = False
-      self.backend.messages.on_attempt_delivery_to_clients()
+      self.mc.download_content.side_effect = downloading(IMAGE_DATA)
+      attempt_deliveries_to_clients(self.backend.messages)
       self.pc.create_conversation.assert_called_with(
           "prpl-jabber", "test@localhost", "test2@localhost")
       self.assertEqual(self.db_session.query(Message).count(), 1)
       # Finally, send_image will return True - everything should be OK now.
-      self.pc.send_image.return_value = True
-      self.backend.messages.on_attempt_delivery_to_clients()
-      self.pc.send_image.assert_called_with(
-          "prpl-jabber", "test@localhost", 123, "Test image", IMAGE_DATA)
+      self.pc.send_image.side_effect = reading(sent, True)
+      attempt_deliveries_to_clients(self.backend.messages)
+      self.assertEqual(sent[-1], ("prpl-jabber", "test@localhost", 123, "Test image", IMAGE_DATA))
       self.assertEqual(self.db_session.query(Message).count(), 0)
+      self.assertEqual(os.listdir(self.backend.messages.media_transfers.downloads_path), [])
@@ -19,7 +19,10 @@
 
 """Tests PresenceLayer functionality."""
 
+from unittest.mock import call, patch
+
 from pumaduct.layers.tests.common import LayerTestCommon
+from pumaduct.storage import Account
 
 # pylint: disable=duplicate-code
 
@@ -33,6 +36,27 @@ PRESENCE_EVENTS = {
     }]
 }
 
+EPHEMERAL_PRESENCE_EVENTS = {
+    "events": [],
+    "ephemeral": [{
+        "sender": "@test:localhost",
+        "type": "m.presence",
+        "content": {"presence": "unavailable"}
+    }]
+}
+
+INVITE_EVENTS = {
+    "events": [{
+        "sender": "@test:localhost",
+        "event_id": "event_id1",
+        "origin_server_ts": 12345000,
+        "type": "m.room.member",
+        "content": {"membership": "invite"},
+        "state_key": "@xmpp-test2:localhost",
+        "room_id": "room_id1"
+    }]
+}
+
 class PresenceLayerTest(LayerTestCommon):
   """Tests PresenceLayer functionality."""
 
@@ -45,10 +69,44 @@ class PresenceLayerTest(LayerTestCommon):
           "contact-status-changed", "prpl-jabber", "test@localhost",
           "test2@localhost", "online")
       self.mc.set_user_presence.assert_called_with("@xmpp-test2:localhost", "online")
+      # Repeated statuses are not published.
+      self.mc.reset_mock()
       self.backend.base.dispatch_callbacks(
           "contact-status-changed", "prpl-jabber", "test@localhost",
-          "test2@localhost", "unavailable")
-      self.mc.set_user_presence.assert_called_with("@xmpp-test2:localhost", "unavailable")
+          "test2@localhost", "online")
+      self.mc.set_user_presence.assert_not_called()
+      # Changes shortly after the publication are debounced.
+      for status in ("unavailable", "online", "unavailable"):
+        self.backend.base.dispatch_callbacks(
+            "contact-status-changed", "prpl-jabber", "test@localhost",
+            "test2@localhost", status)
+      self.mc.set_user_presence.assert_not_called()
+      self.glib.timeout_add_seconds.assert_called_with(
+          5, self.backend.presence.on_publish_pending_presences)
+      self.backend.presence.on_publish_pending_presences()
+      self.mc.set_user_presence.assert_called_once_with("@xmpp-test2:localhost", "unavailable")
+
+  def test_published_presence_dropped_with_ghost(self):
+    self.create_account()
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.base.dispatch_callbacks(
+          "contact-status-changed", "prpl-jabber", "test@localhost",
+          "test2@localhost", "online")
+      self.assertEqual(
+          self.backend.base.ghosts["@xmpp-test2:localhost"].presence[0], "online")
+      account = self.backend.base.accounts["@test:localhost"][0]
+      self.backend.base.remove_contacts(account)
+      self.assertNotIn("@xmpp-test2:localhost", self.backend.base.ghosts)
+      # Nothing is remembered about the dropped contact, so it's published again once back.
+      self.mc.reset_mock()
+      self.backend.base.dispatch_callbacks(
+          "contact-updated", "prpl-jabber", "test@localhost", "test2@localhost", "Test2")
+      self.backend.base.dispatch_callbacks(
+          "contact-status-changed", "prpl-jabber", "test@localhost",
+          "test2@localhost", "online")
+      self.mc.set_user_presence.assert_called_once_with("@xmpp-test2:localhost", "online")
 
   def test_presence_refresh(self):
     self.create_account()
@@ -65,6 +123,124 @@ class PresenceLayerTest(LayerTestCommon):
       self.mc.set_user_presence.assert_any_call("@xmpp-test2:localhost", "online")
       self.mc.set_user_presence.assert_any_call("@pumaduct:localhost", "online")
 
+  @patch("pumaduct.layers.presence.time.monotonic")
+  def test_presence_refresh_spread(self, monotonic):
+    monotonic.return_value = 100
+    self.create_account()
+    self.conf["presence_refresh_interval"] = 4
+    self.conf["presence_refresh_tick_interval"] = 2
+    self.pc.get_contact_status.return_value = "online"
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      for contact in ("test3@localhost", "test4@localhost", "test5@localhost"):
+        self.backend.base.dispatch_callbacks(
+            "contact-updated", "prpl-jabber", "test@localhost", contact, contact)
+      self.glib.timeout_add_seconds.assert_any_call(2, self.backend.presence.on_presence_refresh)
+      # Every tick refreshes its share of the contacts, all of them per interval.
+      for refreshed in (2, 4, 6):
+        self.backend.presence.on_presence_refresh()
+        self.assertEqual(self.pc.get_contact_status.call_count, refreshed)
+        monotonic.return_value += 2
+      self.assertEqual(
+          self.mc.set_user_presence.call_args_list.count(
+              call("@pumaduct:localhost", "online")), 3)
+
+  @patch("pumaduct.layers.presence.time.monotonic")
+  def test_presence_refresh_few_contacts(self, monotonic):
+    monotonic.return_value = 100
+    self.create_account()
+    self.conf["presence_refresh_interval"] = 4
+    self.conf["presence_refresh_tick_interval"] = 1
+    self.pc.get_contact_status.return_value = "online"
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.pc.reset_mock()
+      self.mc.reset_mock()
+      # The only contact is refreshed on the first tick, the rest of the interval is idle.
+      for _ in range(4):
+        self.assertTrue(self.backend.presence.on_presence_refresh())
+        monotonic.return_value += 1
+      self.pc.get_contact_status.assert_called_once()
+      self.assertEqual(self.mc.set_user_presence.call_args_list, [
+          call("@pumaduct:localhost", "online"), call("@xmpp-test2:localhost", "online")])
+      self.backend.presence.on_presence_refresh()
+      self.assertEqual(self.pc.get_contact_status.call_count, 2)
+
+  @patch("pumaduct.layers.presence.time.monotonic")
+  def test_presence_refresh_no_contacts(self, monotonic):
+    monotonic.return_value = 100
+    self.conf["presence_refresh_interval"] = 4
+    self.conf["presence_refresh_tick_interval"] = 1
+    self.backend = self.create_backend()
+    with self.backend:
+      self.mc.reset_mock()
+      # The service presence is still refreshed, but only once per interval.
+      for _ in range(8):
+        self.backend.presence.on_presence_refresh()
+        monotonic.return_value += 1
+      self.assertEqual(self.mc.set_user_presence.call_args_list, [
+          call("@pumaduct:localhost", "online")] * 2)
+
+  def test_presence_interest_only(self):
+    self.create_account()
+    self.conf["presence_interest_only"] = True
+    self.pc.get_contact_status.return_value = "online"
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.mc.reset_mock()
+      # No room has the contact, so its presence is not published.
+      self.backend.base.dispatch_callbacks(
+          "contact-status-changed", "prpl-jabber", "test@localhost",
+          "test2@localhost", "unavailable")
+      self.backend.presence.on_presence_refresh()
+      self.pc.get_contact_status.assert_not_called()
+      self.mc.set_user_presence.assert_called_once_with("@pumaduct:localhost", "online")
+      # Once the room appears, the presence is published and then kept up to date.
+      self.backend.process_transaction(1, INVITE_EVENTS)
+      self.mc.set_user_presence.assert_called_with("@xmpp-test2:localhost", "online")
+      self.backend.base.remove_room("room_id1")
+      self.backend.base.dispatch_callbacks("user-signed-off", "prpl-jabber", "test@localhost")
+      self.backend.presence.on_publish_pending_presences()
+      self.mc.set_user_presence.assert_called_with("@xmpp-test2:localhost", "offline")
+
+  def test_shared_contact_presence(self):
+    self.create_account()
+    self.db_session.add(Account(
+        user="@test3:localhost", network="prpl-jabber",
+        ext_user="test3@localhost", password="password"))
+    self.db_session.commit()
+    self.conf["presence_debounce_interval"] = 0
+    self.conf["presence_offline_grace_period"] = 0
+    self.pc.get_contact_status.return_value = "online"
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.base.dispatch_callbacks("user-signed-on", "prpl-jabber", "test3@localhost")
+      self.backend.base.dispatch_callbacks(
+          "contact-updated", "prpl-jabber", "test3@localhost", "test2@localhost", "Test2")
+      self.backend.base.dispatch_callbacks(
+          "contact-status-changed", "prpl-jabber", "test3@localhost",
+          "test2@localhost", "online")
+      self.pc.reset_mock()
+      self.mc.reset_mock()
+      # The contact is refreshed once, whichever account has it.
+      self.backend.presence.on_presence_refresh()
+      self.pc.get_contact_status.assert_called_once()
+      self.mc.set_user_presence.assert_any_call("@xmpp-test2:localhost", "online")
+      # The contact is still online for the other account.
+      self.mc.reset_mock()
+      self.backend.base.dispatch_callbacks(
+          "connection-error", "prpl-jabber", "test@localhost",
+          "test reason", "test description")
+      self.mc.set_user_presence.assert_not_called()
+      self.backend.base.dispatch_callbacks(
+          "contact-status-changed", "prpl-jabber", "test3@localhost",
+          "test2@localhost", "offline")
+      self.mc.set_user_presence.assert_called_once_with("@xmpp-test2:localhost", "offline")
+
   def test_request_presence_list_on_enter(self):
     self.create_account()
     self.backend = self.create_backend()
@@ -96,12 +272,54 @@ class PresenceLayerTest(LayerTestCommon):
       self.pc.set_account_status.assert_called_with(
           "prpl-jabber", "test@localhost", "offline")
 
+  def test_ephemeral_presence(self):
+    self.create_account()
+    self.conf["receive_ephemeral_events"] = True
+    self.backend = self.create_backend()
+    with self.backend:
+      self.mc.get_presence_list.assert_not_called()
+      self.mc.add_to_presence_list.assert_not_called()
+      self.send_signon_callbacks()
+      self.pc.set_account_status.assert_not_called()
+      self.backend.process_transaction(1, EPHEMERAL_PRESENCE_EVENTS)
+      self.pc.set_account_status.assert_called_with(
+          "prpl-jabber", "test@localhost", "unavailable")
+      # The pushed presence is mirrored on sign on instead of polling it.
+      self.pc.reset_mock()
+      self.send_signon_callbacks()
+      self.mc.get_non_managed_user_presence.assert_not_called()
+      self.pc.set_account_status.assert_called_with(
+          "prpl-jabber", "test@localhost", "unavailable")
+
   def test_presence_on_connection_error(self):
     self.create_account()
     self.backend = self.create_backend()
     with self.backend:
       self.send_signon_callbacks()
+      self.mc.reset_mock()
       self.backend.base.dispatch_callbacks(
           "connection-error", "prpl-jabber", "test@localhost",
           "test reason", "test description")
+      self.backend.base.dispatch_callbacks(
+          "user-signed-off", "prpl-jabber", "test@localhost")
+      # Contacts are set 'offline' only once the grace period passes without reconnect.
+      self.mc.set_user_presence.assert_not_called()
+      self.glib.timeout_add_seconds.call_args[0][1]()
       self.mc.set_user_presence.assert_called_with("@xmpp-test2:localhost", "offline")
+
+  def test_presence_on_connection_flap(self):
+    self.create_account()
+    self.pc.get_contact_status.return_value = "online"
+    self.glib.timeout_add_seconds.return_value = 7
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.presence.on_presence_refresh()
+      self.mc.reset_mock()
+      self.backend.base.dispatch_callbacks(
+          "connection-error", "prpl-jabber", "test@localhost",
+          "test reason", "test description")
+      self.send_signon_callbacks()
+      # Reconnected within the grace period and nothing has changed.
+      self.glib.source_remove.assert_called_with(7)
+      self.mc.set_user_presence.assert_not_called()
@@ -100,6 +100,24 @@ class RegistrationLayerTest(LayerTestCommon):
       self.assertEqual(args[1], "@pumaduct:localhost")
       self.assertIn("Successfully registered @test:localhost", args[3]["body"])
 
+  def test_registration_failure_account_not_stored(self):
+    self.backend = self.create_backend()
+    with self.backend:
+      self.backend.process_transaction(1, REGISTRATION_EVENTS)
+      # Account with the same external user appears meanwhile, so storing fails.
+      self.db_session.add(Account(
+          user="@test3:localhost", network="prpl-jabber",
+          ext_user="test@localhost", password="password"))
+      self.db_session.commit()
+      with self.assertLogs():
+        self.backend.base.dispatch_callbacks(
+            "user-signed-on", "prpl-jabber", "test@localhost")
+      self.assertNotIn("@test:localhost", self.backend.base.accounts)
+      self.pc.logout.assert_called_with("prpl-jabber", "test@localhost")
+      args = self.mc.send_message.call_args[0]
+      self.assertEqual(args[0], "room_id0")
+      self.assertIn("cannot store the account", args[3]["body"])
+
   def test_registration_failure_invalid_username(self):
     self.backend = self.create_backend()
     with self.backend:
@@ -212,11 +230,15 @@ class RegistrationLayerTest(LayerTestCommon):
     self.create_account()
     self.backend = self.create_backend()
     with self.backend:
-      self.backend.messages.pending_deliveries_to_clients = set(
-          [("@test:localhost", self.backend.base.accounts["@test:localhost"][0])])
+      key = ("@test:localhost", self.backend.base.accounts["@test:localhost"][0])
+      self.backend.messages.pending_deliveries_to_clients = set([key])
+      self.backend.messages.delivery_to_clients_retries.intervals[key] = 4
       self.backend.process_transaction(1, UNREGISTRATION_EVENTS)
       accounts = self.db_session.query(Account).all()
       self.assertEqual(len(accounts), 0)
+      # Retries state of the removed account is forgotten.
+      self.assertEqual(self.backend.messages.pending_deliveries_to_clients, set())
+      self.assertEqual(self.backend.messages.delivery_to_clients_retries.intervals, {})
       args = self.mc.send_message.call_args[0]
       self.assertEqual(args[0], "room_id0")
       self.assertEqual(args[1], "@pumaduct:localhost")
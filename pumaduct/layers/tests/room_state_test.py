@@ -151,8 +151,10 @@ class RoomStateLayerTest(LayerTestCommon):
           self.backend.base.rooms["room_id1"].members,
           set(["@xmpp-test2:localhost"]))
       self.backend.process_transaction(2, LEAVE_EVENTS)
-      self.assertIn("room_id1", self.backend.base.rooms)
-      self.assertEqual(self.backend.base.rooms["room_id1"].members, set())
+      # No bridged members left - the room should not be tracked anymore.
+      self.assertNotIn("room_id1", self.backend.base.rooms)
+      # Nor restored, as it's not usable anymore.
+      self.assertNotIn("room_id1", self.backend.room_state.evicted_rooms)
 
   def test_membership_service_leave(self):
     self.create_account()
@@ -213,3 +215,40 @@ class RoomStateLayerTest(LayerTestCommon):
       self.assertEqual(
           self.backend.base.rooms["room_id1"].members,
           set(["@xmpp-test2:localhost"]))
+
+  def test_idle_room_eviction_and_restore(self):
+    self.conf["room_idle_timeout"] = 60
+    self.create_account()
+    self.glib.timeout_add_seconds.return_value = 1
+    self.pc.create_conversation.return_value = 123
+    self.mc.get_user_state.return_value = INITIAL_SYNC_CONTACT_STATE
+    self.backend = self.create_backend()
+    with self.backend:
+      self.assertEqual(self.backend.base.rooms_eviction_cb, 1)
+      self.send_signon_callbacks()
+      self.assertIn("room_id1", self.backend.base.rooms)
+      # Recently used rooms are not evicted.
+      self.backend.base.on_evict_idle_rooms()
+      self.assertIn("room_id1", self.backend.base.rooms)
+      self.backend.base.rooms["room_id1"].last_active -= 120
+      self.backend.base.on_evict_idle_rooms()
+      self.assertNotIn("room_id1", self.backend.base.rooms)
+      # The message to the evicted room should restore it from Matrix state
+      # with a single lookup of the room members.
+      self.mc.get_user_state.reset_mock()
+      self.mc.get_room_members.return_value = set(
+          ["@test:localhost", "@xmpp-test2:localhost"])
+      self.backend.process_transaction(1, {"events": [MESSAGE_EVENTS["events"][1]]})
+      self.mc.get_room_members.assert_called_once_with("room_id1", "@xmpp-test2:localhost")
+      self.mc.get_user_state.assert_not_called()
+      self.assertIn("room_id1", self.backend.base.rooms)
+      self.pc.send_message.assert_called_with(
+          "prpl-jabber", "test@localhost", 123, "Test message.")
+      # Evict again: sending from the contact should reuse the room instead of creating one.
+      self.backend.base.rooms["room_id1"].last_active -= 120
+      self.backend.base.on_evict_idle_rooms()
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "recv", "Test message.", 12345)
+      self.mc.create_room.assert_not_called()
+      self.assertIn("room_id1", self.backend.base.rooms)
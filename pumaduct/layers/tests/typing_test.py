@@ -20,6 +20,7 @@
 """Tests TypingLayer functionality."""
 
 import copy
+from unittest.mock import patch
 
 from pumaduct.layers.tests.common import LayerTestCommon
 
@@ -45,6 +46,15 @@ NOT_TYPING_EVENTS = {
     }]
 }
 
+EPHEMERAL_TYPING_EVENTS = {
+    "events": [],
+    "de.sorunome.msc2409.ephemeral": [{
+        "type": "m.typing",
+        "content": {"user_ids": ["@test:localhost"]},
+        "room_id": "room_id1"
+    }]
+}
+
 class TypingLayerTest(LayerTestCommon):
   """Tests TypingLayer functionality."""
 
@@ -58,12 +68,45 @@ class TypingLayerTest(LayerTestCommon):
           "contact-typing", "prpl-jabber", "test@localhost", 123,
           "test2@localhost", True)
       self.mc.set_user_typing.assert_called_with(
-          "@xmpp-test2:localhost", "room_id0", True)
+          "@xmpp-test2:localhost", "room_id0", True, timeout=30000)
       self.backend.base.dispatch_callbacks(
           "contact-typing", "prpl-jabber", "test@localhost", 123,
           "test2@localhost", False)
       self.mc.set_user_typing.assert_called_with(
-          "@xmpp-test2:localhost", "room_id0", False)
+          "@xmpp-test2:localhost", "room_id0", False, timeout=30000)
+
+  @patch("pumaduct.layers.typing.time.monotonic")
+  def test_typing_to_matrix_redundant(self, monotonic):
+    self.create_account()
+    self.mc.create_room.return_value = "room_id0"
+    monotonic.return_value = 100
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      # Stopping typing that was never reported is dropped.
+      self.backend.base.dispatch_callbacks(
+          "contact-typing", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", False)
+      self.mc.set_user_typing.assert_not_called()
+      for _ in range(3):
+        self.backend.base.dispatch_callbacks(
+            "contact-typing", "prpl-jabber", "test@localhost", 123,
+            "test2@localhost", True)
+      self.assertEqual(self.mc.set_user_typing.call_count, 1)
+      # Ongoing typing is refreshed once the refresh interval passes.
+      monotonic.return_value = 110
+      self.backend.base.dispatch_callbacks(
+          "contact-typing", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", True)
+      self.assertEqual(self.mc.set_user_typing.call_count, 2)
+      # Matrix server has timed the typing out, so it's re-sent right away.
+      self.backend.process_transaction(1, {
+          "events": [{
+              "type": "m.typing", "content": {"user_ids": []}, "room_id": "room_id0"}]})
+      self.backend.base.dispatch_callbacks(
+          "contact-typing", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", True)
+      self.assertEqual(self.mc.set_user_typing.call_count, 3)
 
   def test_typing_to_purple(self):
     self.create_account()
@@ -96,6 +139,18 @@ class TypingLayerTest(LayerTestCommon):
       self.backend.process_transaction(4, NOT_TYPING_EVENTS)
       self.pc.set_typing.assert_called_with("prpl-jabber", "test@localhost", 123, False)
 
+  def test_ephemeral_typing_to_purple(self):
+    self.create_account()
+    self.mc.create_room.return_value = "room_id1"
+    self.backend = self.create_backend()
+    with self.backend:
+      self.send_signon_callbacks()
+      self.backend.base.dispatch_callbacks(
+          "new-message", "prpl-jabber", "test@localhost", 123,
+          "test2@localhost", "recv", "Test message.", 12345)
+      self.backend.process_transaction(1, EPHEMERAL_TYPING_EVENTS)
+      self.pc.set_typing.assert_called_with("prpl-jabber", "test@localhost", 123, True)
+
   def test_typing_feedback_correct_state(self):
     self.create_account()
     self.mc.create_room.return_value = "room_id1"
@@ -110,6 +165,14 @@ class TypingLayerTest(LayerTestCommon):
           "new-message", "prpl-jabber", "test@localhost", 123,
           "test2@localhost", "recv", "Test message.", 12345)
       self.backend.process_transaction(1, typing_events)
-      # The user associated with the account is not present in typing user ids,
-      # hence its typing update should be 'False'.
+      # The user associated with the account is not present in typing user ids
+      # and wasn't typing before, hence no typing update should be sent.
+      self.pc.set_typing.assert_not_called()
+      self.backend.process_transaction(2, TYPING_EVENTS)
+      self.pc.set_typing.assert_called_once_with("prpl-jabber", "test@localhost", 123, True)
+      # Repeated state, e.g. due to the contact typing, is not sent again.
+      typing_events["events"][0]["content"]["user_ids"].append("@test:localhost")
+      self.backend.process_transaction(3, typing_events)
+      self.pc.set_typing.assert_called_once_with("prpl-jabber", "test@localhost", 123, True)
+      self.backend.process_transaction(4, NOT_TYPING_EVENTS)
       self.pc.set_typing.assert_called_with("prpl-jabber", "test@localhost", 123, False)
@@ -20,63 +20,127 @@
 """Routes typing notifications between clients and Matrix."""
 
 import logging
+import time
 
 from pumaduct.layers.layer_base import LayerBase
 from pumaduct.utils import query_json_path
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TYPING_TIMEOUT = 30
+DEFAULT_TYPING_REFRESH_INTERVAL = 10
+
+ORIGIN_CLIENT = "client"
+ORIGIN_MATRIX = "matrix"
+
+class TypingState(object):
+  """Typing state routed for the user in the room, kept only while the user is typing."""
+  __slots__ = ("origin", "updated")
+
+  def __init__(self, origin, updated):
+    # Which side the state came from: ORIGIN_CLIENT or ORIGIN_MATRIX.
+    self.origin = origin
+    # Monotonic time the state was last sent at.
+    self.updated = updated
+
 class TypingLayer(LayerBase):
   """Routes typing notifications between clients and Matrix."""
 
   def __init__(self, conf, base_layer):
-    del conf # Unused.
     self.base = base_layer
+    self.typing_timeout = (
+        conf["typing_timeout"] if "typing_timeout" in conf else DEFAULT_TYPING_TIMEOUT)
+    # Refreshing less often than Matrix server times typing out would make it flicker.
+    self.typing_refresh_interval = min(
+        conf["typing_refresh_interval"] if "typing_refresh_interval" in conf
+        else DEFAULT_TYPING_REFRESH_INTERVAL, self.typing_timeout)
+    # (room_id, mxid) -> TypingState, only the users currently typing are kept.
+    self.typing_states = {}
 
   def __enter__(self):
     self.base.add_clients_callback("contact-typing", self.on_contact_typing)
     self.base.add_transaction_callback("m.typing", self.on_transaction_typing)
+    self.base.add_rooms_callback("room-removed", self.on_room_removed)
 
   def __exit__(self, type_, value, traceback):
     self.base.remove_clients_callback("contact-typing", self.on_contact_typing)
     self.base.remove_transaction_callback("m.typing", self.on_transaction_typing)
+    self.base.remove_rooms_callback("room-removed", self.on_room_removed)
+    self.typing_states.clear()
 
   def on_contact_typing(self, user, account, conv_id, ext_contact, is_typing):
     """Routes typing notifications from the client to Matrix server."""
     contact = self.base.ext_contact_to_mxid(account.network, ext_contact)
     room_id = self.base.ensure_room(user, contact, conv_id)
-    self.base.matrix_client.set_user_typing(contact, room_id, is_typing)
+    now = time.monotonic()
+    if not self._is_changed(room_id, contact, is_typing, now):
+      return
+    if self.base.matrix_client.set_user_typing(
+        contact, room_id, is_typing, timeout=self.typing_timeout * 1000):
+      self._set_state(room_id, contact, is_typing, ORIGIN_CLIENT, now)
 
   def on_transaction_typing(self, transaction_id, event):
     """Routes typing notifications from Matrix server to the client."""
     del transaction_id # Unused.
     room_id = query_json_path(event, "room_id")
-    if room_id in self.base.rooms and self.base.rooms[room_id].members:
-      user = self.base.rooms[room_id].user
+    room = self.base.get_room(room_id)
+    if room and room.members:
+      user = room.user
       typing_user_ids = set(query_json_path(event, "content", "user_ids"))
+      self._expire_client_states(room_id, room, typing_user_ids)
+      is_typing = user in typing_user_ids
+      # Matrix server sends the typing state of all the users in the room on any
+      # change, including the ones caused by our own notifications from the client:
+      # these are dropped here unless the user state has changed too.
+      if not self._is_changed(room_id, user, is_typing, None):
+        return
       # Note: the implementation assumes 1:1 chat.
-      contact = next(iter(self.base.rooms[room_id].members))
+      contact = next(iter(room.members))
       account = self.base.find_account_for_contact(user, contact)
       if account:
-        conv_id = self.base.rooms[room_id].conv_id
+        conv_id = room.conv_id
         # We cannot operate without conv_id as it's required by
         # the client for sending the typing state.
         if not conv_id:
           ext_contact = self.base.mxid_to_ext_contact(account.network, contact)
           conv_id = account.client.create_conversation(
               account.network, account.ext_user, ext_contact)
-          self.base.rooms[room_id].conv_id = conv_id
+          room.conv_id = conv_id
         if conv_id:
-          # Note: we can get here via feedback loop, that is - when Matrix server
-          # receives our typing notification from the external client, it will send
-          # us the transaction and we'll end up here. We cannot distinguish it from
-          # the "genuine" update for the user and discard, though, so the best we
-          # can do is to send the correct current typing state for the user.
-          account.client.set_typing(
-              account.network, account.ext_user, conv_id, user in typing_user_ids)
+          account.client.set_typing(account.network, account.ext_user, conv_id, is_typing)
+          self._set_state(room_id, user, is_typing, ORIGIN_MATRIX, time.monotonic())
           return
       logger.info(
           "Cannot figure out conversation id or account "
           "for room '{0}', cannot set typing state", room_id)
     else:
       logger.info("Room '{0}' is unknown, cannot set typing state", room_id)
+
+  def on_room_removed(self, room_id, room, evicted):
+    """Drops typing states of the room that is no longer tracked."""
+    del room, evicted # Unused.
+    for key in [key for key in self.typing_states if key[0] == room_id]:
+      del self.typing_states[key]
+
+  def _is_changed(self, room_id, mxid, is_typing, now):
+    """Returns True if the typing state differs from the one last sent,
+    or if it's still typing and `now` is past the refresh interval."""
+    state = self.typing_states.get((room_id, mxid))
+    if not state or not is_typing:
+      # Only the users that are typing have the state.
+      return is_typing != bool(state)
+    return now is not None and now - state.updated >= self.typing_refresh_interval
+
+  def _set_state(self, room_id, mxid, is_typing, origin, now):
+    if is_typing:
+      self.typing_states[(room_id, mxid)] = TypingState(origin, now)
+    else:
+      self.typing_states.pop((room_id, mxid), None)
+
+  def _expire_client_states(self, room_id, room, typing_user_ids):
+    """Forgets the contacts typing states Matrix server has timed out, so that
+    the next typing notification from the client is sent right away."""
+    for contact in room.members:
+      state = self.typing_states.get((room_id, contact))
+      if state and state.origin == ORIGIN_CLIENT and contact not in typing_user_ids:
+        del self.typing_states[(room_id, contact)]
@@ -30,7 +30,6 @@ import signal
 import sys
 import yaml
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -40,7 +39,7 @@ from pumaduct import http_frontend
 from pumaduct import logger_format
 from pumaduct import matrix_client
 
-from pumaduct.storage import Base, Account, Message
+from pumaduct.storage import Base, Account, Message, SentEvent, create_db_engine, upgrade
 
 logger_format.setup()
 logger = logging.getLogger("pumaduct.main")
@@ -119,9 +118,10 @@ def load_logging_config(conf):
 def configure_db(conf):
   """Configures database, exits on error."""
   try:
-    engine = create_engine(conf["db_spec"])
+    engine = create_db_engine(conf)
     Base.metadata.bind = engine
     Base.metadata.create_all(engine)
+    upgrade(engine)
     return sessionmaker(bind=engine)()
   except SQLAlchemyError:
     logger.exception("DB configuration error")
@@ -154,7 +154,7 @@ def main():
   clients, mx_client = create_clients(conf)
 
   pumaduct_backend = backend.Backend(
-      conf, glib, mx_client, clients, db_session, Account, Message)
+      conf, glib, mx_client, clients, db_session, Account, Message, SentEvent)
   httpd = http_frontend.HttpFrontend(conf, pumaduct_backend)
 
   context_manager = contextlib.ExitStack()
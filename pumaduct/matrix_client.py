@@ -22,6 +22,7 @@
 from datetime import timezone
 import json
 import logging
+import os
 import urllib.parse
 import uuid
 
@@ -29,6 +30,8 @@ import requests
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 class Client(object):
   """Subset of Matrix client API enhanced with AS-specific functionality."""
 
@@ -138,11 +141,14 @@ class Client(object):
     logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
     return resp.status_code == Client.HTTP_OK
 
-  def upload_content(self, content_type, data):
-    """Uploads given content to the server and returns its resulting URL."""
+  def upload_content(self, content_type, data, timeout=None):
+    """Uploads given content to the server and returns its resulting URL.
+
+    `data` can be either bytes or binary file object, the latter is streamed."""
     upload_url = self._create_url("/_matrix/media/r0/upload")
     headers = {"Content-Type": content_type}
-    resp = requests.post(upload_url, data, headers=headers, verify=self.verify_hs_cert)
+    resp = requests.post(
+        upload_url, data, headers=headers, verify=self.verify_hs_cert, timeout=timeout)
     logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
     if resp.status_code == Client.HTTP_OK:
       result = json.loads(resp.content.decode("utf8"))
@@ -150,26 +156,38 @@ class Client(object):
         return result["content_uri"]
     logger.error(
         "Failed to upload content of content type '{0}' and size {1}: {2}",
-        content_type, len(data), resp.content)
+        content_type, len(data) if isinstance(data, bytes) else os.fstat(data.fileno()).st_size,
+        resp.content)
     return None
 
-  def download_content(self, server, media_id):
-    """Downloads content from the server given server name and URL path."""
+  def download_content(self, server, media_id, dest=None, timeout=None):
+    """Downloads content from the server given server name and URL path.
+
+    If `dest` binary file object is given, the content is streamed into it
+    and True is returned, otherwise the content is returned."""
     download_url = self._create_url(
         "/_matrix/media/r0/download/{server}{media_id}", server=server, media_id=media_id)
-    resp = requests.get(download_url, verify=self.verify_hs_cert)
-    logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
-    if resp.status_code == Client.HTTP_OK:
-      return resp.content
-    logger.error(
-        "Failed to download from '{0}' the media '{1}': {2}", server, media_id, resp.content)
-    return None
+    return self._download(download_url, server, media_id, dest, timeout)
+
+  def download_thumbnail( # pylint: disable=too-many-arguments
+      self, server, media_id, width, height, dest=None, timeout=None):
+    """Downloads the thumbnail of the content scaled down to fit into `width` x `height`.
 
-  def set_user_typing(self, user, room_id, is_typing):
-    """Sets typing state for the given AS-managed user in the given room."""
+    `dest` is handled the same way as in `download_content`."""
+    thumbnail_url = self._create_url(
+        "/_matrix/media/r0/thumbnail/{server}{media_id}", server=server, media_id=media_id)
+    thumbnail_url += "&width={0}&height={1}&method=scale".format(width, height)
+    return self._download(thumbnail_url, server, media_id, dest, timeout)
+
+  def set_user_typing(self, user, room_id, is_typing, timeout=None):
+    """Sets typing state for the given AS-managed user in the given room.
+
+    If set, `timeout` is the time in milliseconds Matrix server resets the state after."""
     typing_url = self._create_url(
         "/_matrix/client/r0/rooms/{room_id}/typing/{user_id}", room_id=room_id, user_id=user)
     payload = {"typing": is_typing}
+    if is_typing and timeout:
+      payload["timeout"] = timeout
     resp = requests.put(typing_url, json.dumps(payload), verify=self.verify_hs_cert)
     logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
     return resp.status_code == Client.HTTP_OK
@@ -211,6 +229,16 @@ class Client(object):
     logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
     return resp.status_code == Client.HTTP_OK
 
+  def get_room_members(self, room_id, user):
+    """Returns the set of users joined to the room as seen by AS-managed user or None."""
+    members_url = self._create_url(
+        "/_matrix/client/r0/rooms/{room_id}/joined_members", room_id=room_id, user_id=user)
+    resp = requests.get(members_url, verify=self.verify_hs_cert)
+    logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
+    if resp.status_code == Client.HTTP_OK:
+      return set(json.loads(resp.content.decode("utf8"))["joined"])
+    return None
+
   def get_user_state(self, user, state_filter=None, next_batch=None):
     """Performs single sync request for the given user without waiting."""
     user_state_url = self._create_url("/_matrix/client/r0/sync", user_id=user) + "&full_state=true"
@@ -247,6 +275,20 @@ class Client(object):
     logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
     return resp.status_code == Client.HTTP_OK
 
+  def _download(self, url, server, media_id, dest, timeout): # pylint: disable=too-many-arguments
+    with requests.get(
+        url, verify=self.verify_hs_cert, stream=dest is not None, timeout=timeout) as resp:
+      if resp.status_code == Client.HTTP_OK:
+        if dest is None:
+          logger.debug("Status: {0}, content: {1}", resp.status_code, resp.content)
+          return resp.content
+        for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+          dest.write(chunk)
+        return True
+      logger.error(
+          "Failed to download from '{0}' the media '{1}': {2}", server, media_id, resp.content)
+      return None
+
   def _create_url(self, url, **kwargs):
     quoted_args = {}
     for key, value in kwargs.items():
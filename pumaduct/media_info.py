@@ -0,0 +1,84 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Metadata and thumbnails of the media sent to Matrix."""
+
+import io
+import logging
+
+import magic
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THUMBNAIL_SIZE = (320, 240)
+
+# Formats that might have transparency, so their thumbnails are stored as PNG.
+TRANSPARENT_FORMATS = ("GIF", "PNG", "WEBP")
+
+class MediaInfo(object):
+  """Content type, `info` of the Matrix event and the thumbnail of the media."""
+  __slots__ = ("content_type", "info", "thumbnail", "thumbnail_info")
+
+  def __init__(self, content_type, info, thumbnail=None, thumbnail_info=None):
+    self.content_type = content_type
+    self.info = info
+    # Encoded thumbnail, if any, with its own `info`.
+    self.thumbnail = thumbnail
+    self.thumbnail_info = thumbnail_info
+
+def get_media_info(content, is_image, thumbnail_size=DEFAULT_THUMBNAIL_SIZE):
+  """Returns `MediaInfo` of the media content.
+
+  For images, dimensions and the thumbnail not larger than `thumbnail_size`
+  are only available if Pillow is installed. The thumbnail is not generated
+  if the image already fits into `thumbnail_size`."""
+  content_type = magic.from_buffer(content, mime=True)
+  result = MediaInfo(content_type, {"mimetype": content_type, "size": len(content)})
+  if is_image and Image:
+    try:
+      with Image.open(io.BytesIO(content)) as image:
+        info = dict(result.info, w=image.width, h=image.height)
+        if image.width > thumbnail_size[0] or image.height > thumbnail_size[1]:
+          (result.thumbnail, result.thumbnail_info) = _create_thumbnail(image, thumbnail_size)
+        result.info = info
+    except Exception as e: # pylint: disable=broad-except
+      # Pillow raises all kinds of errors on malformed images, these are still sent then.
+      logger.warning("Cannot process the image of content type '{0}': {1!r}", content_type, e)
+  return result
+
+def _create_thumbnail(image, thumbnail_size):
+  if image.format in TRANSPARENT_FORMATS:
+    (fmt, mode, content_type) = ("PNG", "RGBA", "image/png")
+  else:
+    (fmt, mode, content_type) = ("JPEG", "RGB", "image/jpeg")
+  # For JPEG this makes the decoder downscale the image, which is much cheaper.
+  image.draft(mode, thumbnail_size)
+  thumbnail = image.convert(mode)
+  thumbnail.thumbnail(thumbnail_size)
+  data = io.BytesIO()
+  thumbnail.save(data, fmt)
+  content = data.getvalue()
+  return (content, {
+      "mimetype": content_type, "size": len(content),
+      "w": thumbnail.width, "h": thumbnail.height})
@@ -0,0 +1,150 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content-addressed on-disk storage for the media of offline messages."""
+
+from collections import Counter
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Temporary files are kept apart from the blobs, but on the same file system,
+# so that these can be moved into place.
+TEMP_DIR = "tmp"
+
+class MediaSpool(object):
+  """
+  Content-addressed on-disk storage for the media of offline messages.
+
+  Blobs are identified by the SHA-256 of their content, so the same media
+  queued multiple times is stored only once. Blobs are spread over
+  subdirectories named after the first two characters of their IDs.
+  """
+  def __init__(self, path):
+    self.path = path
+    # Blobs being released are removed once it's known no messages reference
+    # them, unless they were spooled again meanwhile.
+    self.releasing_blobs = Counter()
+    self.respooled_blobs = set()
+    self.temp_path = os.path.join(self.path, TEMP_DIR)
+    os.makedirs(self.temp_path, exist_ok=True)
+    # Leftovers of the previous run are not referenced by anything.
+    for name in os.listdir(self.temp_path):
+      os.unlink(os.path.join(self.temp_path, name))
+
+  def put(self, content):
+    """Stores the content, returns its blob ID."""
+    blob_id = hashlib.sha256(content).hexdigest()
+    if not os.path.exists(self._blob_path(blob_id)):
+      # Write to the temporary file first, so that partially written blobs
+      # never appear under their final name.
+      tmp_path = self.write_temp(content)
+      try:
+        self.add(tmp_path, blob_id)
+      except:
+        self.remove_temp(tmp_path)
+        raise
+    else:
+      self._on_spooled(blob_id)
+    return blob_id
+
+  def write_temp(self, content):
+    """Writes the content to the new temporary file, returns its path.
+
+    The file becomes the blob once it's added with `add`, otherwise
+    it must be removed with `remove_temp`."""
+    (fd, tmp_path) = tempfile.mkstemp(dir=self.temp_path)
+    try:
+      with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(content)
+    except:
+      os.unlink(tmp_path)
+      raise
+    return tmp_path
+
+  def add(self, tmp_path, blob_id):
+    """Moves the temporary file written by `write_temp` into the spool as the blob,
+    returns its blob ID."""
+    blob_path = self._blob_path(blob_id)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.replace(tmp_path, blob_path)
+    self._on_spooled(blob_id)
+    return blob_id
+
+  def remove_temp(self, tmp_path): # pylint: disable=no-self-use
+    """Removes the temporary file written by `write_temp`."""
+    os.unlink(tmp_path)
+
+  def open(self, blob_id):
+    """Opens the blob for reading, returns binary file object."""
+    return open(self._blob_path(blob_id), "rb")
+
+  def size(self, blob_id):
+    """Returns the size of the blob in bytes."""
+    return os.path.getsize(self._blob_path(blob_id))
+
+  def remove(self, blob_id):
+    """Removes the blob, if it exists."""
+    try:
+      os.unlink(self._blob_path(blob_id))
+    except FileNotFoundError:
+      pass
+
+  def start_release(self, blob_ids):
+    """Marks the blobs as being released, until `finish_release` is called for them."""
+    self.releasing_blobs.update(blob_ids)
+
+  def finish_release(self, blob_ids, referenced):
+    """Removes the released blobs that are not referenced and were not spooled again
+    since `start_release`."""
+    for blob_id in blob_ids:
+      if blob_id not in referenced and blob_id not in self.respooled_blobs:
+        self.remove(blob_id)
+      self.releasing_blobs[blob_id] -= 1
+      if self.releasing_blobs[blob_id] <= 0:
+        del self.releasing_blobs[blob_id]
+        self.respooled_blobs.discard(blob_id)
+
+  def blob_ids(self):
+    """Returns the IDs of all stored blobs."""
+    result = set()
+    for (_, _, files) in os.walk(self.path):
+      result.update(name for name in files if len(name) == hashlib.sha256().digest_size * 2)
+    return result
+
+  def collect_garbage(self, referenced):
+    """Removes all blobs except the referenced ones, returns the number of removed blobs."""
+    unreferenced = self.blob_ids() - set(referenced)
+    for blob_id in unreferenced:
+      self.remove(blob_id)
+    if unreferenced:
+      logger.info("Removed {0} unreferenced blobs from media spool", len(unreferenced))
+    return len(unreferenced)
+
+  def _blob_path(self, blob_id):
+    return os.path.join(self.path, blob_id[:2], blob_id)
+
+  def _on_spooled(self, blob_id):
+    # Messages referencing the blob again might not be visible yet to the lookups
+    # made for its release, so make sure these don't remove it.
+    if blob_id in self.releasing_blobs:
+      self.respooled_blobs.add(blob_id)
@@ -0,0 +1,180 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Transfers of media between Matrix and the clients."""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEDIA_TRANSFERS_PATH = "/var/lib/synapse/pumaduct-transfers"
+DEFAULT_MEDIA_TRANSFER_WORKERS = 4
+DEFAULT_MEDIA_TRANSFERS_QUOTA = 256 * 1024 * 1024
+DEFAULT_MEDIA_TRANSFER_TIMEOUT = 300
+
+# Progress of the transfers is logged each time that many bytes are transferred.
+PROGRESS_LOG_STEP = 1024 * 1024
+
+# Downloads are spooled to the subdirectory of their own, so that only these
+# are removed as the leftovers of the previous run.
+DOWNLOADS_DIR = "downloads"
+
+class MediaTransferError(Exception):
+  """Raised when the transfer exceeds the quota or the timeout."""
+  pass
+
+class MediaTransfers(object):
+  """
+  Transfers media between Matrix and the clients.
+
+  Transfers are meant to be run by `executor`, which has `workers` threads,
+  so that large media doesn't stall the main loop; if `workers` is zero,
+  `executor` is None. Downloaded media is spooled to the files under `path`
+  rather than kept in memory, the total size of these files is limited by
+  `quota` bytes. Transfers taking longer than `timeout` seconds are aborted.
+  """
+  def __init__( # pylint: disable=too-many-arguments
+      self, matrix_client, path, workers=DEFAULT_MEDIA_TRANSFER_WORKERS,
+      quota=DEFAULT_MEDIA_TRANSFERS_QUOTA, timeout=DEFAULT_MEDIA_TRANSFER_TIMEOUT):
+    self.matrix_client = matrix_client
+    self.path = path
+    self.downloads_path = os.path.join(self.path, DOWNLOADS_DIR)
+    self.workers = workers
+    self.quota = quota
+    self.timeout = timeout
+    self.executor = None
+    # Total size of the spooled files, updated from the worker threads.
+    self.lock = threading.Lock()
+    self.usage = 0
+
+  def __enter__(self):
+    os.makedirs(self.downloads_path, exist_ok=True)
+    # Leftovers of the previous run are not referenced by anything.
+    for name in os.listdir(self.downloads_path):
+      os.unlink(os.path.join(self.downloads_path, name))
+    if self.workers:
+      self.executor = ThreadPoolExecutor(
+          max_workers=self.workers, thread_name_prefix="pumaduct-media")
+
+  def __exit__(self, type_, value, traceback):
+    if self.executor:
+      self.executor.shutdown(wait=True)
+      self.executor = None
+
+  def download(self, server, media_id, thumbnail_size=None):
+    """Downloads the media into the spool, returns the path of the spooled file.
+
+    If `thumbnail_size` (width, height) is given, the thumbnail of the media
+    fitting into it is downloaded instead. Returns None on failure. The file
+    must be released with `release` once it's not needed anymore."""
+    (fd, path) = tempfile.mkstemp(dir=self.downloads_path)
+    description = "{0}{1}".format(server, media_id)
+    with os.fdopen(fd, "wb") as spooled:
+      stream = _TransferStream(self, spooled, description, count_usage=True)
+      try:
+        if thumbnail_size:
+          result = self.matrix_client.download_thumbnail(
+              server, media_id, thumbnail_size[0], thumbnail_size[1], stream,
+              timeout=self.timeout)
+        else:
+          result = self.matrix_client.download_content(
+              server, media_id, stream, timeout=self.timeout)
+      except (MediaTransferError, requests.RequestException, OSError) as e:
+        logger.error("Download of the media '{0}' failed: {1}", description, e)
+        result = None
+    if not result:
+      self._remove(path, stream.transferred)
+      return None
+    logger.debug("Downloaded {0} bytes of the media '{1}'", stream.transferred, description)
+    return path
+
+  def upload(self, content_type, open_content):
+    """Uploads the content opened by `open_content()`, returns its URL or None on failure."""
+    try:
+      with open_content() as content:
+        stream = _TransferStream(self, content, content_type)
+        url = self.matrix_client.upload_content(content_type, stream, timeout=self.timeout)
+    except (MediaTransferError, requests.RequestException, OSError) as e:
+      logger.error("Upload of the media of content type '{0}' failed: {1}", content_type, e)
+      return None
+    if url:
+      logger.debug("Uploaded {0} bytes of the media as '{1}'", stream.transferred, url)
+    return url
+
+  def release(self, path):
+    """Removes the file returned by `download`."""
+    self._remove(path, os.path.getsize(path))
+
+  def _remove(self, path, size):
+    os.unlink(path)
+    with self.lock:
+      self.usage -= size
+
+  def _add_usage(self, size):
+    with self.lock:
+      if self.usage + size > self.quota:
+        raise MediaTransferError("Media transfers quota of {0} bytes exceeded".format(self.quota))
+      self.usage += size
+
+class _TransferStream(object):
+  """Wraps the file object to enforce the transfer timeout and quota and to log the progress."""
+
+  def __init__(self, transfers, fileobj, description, count_usage=False):
+    self.transfers = transfers
+    self.fileobj = fileobj
+    self.description = description
+    self.count_usage = count_usage
+    self.deadline = time.monotonic() + transfers.timeout
+    self.transferred = 0
+    self.next_progress = PROGRESS_LOG_STEP
+
+  def read(self, size=-1):
+    data = self.fileobj.read(size)
+    self._on_transferred(len(data))
+    return data
+
+  def write(self, data):
+    if self.count_usage:
+      self.transfers._add_usage(len(data)) # pylint: disable=protected-access
+    # Count the data before writing, so that it's released even if the write fails.
+    self._on_transferred(len(data))
+    return self.fileobj.write(data)
+
+  def fileno(self):
+    return self.fileobj.fileno()
+
+  def tell(self):
+    return self.fileobj.tell()
+
+  def _on_transferred(self, size):
+    self.transferred += size
+    if time.monotonic() > self.deadline:
+      raise MediaTransferError("Transfer timed out after {0} seconds".format(
+          self.transfers.timeout))
+    if self.transferred >= self.next_progress:
+      logger.debug(
+          "Transferred {0} bytes of the media '{1}'", self.transferred, self.description)
+      self.next_progress += PROGRESS_LOG_STEP
@@ -0,0 +1,617 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Storage backends for the queue of offline messages."""
+
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_right, insort
+from collections import Counter
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import tempfile
+
+from sqlalchemy import and_, bindparam, func, or_
+from sqlalchemy.ext import baked
+
+from pumaduct.payload_codec import PayloadCodec, PayloadCodecError
+from pumaduct.payload_codec import DEFAULT_COMPRESSION, DEFAULT_COMPRESSION_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OFFLINE_QUEUE_BACKEND = "sql"
+DEFAULT_OFFLINE_QUEUE_JOURNAL_PATH = "/var/lib/synapse/pumaduct-queue"
+DEFAULT_GROUP_COMMIT_INTERVAL = 1
+DEFAULT_GROUP_COMMIT_SIZE = 100
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_CLAIM_LEASE = 0
+
+MESSAGE_FIELDS = (
+    "network", "ext_user", "room_id", "sender", "recipient",
+    "destination", "time", "payload", "blob_id")
+
+class MessageQueueBase(metaclass=ABCMeta):
+  """Abstract interface for offline messages queue backends.
+
+  Messages are returned as objects having `id` and all `MESSAGE_FIELDS` attributes,
+  with `payload` being the dict or None if it cannot be decoded, ordered by (time, id)
+  within each queue: all messages to Matrix form one queue, while messages to clients
+  are queued per (sender, network, ext_user)."""
+
+  @abstractmethod
+  def start(self):
+    raise NotImplementedError()
+
+  @abstractmethod
+  def stop(self):
+    raise NotImplementedError()
+
+  # Whether other processes modify the queue too, so that its depths must be re-counted.
+  shared = False
+
+  @abstractmethod
+  def depths(self, callback=None):
+    """Returns (destination, sender, network, ext_user, count) for all non-empty queues.
+
+    If `callback` is set, it's called with the result instead, either right away or later."""
+    raise NotImplementedError()
+
+  @abstractmethod
+  def put(self, **fields):
+    """Queues the message with given fields."""
+    raise NotImplementedError()
+
+  @abstractmethod
+  def fetch_page(self, queue_key, after, callback):
+    """Calls `callback` with the page of messages of the queue that follow `after`
+    (time, id) key or the first page if it's None, either right away or later.
+
+    Queue key is ("matrix",) or ("client", sender, network, ext_user)."""
+    raise NotImplementedError()
+
+  def walk_pages_to_client(self, sender, network, ext_user, process_page, done):
+    """Passes pages of messages to the client to `process_page`, see `PagesWalk`."""
+    PagesWalk(
+        self, ("client", sender, network, ext_user), process_page, done).start()
+
+  def walk_pages_to_matrix(self, process_page, done):
+    """Passes pages of messages to Matrix to `process_page`, see `PagesWalk`."""
+    PagesWalk(self, ("matrix",), process_page, done).start()
+
+  @abstractmethod
+  def remove(self, ids):
+    """Removes the messages with given IDs from the queue."""
+    raise NotImplementedError()
+
+  @abstractmethod
+  def expire(self, destination, before, limit, callback):
+    """Removes up to `limit` messages to `destination` queued before given time,
+    oldest first, then calls `callback` with the list of removed messages."""
+    raise NotImplementedError()
+
+  @abstractmethod
+  def commit(self):
+    """Makes preceding removals durable, called once per delivery attempt."""
+    raise NotImplementedError()
+
+  @abstractmethod
+  def referenced_blob_ids(self, blob_ids=None, callback=None):
+    """Returns the set of blob IDs referenced by queued messages, optionally
+    restricted to given ones.
+
+    If `callback` is set, it's called with the result instead, either right away
+    or later. Should the lookup fail, all given blob IDs are reported as referenced."""
+    raise NotImplementedError()
+
+class PagesWalk(object):
+  """
+  Walks through the pages of the queue without waiting for them to be read.
+
+  Pages are passed to `process_page`, which returns True to stop the walk,
+  then `done` is called. The pages the queue returns right away are processed
+  in the loop, so that long queues don't lead to deep recursion.
+  """
+  def __init__(self, queue, queue_key, process_page, done):
+    self.queue = queue
+    self.queue_key = queue_key
+    self.process_page = process_page
+    self.done = done
+    self.fetching = False
+    self.page = None
+
+  def start(self):
+    """Starts the walk from the first page."""
+    self._fetch(None)
+
+  def _fetch(self, after):
+    while after is not False:
+      self.fetching = True
+      self.page = None
+      self.queue.fetch_page(self.queue_key, after, self._on_page)
+      self.fetching = False
+      if self.page is None:
+        # The walk continues once the page is read.
+        return
+      after = self._process(self.page)
+
+  def _on_page(self, page):
+    if self.fetching:
+      self.page = page
+    else:
+      self._fetch(self._process(page))
+
+  def _process(self, page):
+    """Returns the key to fetch the next page after or False if the walk is over."""
+    if not page or self.process_page(page) or len(page) < self.queue.page_size:
+      self.done()
+      return False
+    return (page[-1].time, page[-1].id)
+
+class QueuedMessage(object):
+  """Offline message, detached from any storage."""
+  __slots__ = ("id",) + MESSAGE_FIELDS
+
+  def __init__(self, id, **fields): # pylint: disable=redefined-builtin,invalid-name
+    self.id = id # pylint: disable=invalid-name
+    for field in MESSAGE_FIELDS:
+      setattr(self, field, fields.get(field))
+
+  def to_record(self):
+    record = {field: getattr(self, field) for field in MESSAGE_FIELDS}
+    record["id"] = self.id
+    record["time"] = record["time"].isoformat()
+    return record
+
+  @staticmethod
+  def from_storage(message, codec):
+    """Returns the detached copy of the stored message, its payload is None
+    if it cannot be decoded, so that it's dropped rather than blocking the queue."""
+    fields = {field: getattr(message, field) for field in MESSAGE_FIELDS}
+    try:
+      fields["payload"] = codec.decode_stored(message.payload, message.payload_data)
+    except PayloadCodecError as e:
+      logger.error("Cannot decode the payload of the offline message {0}: {1}", message.id, e)
+      fields["payload"] = None
+    return QueuedMessage(message.id, **fields)
+
+  @staticmethod
+  def from_record(record):
+    record = dict(record)
+    record["time"] = datetime.fromisoformat(record["time"])
+    if isinstance(record["payload"], str):
+      # Journals written before payloads were stored as dicts.
+      record["payload"] = json.loads(record["payload"])
+    return QueuedMessage(**record)
+
+class SqlMessageQueue(MessageQueueBase):
+  """Stores offline messages in the SQL table, see `pumaduct.storage.Message`.
+
+  Updates are submitted to the storage service without waiting for them, while
+  the reads wait for all preceding updates and return detached copies of the rows.
+  Payloads are stored encoded by `codec`, see `pumaduct.payload_codec.PayloadCodec`.
+
+  Pages queries are baked, so that their SQL is compiled only once.
+
+  If `claim_lease` is non-zero, multiple workers can share the queue: each
+  returned page is claimed by `worker_id` for `claim_lease` seconds, during
+  which other workers skip these messages. `worker_id` is required then, as
+  it must stay the same across restarts for the worker to resume its claims.
+  The rows are selected with 'FOR UPDATE SKIP LOCKED' where supported, so that
+  concurrent workers don't wait for each other and never claim the same rows."""
+
+  def __init__( # pylint: disable=too-many-arguments
+      self, storage_service, storage, page_size, codec,
+      claim_lease=DEFAULT_CLAIM_LEASE, worker_id=None):
+    self.storage_service = storage_service
+    self.storage = storage
+    self.page_size = page_size
+    self.codec = codec
+    self.claim_lease = claim_lease
+    if claim_lease and not worker_id:
+      raise ValueError("Worker ID must be set when offline messages claiming is enabled")
+    self.worker_id = worker_id
+    self.shared = bool(claim_lease)
+    self.bakery = baked.bakery()
+
+  def start(self):
+    pass
+
+  def stop(self):
+    pass
+
+  def depths(self, callback=None):
+    msg = self.storage
+    def query_depths(db_session):
+      return db_session.query(
+          msg.destination, msg.sender, msg.network, msg.ext_user, func.count(msg.id)).group_by(
+              msg.destination, msg.sender, msg.network, msg.ext_user).all()
+    if callback:
+      self.storage_service.submit(query_depths, callback)
+      return None
+    return self.storage_service.call(query_depths)
+
+  def put(self, **fields):
+    fields["payload_data"] = self.codec.encode(fields["payload"])
+    fields["payload"] = ""
+    message = self.storage(**fields)
+    self.storage_service.submit(lambda db_session: db_session.add(message))
+
+  def fetch_page(self, queue_key, after, callback):
+    # The failure is logged by the storage service, just end the walk.
+    self.storage_service.submit(
+        self._query_page(queue_key, after), callback, lambda error: callback([]))
+
+  def remove(self, ids):
+    if ids:
+      msg = self.storage
+      self.storage_service.submit(lambda db_session: db_session.query(msg).filter(
+          msg.id.in_(ids)).delete(synchronize_session=False))
+
+  def expire(self, destination, before, limit, callback):
+    msg = self.storage
+    def expire_batch(db_session):
+      expired = [QueuedMessage.from_storage(message, self.codec)
+                 for message in db_session.query(msg).filter(
+          msg.destination == destination, msg.time < before).order_by(msg.time).limit(limit)]
+      if expired:
+        db_session.query(msg).filter(msg.id.in_([message.id for message in expired])).delete(
+            synchronize_session=False)
+      return expired
+    self.storage_service.submit(expire_batch, callback)
+
+  def commit(self):
+    # Storage service commits the submitted updates itself.
+    pass
+
+  def referenced_blob_ids(self, blob_ids=None, callback=None):
+    msg = self.storage
+    def query_blob_ids(db_session):
+      query = db_session.query(msg.blob_id).filter(msg.blob_id.isnot(None))
+      if blob_ids is not None:
+        query = query.filter(msg.blob_id.in_(blob_ids))
+      return set(row.blob_id for row in query.distinct())
+    if callback:
+      self.storage_service.submit(
+          query_blob_ids, callback, lambda error: callback(set(blob_ids or ())))
+      return None
+    return self.storage_service.call(query_blob_ids)
+
+  def _page_query(self, kind, after_last):
+    msg = self.storage
+    query = self.bakery(lambda db_session: db_session.query(msg))
+    if kind == "client":
+      query += lambda query: query.filter(
+          msg.destination == "client",
+          msg.network == bindparam("network"),
+          msg.ext_user == bindparam("ext_user"),
+          msg.sender == bindparam("sender"))
+    elif kind == "client_no_account":
+      query += lambda query: query.filter(
+          msg.destination == "client",
+          msg.network.is_(None),
+          msg.ext_user.is_(None),
+          msg.sender == bindparam("sender"))
+    else:
+      query += lambda query: query.filter(msg.destination == "matrix")
+    if after_last:
+      query += lambda query: query.filter(or_(
+          msg.time > bindparam("last_time"),
+          and_(msg.time == bindparam("last_time"), msg.id > bindparam("last_id"))))
+    if self.claim_lease:
+      query += lambda query: query.filter(or_(
+          msg.claimed_until.is_(None),
+          msg.claimed_until < bindparam("now"),
+          msg.claimed_by == bindparam("worker_id"))).with_for_update(skip_locked=True)
+    query += lambda query: query.order_by(msg.time, msg.id).limit(self.page_size)
+    return query
+
+  def _query_page(self, queue_key, last):
+    """Returns the operation reading the page of the queue that follows `last` key.
+
+    Uses keyset pagination on (time, id), so that the rows deleted from already
+    processed pages don't shift the subsequent ones."""
+    msg = self.storage
+    if queue_key[0] == "matrix":
+      (kind, params) = ("matrix", {})
+    elif queue_key[2] is None:
+      # Messages without the account, '= NULL' doesn't match these.
+      (kind, params) = ("client_no_account", {"sender": queue_key[1]})
+    else:
+      (kind, params) = (
+          "client", {"sender": queue_key[1], "network": queue_key[2], "ext_user": queue_key[3]})
+    def query_page(db_session):
+      page_params = dict(params)
+      if last:
+        (page_params["last_time"], page_params["last_id"]) = last
+      if self.claim_lease:
+        now = datetime.utcnow()
+        page_params["now"] = now
+        page_params["worker_id"] = self.worker_id
+      messages = self._page_query(kind, bool(last))(db_session).params(**page_params)
+      page = [QueuedMessage.from_storage(message, self.codec) for message in messages]
+      if page and self.claim_lease:
+        db_session.query(msg).filter(msg.id.in_([message.id for message in page])).update(
+            {msg.claimed_by: self.worker_id,
+             msg.claimed_until: now + timedelta(seconds=self.claim_lease)},
+            synchronize_session=False)
+      return page
+    return query_page
+
+class JournalMessageQueue(MessageQueueBase):
+  """
+  Keeps offline messages in memory, persisted in the append-only journal.
+
+  Each change is appended to the journal as the JSON record, but records are
+  written and fsync'ed in groups: once `group_commit_size` of them accumulate
+  or `group_commit_interval` seconds pass, whichever happens first. Therefore,
+  the changes made within the last `group_commit_interval` might be lost on
+  crash. The journal is split into segments of about `segment_size` bytes;
+  when the segment is full and most of the journal records refer to the
+  messages that were already delivered, the live messages are rewritten into
+  the new segment and the older ones are removed.
+  """
+  def __init__( # pylint: disable=too-many-arguments
+      self, glib, path, page_size, group_commit_interval=DEFAULT_GROUP_COMMIT_INTERVAL,
+      group_commit_size=DEFAULT_GROUP_COMMIT_SIZE, segment_size=DEFAULT_SEGMENT_SIZE):
+    self.glib = glib
+    self.path = path
+    self.page_size = page_size
+    self.group_commit_interval = group_commit_interval
+    self.group_commit_size = group_commit_size
+    self.segment_size = segment_size
+    self.messages = {}
+    # Sorted (time, id) of messages per queue. Removed messages are dropped
+    # from these lazily, `dead` counts such entries per queue.
+    self.queues = {}
+    self.dead = Counter()
+    self.next_id = 1
+    self.segment = None
+    self.segment_number = 0
+    # Number of records in all segments, used to decide when to compact.
+    self.records = 0
+    self.pending = []
+    self.group_commit_cb = None
+
+  def start(self):
+    os.makedirs(self.path, exist_ok=True)
+    segments = self._list_segments()
+    for number in segments:
+      self._replay_segment(number)
+    if segments:
+      self.segment_number = segments[-1]
+    logger.info("Replayed {0} offline messages from the journal", len(self.messages))
+    self._compact()
+
+  def stop(self):
+    self.flush()
+    if self.segment:
+      self.segment.close()
+      self.segment = None
+
+  def depths(self, callback=None):
+    counts = Counter(_queue_key(message) for message in self.messages.values())
+    depths = [
+        (key[0], key[1], key[2], key[3], count) if key[0] == "client"
+        else ("matrix", None, None, None, count)
+        for (key, count) in counts.items()]
+    if callback:
+      callback(depths)
+      return None
+    return depths
+
+  def put(self, **fields):
+    message = QueuedMessage(self.next_id, **fields)
+    self.next_id += 1
+    self._add(message)
+    self._append({"put": message.to_record()})
+    return message
+
+  def fetch_page(self, queue_key, after, callback):
+    callback(self._get_page(queue_key, after))
+
+  def remove(self, ids):
+    removed = self._remove(ids)
+    if removed:
+      self._append({"del": removed})
+
+  def expire(self, destination, before, limit, callback):
+    expired = []
+    for key in [key for key in self.queues if key[0] == destination]:
+      queue_expired = 0
+      for (time, message_id) in self.queues[key]:
+        if time >= before or queue_expired >= limit:
+          break
+        if message_id in self.messages:
+          expired.append(self.messages[message_id])
+          queue_expired += 1
+    # Take the oldest messages across all queues.
+    expired.sort(key=lambda message: (message.time, message.id))
+    expired = expired[:limit]
+    self.remove([message.id for message in expired])
+    callback(expired)
+
+  def commit(self):
+    # Removals are made durable by the group commit.
+    pass
+
+  def referenced_blob_ids(self, blob_ids=None, callback=None):
+    referenced = set(
+        message.blob_id for message in self.messages.values() if message.blob_id)
+    if blob_ids is not None:
+      referenced &= set(blob_ids)
+    if callback:
+      callback(referenced)
+      return None
+    return referenced
+
+  def on_group_commit(self):
+    """Writes pending journal records."""
+    self.group_commit_cb = None
+    self.flush()
+    return False
+
+  def flush(self):
+    """Writes pending journal records and waits for them to reach the disk."""
+    if self.group_commit_cb:
+      self.glib.source_remove(self.group_commit_cb)
+      self.group_commit_cb = None
+    if not self.pending:
+      return
+    self.segment.write("".join(self.pending).encode("utf8"))
+    self.segment.flush()
+    os.fsync(self.segment.fileno())
+    self.records += len(self.pending)
+    self.pending = []
+    if self.segment.tell() >= self.segment_size:
+      if len(self.messages) * 2 < self.records:
+        self._compact()
+      else:
+        self.segment.close()
+        self.segment_number += 1
+        self.segment = open(self._segment_path(self.segment_number), "ab")
+
+  def _add(self, message):
+    key = _queue_key(message)
+    insort(self.queues.setdefault(key, []), (message.time, message.id))
+    self.messages[message.id] = message
+
+  def _remove(self, ids):
+    removed = []
+    for message_id in ids:
+      message = self.messages.pop(message_id, None)
+      if message:
+        removed.append(message_id)
+        key = _queue_key(message)
+        self.dead[key] += 1
+        if self.dead[key] * 2 > len(self.queues[key]):
+          self._prune_queue(key)
+    return removed
+
+  def _prune_queue(self, key):
+    queue = [entry for entry in self.queues[key] if entry[1] in self.messages]
+    if queue:
+      self.queues[key] = queue
+    else:
+      del self.queues[key]
+    del self.dead[key]
+
+  def _get_page(self, key, last):
+    # The queue might be replaced while the page is processed, so look it up each time.
+    queue = self.queues.get(key, [])
+    pos = bisect_right(queue, last) if last else 0
+    page = []
+    while pos < len(queue) and len(page) < self.page_size:
+      message = self.messages.get(queue[pos][1])
+      if message:
+        page.append(message)
+      pos += 1
+    return page
+
+  def _append(self, record):
+    self.pending.append(json.dumps(record) + "\n")
+    if len(self.pending) >= self.group_commit_size:
+      self.flush()
+    elif not self.group_commit_cb:
+      self.group_commit_cb = self.glib.timeout_add_seconds(
+          self.group_commit_interval, self.on_group_commit)
+
+  def _compact(self):
+    """Rewrites live messages into the new segment and removes all older ones."""
+    if self.segment:
+      self.segment.close()
+    old_segments = self._list_segments()
+    self.segment_number += 1
+    (fd, tmp_path) = tempfile.mkstemp(dir=self.path)
+    with os.fdopen(fd, "wb") as tmp_file:
+      for message in self.messages.values():
+        tmp_file.write((json.dumps({"put": message.to_record()}) + "\n").encode("utf8"))
+      tmp_file.flush()
+      os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, self._segment_path(self.segment_number))
+    # Replaying the older segments together with the compacted one yields the
+    # same result, so it's fine if we're interrupted while removing them.
+    for number in old_segments:
+      os.unlink(self._segment_path(number))
+    self.records = len(self.messages)
+    self.segment = open(self._segment_path(self.segment_number), "ab")
+    logger.debug(
+        "Compacted the journal into the segment {0} with {1} messages",
+        self.segment_number, self.records)
+
+  def _replay_segment(self, number):
+    with open(self._segment_path(number), "rb") as segment:
+      for line in segment:
+        try:
+          record = json.loads(line.decode("utf8"))
+        except ValueError:
+          # Partially written record - can only be the last one in the segment.
+          logger.warning("Discarding truncated record in the journal segment {0}", number)
+          break
+        if "put" in record:
+          message = QueuedMessage.from_record(record["put"])
+          self.next_id = max(self.next_id, message.id + 1)
+          if message.id not in self.messages:
+            self._add(message)
+        else:
+          self._remove(record["del"])
+
+  def _list_segments(self):
+    return sorted(
+        int(name[:-len(".journal")]) for name in os.listdir(self.path)
+        if name.endswith(".journal"))
+
+  def _segment_path(self, number):
+    return os.path.join(self.path, "{0:016d}.journal".format(number))
+
+def create_message_queue(conf, glib, storage_service, storage, page_size):
+  """Creates offline messages queue backend according to the config."""
+  backend = (
+      conf["offline_queue_backend"] if "offline_queue_backend" in conf
+      else DEFAULT_OFFLINE_QUEUE_BACKEND)
+  if backend == "sql":
+    return SqlMessageQueue(
+        storage_service, storage, page_size,
+        PayloadCodec(
+            conf["offline_payload_compression"] if "offline_payload_compression" in conf
+            else DEFAULT_COMPRESSION,
+            conf["offline_payload_compression_threshold"]
+            if "offline_payload_compression_threshold" in conf
+            else DEFAULT_COMPRESSION_THRESHOLD),
+        conf["offline_queue_claim_lease"] if "offline_queue_claim_lease" in conf
+        else DEFAULT_CLAIM_LEASE,
+        conf["offline_queue_worker_id"] if "offline_queue_worker_id" in conf else None)
+  if backend == "journal":
+    return JournalMessageQueue(
+        glib,
+        conf["offline_queue_journal_path"] if "offline_queue_journal_path" in conf
+        else DEFAULT_OFFLINE_QUEUE_JOURNAL_PATH,
+        page_size,
+        conf["offline_queue_group_commit_interval"]
+        if "offline_queue_group_commit_interval" in conf else DEFAULT_GROUP_COMMIT_INTERVAL,
+        conf["offline_queue_group_commit_size"]
+        if "offline_queue_group_commit_size" in conf else DEFAULT_GROUP_COMMIT_SIZE,
+        conf["offline_queue_segment_size"]
+        if "offline_queue_segment_size" in conf else DEFAULT_SEGMENT_SIZE)
+  raise ValueError("Unknown offline queue backend '{0}'".format(backend))
+
+def _queue_key(message):
+  if message.destination == "matrix":
+    return ("matrix",)
+  return ("client", message.sender, message.network, message.ext_user)
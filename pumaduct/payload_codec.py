@@ -0,0 +1,126 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Binary encoding of offline messages payloads for storage."""
+
+import json
+import logging
+import zlib
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+SERIALIZER_JSON = 0
+SERIALIZER_MSGPACK = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+COMPRESSIONS = {
+    "none": COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "zstd": COMPRESSION_ZSTD}
+
+DEFAULT_COMPRESSION = "zlib"
+DEFAULT_COMPRESSION_THRESHOLD = 256
+
+class PayloadCodecError(Exception):
+  """Raised when the stored payload cannot be decoded."""
+  pass
+
+class PayloadCodec(object):
+  """
+  Encodes payloads into the versioned binary format.
+
+  Encoded payload starts with the header of three bytes: format version,
+  serializer and compression. Payloads are serialized with MessagePack if
+  it's available, falling back to compact JSON otherwise, and are compressed
+  only if their serialized size is at least `compression_threshold` bytes,
+  as compressing small payloads doesn't pay off.
+  """
+  def __init__(self, compression=DEFAULT_COMPRESSION,
+               compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+    if compression not in COMPRESSIONS:
+      raise ValueError("Unknown payload compression '{0}'".format(compression))
+    if compression == "zstd" and not zstandard:
+      logger.warning("zstandard import failed, falling back to zlib for payloads compression")
+      compression = "zlib"
+    self.compression = COMPRESSIONS[compression]
+    self.compression_threshold = compression_threshold
+    self.serializer = SERIALIZER_MSGPACK if msgpack else SERIALIZER_JSON
+    if zstandard:
+      self.zstd_compressor = zstandard.ZstdCompressor()
+      self.zstd_decompressor = zstandard.ZstdDecompressor()
+
+  def encode(self, payload):
+    """Encodes the payload, returns bytes."""
+    if self.serializer == SERIALIZER_MSGPACK:
+      data = msgpack.packb(payload, use_bin_type=True)
+    else:
+      data = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf8")
+    compression = COMPRESSION_NONE
+    if self.compression != COMPRESSION_NONE and len(data) >= self.compression_threshold:
+      if self.compression == COMPRESSION_ZSTD:
+        compressed = self.zstd_compressor.compress(data)
+      else:
+        compressed = zlib.compress(data)
+      # Incompressible data, e.g. already compressed media, is stored as is.
+      if len(compressed) < len(data):
+        (data, compression) = (compressed, self.compression)
+    return bytes((FORMAT_VERSION, self.serializer, compression)) + data
+
+  def decode(self, data):
+    """Decodes the payload encoded by `encode`."""
+    if len(data) < 3 or data[0] != FORMAT_VERSION:
+      raise PayloadCodecError("Unsupported payload format")
+    (serializer, compression) = (data[1], data[2])
+    data = data[3:]
+    if compression == COMPRESSION_ZLIB:
+      data = zlib.decompress(data)
+    elif compression == COMPRESSION_ZSTD:
+      if not zstandard:
+        raise PayloadCodecError("Payload is compressed with zstd, but zstandard is not available")
+      data = self.zstd_decompressor.decompress(data)
+    elif compression != COMPRESSION_NONE:
+      raise PayloadCodecError("Unknown payload compression {0}".format(compression))
+    if serializer == SERIALIZER_MSGPACK:
+      if not msgpack:
+        raise PayloadCodecError("Payload is serialized with msgpack, but it's not available")
+      return msgpack.unpackb(data, raw=False)
+    if serializer == SERIALIZER_JSON:
+      return json.loads(data.decode("utf8"))
+    raise PayloadCodecError("Unknown payload serializer {0}".format(serializer))
+
+  def decode_stored(self, payload, payload_data):
+    """Decodes the payload stored either in the binary or, for old rows, in JSON form."""
+    if payload_data is not None:
+      return self.decode(payload_data)
+    return json.loads(payload)
@@ -131,6 +131,12 @@ cdef extern from "libpurple/conversation.h":
 
   PurpleConvIm *purple_conversation_get_im_data(const PurpleConversation *conv)
 
+  PurpleConvChat *purple_conversation_get_chat_data(const PurpleConversation *conv)
+
+  int purple_conv_chat_get_id(const PurpleConvChat *chat)
+
+  gboolean purple_conv_chat_has_left(PurpleConvChat *chat)
+
   PurpleConversation *purple_conversation_new(PurpleConversationType type, PurpleAccount *account, const char *name)
 
   PurpleConversation *purple_find_conversation_with_account(PurpleConversationType type, const char *name, const PurpleAccount *account)
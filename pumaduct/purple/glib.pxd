@@ -106,6 +106,8 @@ cdef extern from "glib.h":
 
   void g_free(gpointer mem)
 
+  void g_hash_table_destroy(GHashTable *hash_table)
+
   void g_io_channel_unref(GIOChannel *channel)
 
   GMainLoop *g_main_loop_new(GMainContext *context, gboolean is_running)
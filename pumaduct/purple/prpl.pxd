@@ -0,0 +1,39 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from glib cimport *
+
+from connection cimport PurpleConnection
+
+cdef extern from "libpurple/plugin.h":
+  cdef struct _PurplePlugin
+  ctypedef _PurplePlugin PurplePlugin
+
+cdef extern from "libpurple/prpl.h":
+  # Only the fields used by PuMaDuct are declared.
+  ctypedef struct PurplePluginProtocolInfo:
+    GHashTable *(*chat_info_defaults)(PurpleConnection *gc, const char *chat_name)
+    void (*join_chat)(PurpleConnection *gc, GHashTable *components)
+    char *(*get_chat_name)(GHashTable *components)
+    char *(*get_cb_real_name)(PurpleConnection *gc, int id, const char *who)
+
+  PurplePluginProtocolInfo *PURPLE_PLUGIN_PROTOCOL_INFO(PurplePlugin *plugin)
+
+cdef extern from "libpurple/connection.h":
+  PurplePlugin *purple_connection_get_prpl(const PurpleConnection *gc)
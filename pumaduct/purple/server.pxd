@@ -27,3 +27,9 @@ cdef extern from "libpurple/server.h":
   unsigned int serv_send_typing(PurpleConnection *gc, const char *name, PurpleTypingState state)
 
   int serv_send_im(PurpleConnection *gc, const char *name, const char *message, PurpleMessageFlags flags)
+
+  void serv_join_chat(PurpleConnection *gc, GHashTable *data)
+
+  void serv_chat_invite(PurpleConnection *gc, int id, const char *message, const char *name)
+
+  int serv_chat_send(PurpleConnection *gc, int id, const char *message, PurpleMessageFlags flags)
@@ -27,6 +27,7 @@ from pumaduct.purple.debug cimport *
 from pumaduct.purple.eventloop cimport *
 from pumaduct.purple.imgstore cimport *
 from pumaduct.purple.prefs cimport *
+from pumaduct.purple.prpl cimport *
 from pumaduct.purple.request cimport *
 from pumaduct.purple.server cimport *
 from pumaduct.purple.signals cimport *
@@ -69,6 +70,9 @@ CONNECTION_ERRORS = {
 g_callbacks = defaultdict(list)
 g_reconnect_timeouts = {}
 g_expected_send_msgs = {}
+# Chats being joined, keyed by (account, normalized chat name) and storing
+# the chat name requested by 'create_chat' and the contacts to invite.
+g_pending_chats = {}
 
 cdef void user_signed_on_cb(PurpleConnection *gc, gpointer null) with gil:
   cdef PurpleAccount *account = purple_connection_get_account(gc)
@@ -177,8 +181,28 @@ cdef void contact_typing_cb(PurpleAccount *account, const char *name, gpointer n
 
 cdef void write_conv(PurpleConversation *conv, const char *who, const char *alias,
                      const char *message, PurpleMessageFlags flags, time_t mtime) with gil:
+  emit_new_message(conv, who, message, flags, mtime)
+
+cdef void write_chat(PurpleConversation *conv, const char *who,
+                     const char *message, PurpleMessageFlags flags, time_t mtime) with gil:
+  cdef PurpleConnection *gc = purple_conversation_get_gc(conv)
+  cdef PurplePluginProtocolInfo *prpl_info = NULL
+  cdef char *real_name = NULL
+  # In chats 'who' is usually the nickname, so report the real name of the sender if it's known.
+  if gc and who and not flags & PURPLE_MESSAGE_SEND:
+    prpl_info = PURPLE_PLUGIN_PROTOCOL_INFO(purple_connection_get_prpl(gc))
+    if prpl_info.get_cb_real_name:
+      real_name = prpl_info.get_cb_real_name(
+          gc, purple_conv_chat_get_id(purple_conversation_get_chat_data(conv)), who)
+  if real_name:
+    emit_new_message(conv, real_name, message, flags, mtime)
+    g_free(real_name)
+  else:
+    emit_new_message(conv, who, message, flags, mtime)
+
+cdef void emit_new_message(PurpleConversation *conv, const char *who,
+                           const char *message, PurpleMessageFlags flags, time_t mtime):
   cdef PurpleAccount *account = NULL
-  cdef const char *name = NULL
   cdef intptr_t conv_id = <intptr_t>conv
   if flags & PURPLE_MESSAGE_SEND:
     if conv_id in g_expected_send_msgs:
@@ -192,10 +216,6 @@ cdef void write_conv(PurpleConversation *conv, const char *who, const char *alia
   else:
     logger.debug("Received the message with non-supported flags, skipping: {0}, {1}, {2}, {3}", who, message, flags, mtime)
     return
-  if alias and alias[0]:
-    name = alias
-  elif who and who[0]:
-    name = who
   account = purple_conversation_get_account(conv)
   if "new-message" in g_callbacks:
     network = account.protocol_id.decode("utf8")
@@ -206,6 +226,45 @@ cdef void write_conv(PurpleConversation *conv, const char *who, const char *alia
     for callback in g_callbacks["new-message"]:
       callback(network, user, conv_id, contact, dir, msg, time)
 
+cdef object chat_key(PurpleAccount *account, const char *name):
+  # Protocols normalize chat names differently, lowercasing is good enough for matching these.
+  return (<intptr_t>account, name.decode("utf8").lower())
+
+cdef object get_chat_name(PurpleConnection *gc, GHashTable *components):
+  cdef PurplePluginProtocolInfo *prpl_info = PURPLE_PLUGIN_PROTOCOL_INFO(purple_connection_get_prpl(gc))
+  cdef char *name = NULL
+  if prpl_info.get_chat_name:
+    name = prpl_info.get_chat_name(components)
+  if name:
+    result = name.decode("utf8")
+    g_free(name)
+    return result
+  return None
+
+cdef void chat_joined_cb(PurpleConversation *conv, gpointer null) with gil:
+  cdef PurpleAccount *account = purple_conversation_get_account(conv)
+  cdef PurpleConnection *gc = purple_conversation_get_gc(conv)
+  cdef int chat_id = purple_conv_chat_get_id(purple_conversation_get_chat_data(conv))
+  key = chat_key(account, purple_conversation_get_name(conv))
+  if key in g_pending_chats:
+    (chat_name, contacts) = g_pending_chats.pop(key)
+    logger.debug("Joined the chat '{0}', inviting {1}", chat_name, contacts)
+    for contact in contacts:
+      serv_chat_invite(gc, chat_id, NULL, contact.encode("utf8"))
+    if "chat-joined" in g_callbacks:
+      network = account.protocol_id.decode("utf8")
+      user = account.username.decode("utf8")
+      for callback in g_callbacks["chat-joined"]:
+        callback(network, user, <intptr_t>conv, chat_name)
+
+cdef void chat_join_failed_cb(PurpleConnection *gc, GHashTable *components, gpointer null) with gil:
+  cdef PurpleAccount *account = purple_connection_get_account(gc)
+  name = get_chat_name(gc, components)
+  if name:
+    # Forget about the chat, so that the next 'create_chat' tries joining it again.
+    pending = g_pending_chats.pop(chat_key(account, name.encode("utf8")), None)
+    logger.error("Failed to join the chat '{0}' ({1})", name, pending)
+
 cdef void destroy_conv(PurpleConversation *conv):
   cdef PurpleAccount *account = NULL
   cdef intptr_t conv_id = <intptr_t>conv
@@ -223,7 +282,7 @@ cdef void destroy_conv(PurpleConversation *conv):
 cdef PurpleConversationUiOps conv_uiops = [
   NULL,          # create_conversation
   &destroy_conv, # destroy_conversation
-  NULL,          # write_chat
+  &write_chat,   # write_chat
   NULL,          # write_im
   &write_conv,   # write_conv
   NULL,          # chat_add_users
@@ -443,6 +502,14 @@ class Client(ImClientBase):
         purple_conversations_get_handle(), b"buddy-typing-stopped", &handle,
         <PurpleCallback>contact_typing_cb, NULL)
 
+    purple_signal_connect(
+        purple_conversations_get_handle(), b"chat-joined", &handle,
+        <PurpleCallback>chat_joined_cb, NULL)
+
+    purple_signal_connect(
+        purple_conversations_get_handle(), b"chat-join-failed", &handle,
+        <PurpleCallback>chat_join_failed_cb, NULL)
+
     purple_prefs_set_bool("/purple/away/away_when_idle", False)
     purple_prefs_set_string("/purple/away/idle_reporting", "none")
     purple_prefs_set_bool("/purple/logging/log_ims", False)
@@ -514,6 +581,37 @@ class Client(ImClientBase):
     else:
       raise PurpleError("Account '{0}' is unknown".format(user))
 
+  def create_chat(self, network, user, chat_name, contacts):
+    logger.debug("create_chat: {0}, {1}, {2}, {3}", network, user, chat_name, contacts)
+    cdef PurpleConversation *conv = NULL
+    cdef PurpleConnection *gc = NULL
+    cdef PurplePluginProtocolInfo *prpl_info = NULL
+    cdef GHashTable *components = NULL
+    cdef PurpleAccount *account = purple_accounts_find(
+        user.encode("utf8"), network.encode("utf8"))
+    if not account:
+      raise PurpleError("Account '{0}' is unknown".format(user))
+    gc = account.gc
+    if not gc:
+      raise PurpleError("Account '{0}' is not connected".format(user))
+    prpl_info = PURPLE_PLUGIN_PROTOCOL_INFO(purple_connection_get_prpl(gc))
+    if not prpl_info.chat_info_defaults or not prpl_info.join_chat:
+      raise PurpleError("Network '{0}' doesn't support chats".format(network))
+    components = prpl_info.chat_info_defaults(gc, chat_name.encode("utf8"))
+    name = get_chat_name(gc, components) or chat_name
+    conv = purple_find_conversation_with_account(
+        PURPLE_CONV_TYPE_CHAT, name.encode("utf8"), account)
+    if conv and not purple_conv_chat_has_left(purple_conversation_get_chat_data(conv)):
+      g_hash_table_destroy(components)
+      return <intptr_t>conv
+    key = chat_key(account, name.encode("utf8"))
+    # Joining is asynchronous, "chat-joined" callback is fired once it's done.
+    if key not in g_pending_chats:
+      g_pending_chats[key] = (chat_name, list(contacts))
+      serv_join_chat(gc, components)
+    g_hash_table_destroy(components)
+    return None
+
   def send_message(self, network, user, conversation, message):
     logger.debug(
         "send_message: {0}, {1}, {2}, {3}",
@@ -521,11 +619,17 @@ class Client(ImClientBase):
     cdef intptr_t conv_id = conversation
     cdef PurpleConversation *conv = <PurpleConversation*>conv_id
     cdef PurpleConnection *gc = purple_conversation_get_gc(conv)
+    cdef int err = 0
     if conv_id not in g_expected_send_msgs:
       g_expected_send_msgs[conv_id] = 1
     else:
       g_expected_send_msgs[conv_id] += 1
-    cdef int err = serv_send_im(
+    if purple_conversation_get_type(conv) == PURPLE_CONV_TYPE_CHAT:
+      err = serv_chat_send(
+          gc, purple_conv_chat_get_id(purple_conversation_get_chat_data(conv)),
+          message.encode("utf8"), PURPLE_MESSAGE_SEND)
+      return err >= 0
+    err = serv_send_im(
         gc, purple_conversation_get_name(conv),
         message.encode("utf8"), PURPLE_MESSAGE_SEND)
     return err > 0
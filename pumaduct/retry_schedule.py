@@ -0,0 +1,71 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Retries scheduled on the main loop with exponential backoff."""
+
+class RetrySchedule(object):
+  """
+  Retries scheduled on the main loop per key.
+
+  The interval of the key starts from the base one and doubles each time
+  the retry is scheduled with backoff, up to the maximum, until it's reset.
+  """
+  def __init__(self, glib, interval, max_interval):
+    self.glib = glib
+    self.interval = interval
+    self.max_interval = max_interval
+    self.cbs = {}
+    self.intervals = {}
+
+  def schedule(self, key, callback, backoff=False):
+    """Schedules calling `callback` for the key, unless it's already scheduled."""
+    if key in self.cbs:
+      return
+    interval = self.intervals.get(key)
+    if interval is None:
+      interval = self.interval
+    elif backoff:
+      interval = min(interval * 2, self.max_interval)
+    self.intervals[key] = interval
+    self.cbs[key] = self.glib.timeout_add_seconds(
+        interval, lambda: self._on_timeout(key, callback))
+
+  def cancel(self, key):
+    """Cancels the scheduled retry for the key, keeping its interval."""
+    cb_id = self.cbs.pop(key, None)
+    if cb_id:
+      self.glib.source_remove(cb_id)
+
+  def reset(self, key):
+    """Cancels the scheduled retry for the key and restarts its interval from the base one."""
+    self.cancel(key)
+    self.intervals.pop(key, None)
+
+  def clear(self):
+    """Cancels all scheduled retries and forgets their intervals."""
+    for cb_id in self.cbs.values():
+      self.glib.source_remove(cb_id)
+    self.cbs.clear()
+    self.intervals.clear()
+
+  def _on_timeout(self, key, callback):
+    # The source is removed by returning 'False', so just forget about it.
+    del self.cbs[key]
+    callback()
+    return False
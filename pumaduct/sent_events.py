@@ -0,0 +1,112 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bounded, persisted store of the IDs of the events PuMaDuct sent to Matrix."""
+
+from datetime import datetime, timedelta
+import logging
+from time import monotonic
+
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class SentEventsStore(object):
+  """
+  Bounded, persisted store of the IDs of the events PuMaDuct sent to Matrix.
+
+  Matrix server echoes the events we've sent back to us in transactions, these
+  need to be recognized and discarded. The recent window of IDs is kept in memory,
+  so that membership checks never hit the DB; the DB copy is only used to restore
+  this window on restart. Both copies expire after `ttl` seconds, in case Matrix
+  server never echoes the event back.
+  """
+  def __init__(self, storage_service, storage, max_items, ttl):
+    """
+    :param storage_service: `pumaduct.storage_service.StorageService` to persist event IDs with.
+    :param storage: storage class for sent events, see `pumaduct.storage.SentEvent`.
+    :param max_items: max number of event IDs to keep.
+    :param ttl: time in seconds after which event IDs expire.
+    """
+    self.storage_service = storage_service
+    self.storage = storage
+    self.ttl = ttl
+    self.recent = TTLCache(max_items, ttl, timer=self._timer)
+    # Seconds the cache timer is moved back by, so that the IDs restored by
+    # `load` expire at the same time they would have without the restart.
+    self.backdate = 0
+
+  def __contains__(self, event_id):
+    return event_id in self.recent
+
+  def __len__(self):
+    return len(self.recent)
+
+  def load(self):
+    """Restores the in-memory window from the DB, discarding expired IDs."""
+    self.expire()
+    storage = self.storage
+    max_items = self.recent.maxsize
+    sent_events = self.storage_service.call(lambda db_session: [
+        (sent_event.event_id, sent_event.time) for sent_event in db_session.query(
+            storage).order_by(storage.time.desc()).limit(max_items)])
+    now = datetime.utcnow()
+    # The oldest IDs are inserted first, as the cache expects these to expire first.
+    for (event_id, time) in reversed(sent_events):
+      age = (now - time).total_seconds()
+      if age < self.ttl:
+        self.backdate = max(age, 0)
+        self.recent[event_id] = True
+    self.backdate = 0
+    logger.debug("Restored {0} sent events IDs", len(self.recent))
+
+  def add(self, event_id):
+    """Records the ID of the event that was sent to Matrix."""
+    self.recent[event_id] = True
+    sent_event = self.storage(event_id=event_id, time=datetime.utcnow())
+    def store(db_session):
+      db_session.merge(sent_event)
+    self.storage_service.submit(store)
+
+  def pop(self, event_id):
+    """Removes the event ID, returns True if it was present."""
+    if event_id not in self.recent:
+      return False
+    del self.recent[event_id]
+    storage = self.storage
+    self.storage_service.submit(lambda db_session: db_session.query(storage).filter(
+        storage.event_id == event_id).delete(synchronize_session=False))
+    return True
+
+  def expire(self):
+    """Deletes expired event IDs, both from memory and the DB."""
+    self.recent.expire()
+    storage = self.storage
+    threshold = datetime.utcnow() - timedelta(seconds=self.ttl)
+    self.storage_service.submit(
+        lambda db_session: db_session.query(storage).filter(
+            storage.time < threshold).delete(synchronize_session=False),
+        _on_expired)
+
+  def _timer(self):
+    return monotonic() - self.backdate
+
+def _on_expired(expired):
+  if expired:
+    logger.debug("Expired {0} sent events IDs", expired)
@@ -390,7 +390,10 @@ class Client(ImClientBase): # pylint: disable=too-many-public-methods
   def _send_file(self, network, user, conversation, description, content, is_image):
     if (network, user) in self.instances:
       inst = self.instances[(network, user)]
-      msg = conversation.sendFile(io.BytesIO(content), description, image=is_image)
+      # Content is either the file object or the bytes.
+      if not hasattr(content, "read"):
+        content = io.BytesIO(content)
+      msg = conversation.sendFile(content, description, image=is_image)
       inst.sent_msgs.add(msg.clientId)
       return True
     else:
@@ -19,9 +19,16 @@
 
 """Persistent storage data structures for PuMaDict."""
 
-from sqlalchemy import Column, DateTime, Enum, Integer, String, UniqueConstraint
+import logging
+
+from sqlalchemy import Column, DateTime, Enum, Index, Integer, LargeBinary, String
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 class Account(Base):
@@ -49,4 +56,102 @@ class Message(Base):
   recipient = Column(String)
   destination = Column(Enum("client", "matrix", name="DestinationType"), nullable=False)
   time = Column(DateTime, nullable=False)
+  # JSON payload of the messages stored before `payload_data` was introduced,
+  # empty for the newer ones.
   payload = Column(String, nullable=False)
+  # Payload encoded by `pumaduct.payload_codec.PayloadCodec`.
+  payload_data = Column(LargeBinary)
+  # ID of the media content in `pumaduct.media_spool.MediaSpool`, if any.
+  blob_id = Column(String, index=True)
+  # Worker that claimed the message for delivery and until when, see
+  # `pumaduct.message_queue.SqlMessageQueue`.
+  claimed_by = Column(String)
+  claimed_until = Column(DateTime)
+  __table_args__ = (
+      # Offline messages to clients are retrieved per user and account.
+      Index("ix_pumaduct_message_client", "destination", "network", "ext_user", "sender", "time"),
+      # Offline messages to Matrix are retrieved all at once.
+      Index("ix_pumaduct_message_matrix", "destination", "time"),)
+
+class SentEvent(Base):
+  """ID of the event sent to Matrix by PuMaDuct that Matrix is expected to echo back."""
+
+  __tablename__ = "pumaduct_sent_event"
+  event_id = Column(String, nullable=False, primary_key=True)
+  time = Column(DateTime, nullable=False, index=True)
+
+# Value of SQLite 'auto_vacuum' pragma that enables 'incremental_vacuum'.
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+
+DEFAULT_DB_POOL_SIZE = 5
+DEFAULT_DB_MAX_OVERFLOW = 10
+DEFAULT_DB_POOL_RECYCLE = 3600
+DEFAULT_SQLITE_JOURNAL_MODE = "WAL"
+DEFAULT_SQLITE_SYNCHRONOUS = "NORMAL"
+
+def create_db_engine(conf):
+  """Creates DB engine for `db_spec` from the config, tuned for the specific DB.
+
+  SQLite connections get journal mode and synchronous level pragmas set, while
+  for other DBs the connection pool is configured."""
+  url = make_url(conf["db_spec"])
+  if url.get_backend_name() != "sqlite":
+    return create_engine(
+        url,
+        pool_size=conf["db_pool_size"] if "db_pool_size" in conf else DEFAULT_DB_POOL_SIZE,
+        max_overflow=(
+            conf["db_max_overflow"] if "db_max_overflow" in conf else DEFAULT_DB_MAX_OVERFLOW),
+        pool_recycle=(
+            conf["db_pool_recycle"] if "db_pool_recycle" in conf else DEFAULT_DB_POOL_RECYCLE),
+        # Detects connections dropped by the server, e.g. on its restart.
+        pool_pre_ping=True)
+  engine = create_engine(url)
+  if url.database not in (None, "", ":memory:"):
+    journal_mode = (
+        conf["sqlite_journal_mode"] if "sqlite_journal_mode" in conf
+        else DEFAULT_SQLITE_JOURNAL_MODE)
+    synchronous = (
+        conf["sqlite_synchronous"] if "sqlite_synchronous" in conf
+        else DEFAULT_SQLITE_SYNCHRONOUS)
+    def set_pragmas(dbapi_connection, _):
+      cursor = dbapi_connection.cursor()
+      cursor.execute("PRAGMA journal_mode = {0}".format(journal_mode))
+      cursor.execute("PRAGMA synchronous = {0}".format(synchronous))
+      cursor.close()
+    event.listen(engine, "connect", set_pragmas)
+  return engine
+
+def upgrade(engine):
+  """Brings the schema of existing DB up to date with the current definitions.
+
+  `create_all()` only creates missing tables, so anything added to the existing
+  tables later on has to be created here."""
+  inspector = inspect(engine)
+  for table in Base.metadata.sorted_tables:
+    existing = set(column["name"] for column in inspector.get_columns(table.name))
+    for column in table.columns:
+      if column.name not in existing:
+        # Only nullable columns are ever added, so that existing rows stay valid.
+        logger.info("Adding column '{0}' to the table '{1}'", column.name, table.name)
+        engine.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+            table.name, column.name, column.type.compile(dialect=engine.dialect)))
+    existing = set(index["name"] for index in inspector.get_indexes(table.name))
+    for index in table.indexes:
+      if index.name not in existing:
+        logger.info("Creating index '{0}' on the table '{1}'", index.name, table.name)
+        index.create(bind=engine)
+  if engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+    with engine.connect() as conn:
+      if conn.execute("PRAGMA auto_vacuum").scalar() != SQLITE_AUTO_VACUUM_INCREMENTAL:
+        # Changing this mode for the existing DB only takes effect after full vacuum.
+        logger.info("Enabling incremental auto vacuum for the DB, this might take a while")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+def maintain(db_session, vacuum_pages):
+  """Returns free pages to the OS and refreshes query planner statistics.
+
+  Only SQLite is handled, other DBs are expected to take care of that themselves."""
+  if db_session.get_bind().dialect.name == "sqlite":
+    db_session.execute("PRAGMA incremental_vacuum({0})".format(int(vacuum_pages)))
+    db_session.execute("ANALYZE")
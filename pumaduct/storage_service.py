@@ -0,0 +1,156 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Performs DB operations on the dedicated thread."""
+
+import functools
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORAGE_BATCH_SIZE = 100
+
+class StorageRequest(object):
+  """DB operation submitted to `StorageService`."""
+  __slots__ = ("fn", "callback", "error_callback", "done", "result", "error")
+
+  def __init__(self, fn, callback=None, error_callback=None, wait=False):
+    self.fn = fn
+    self.callback = callback
+    self.error_callback = error_callback
+    self.done = threading.Event() if wait else None
+    self.result = None
+    self.error = None
+
+class StorageService(object):
+  """
+  Performs DB operations on the dedicated thread.
+
+  Operations are functions taking DB session as the only argument. They are
+  executed in the order of submission, in batches of up to `batch_size`
+  operations per transaction, so that the commit cost is shared between them.
+  If any operation of the batch fails, the batch is rolled back and its
+  operations are retried in separate transactions, so that only the failing
+  one is lost.
+
+  Operations results must not reference ORM objects, as these cannot be used
+  outside of the storage thread.
+
+  If `threaded` is False, operations are executed right away on the calling
+  thread instead, which is only useful for tests.
+  """
+  def __init__(self, glib, db_session, threaded=True, batch_size=DEFAULT_STORAGE_BATCH_SIZE):
+    self.glib = glib
+    self.db_session = db_session
+    self.threaded = threaded
+    self.batch_size = batch_size
+    self.requests = queue.Queue()
+    self.thread = None
+
+  def __enter__(self):
+    if self.threaded:
+      self.thread = threading.Thread(target=self.run, name="pumaduct-storage")
+      self.thread.start()
+
+  def __exit__(self, type_, value, traceback):
+    if self.thread:
+      # Operations submitted before are still performed.
+      self.requests.put(None)
+      self.thread.join()
+      self.thread = None
+
+  def submit(self, fn, callback=None, error_callback=None):
+    """Schedules the operation, `callback` is then called with its result in the main loop.
+
+    If the operation fails, `error_callback` is called with the exception instead."""
+    request = StorageRequest(fn, callback, error_callback)
+    if self.thread:
+      self.requests.put(request)
+    else:
+      self._execute([request])
+
+  def call(self, fn):
+    """Performs the operation and waits for its completion, returns its result.
+
+    This blocks the caller, so should be used only when the result is needed
+    right away, e.g. on startup."""
+    request = StorageRequest(fn, wait=bool(self.thread))
+    if self.thread:
+      self.requests.put(request)
+      request.done.wait()
+    else:
+      self._execute([request])
+    if request.error:
+      raise request.error
+    return request.result
+
+  def run(self):
+    """Storage thread main function."""
+    while True:
+      request = self.requests.get()
+      if request is None:
+        return
+      batch = [request]
+      stop = False
+      while len(batch) < self.batch_size:
+        try:
+          request = self.requests.get_nowait()
+        except queue.Empty:
+          break
+        if request is None:
+          stop = True
+          break
+        batch.append(request)
+      self._execute(batch)
+      if stop:
+        return
+
+  def _execute(self, batch):
+    try:
+      for request in batch:
+        request.result = request.fn(self.db_session)
+      self.db_session.commit()
+    except Exception as e: # pylint: disable=broad-except
+      self.db_session.rollback()
+      if len(batch) > 1:
+        logger.warning(
+            "Storage batch of {0} operations failed, retrying them separately", len(batch))
+        for request in batch:
+          self._execute([request])
+        return
+      logger.exception("Storage operation failed")
+      batch[0].result = None
+      batch[0].error = e
+    for request in batch:
+      self._complete(request)
+
+  def _complete(self, request):
+    if request.done:
+      request.done.set()
+    if request.error:
+      (callback, arg) = (request.error_callback, request.error)
+    else:
+      (callback, arg) = (request.callback, request.result)
+    if callback:
+      if self.thread:
+        self.glib.main_context_invoke(functools.partial(callback, arg))
+      else:
+        callback(arg)
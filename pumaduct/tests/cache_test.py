@@ -0,0 +1,39 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests PuMaDuct caching primitives."""
+
+import unittest
+
+from pumaduct.cache import StatsLRUCache
+
+class StatsLRUCacheTest(unittest.TestCase):
+  """Tests StatsLRUCache functionality."""
+
+  def test_lookup_stats(self):
+    cache = StatsLRUCache(maxsize=2)
+    self.assertIsNone(cache.lookup("a"))
+    cache["a"] = False
+    self.assertFalse(cache.lookup("a"))
+    self.assertEqual(cache.lookup("b", 1), 1)
+    self.assertEqual(cache.stats(), {
+        "size": 1, "maxsize": 2, "hits": 1, "misses": 2, "hit_rate": 1 / 3})
+
+  def test_empty_hit_rate(self):
+    self.assertEqual(StatsLRUCache(maxsize=1).hit_rate(), 0.0)
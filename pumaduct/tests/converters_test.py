@@ -0,0 +1,94 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests messages bodies converters."""
+
+import unittest
+from unittest.mock import Mock
+
+import html2text
+import markdown
+
+from pumaduct.converters import BodyConverters, create_converter
+
+PLAIN_BODIES = ["", "Test message.", "See you at 5 pm (or later), ok?", "Ĉu vi? 😀"]
+MARKUP_BODIES = [
+    "<b>Test</b> message.", "Tom &amp; Jerry", "line1\nline2", "- item", "1. item",
+    "**Test** message.", "_Test_", "`code`", "[link](http://example.com)", "# Title",
+    "Trailing space ", "  Leading space", "Test\tmessage"]
+# html2text wraps long lines, while for Markdown these are still plain text.
+LONG_BODY = "x" * 100
+
+class ConvertersTest(unittest.TestCase):
+  """Tests messages bodies converters."""
+
+  def test_html2text(self):
+    converter = create_converter("html2text", 10)
+    for body in PLAIN_BODIES + MARKUP_BODIES + [LONG_BODY]:
+      expected = html2text.HTML2Text().handle(body)
+      if expected.endswith("\n\n"):
+        expected = expected[:-2]
+      self.assertEqual(converter.convert(body), expected)
+    self.assertEqual(converter.plain, len(PLAIN_BODIES))
+
+  def test_markdown(self):
+    converter = create_converter("markdown", 10)
+    for body in PLAIN_BODIES + MARKUP_BODIES + [LONG_BODY]:
+      self.assertEqual(converter.convert(body), markdown.markdown(body))
+    self.assertEqual(converter.plain, len(PLAIN_BODIES) + 1)
+
+  def test_cache(self):
+    converter = create_converter("markdown", 10)
+    converter.convert("**Test**")
+    converter.convert("**Test**")
+    converter.convert("Test")
+    self.assertEqual(converter.stats(), {
+        "size": 1, "maxsize": 10, "hits": 1, "misses": 1, "hit_rate": 0.5, "plain": 1})
+
+  def test_unknown(self):
+    self.assertIsNone(create_converter("smth", 10))
+
+  def test_body_converters(self):
+    offloaded = []
+    def submit(key, callback, fn=None, args=(), offload=True, error_callback=None):
+      del key, error_callback # Unused.
+      if fn:
+        offloaded.append(offload)
+        callback(fn(*args))
+      else:
+        callback()
+    pool = Mock()
+    pool.submit.side_effect = submit
+    converters = BodyConverters(pool, 10, 20)
+    results = []
+    converters.convert_ordered("room1", "prpl-jabber", "markdown", "**Test**", results.append)
+    converters.convert_ordered("room1", "prpl-jabber", "markdown", "**Test** " * 3, results.append)
+    converters.convert_ordered("room1", "prpl-jabber", None, "**Test**", results.append)
+    self.assertEqual(results, [
+        "<p><strong>Test</strong></p>",
+        "<p><strong>Test</strong> <strong>Test</strong> <strong>Test</strong> </p>",
+        "**Test**"])
+    # Only the large bodies are offloaded.
+    self.assertEqual(offloaded, [False, True])
+    # Converters are shared per network.
+    self.assertIs(
+        converters.get("prpl-jabber", "markdown"), converters.get("prpl-jabber", "markdown"))
+    self.assertIsNot(
+        converters.get("prpl-jabber", "markdown"), converters.get("prpl-icq", "markdown"))
+    self.assertEqual(converters.stats()["prpl-jabber/markdown"]["misses"], 1)
@@ -0,0 +1,90 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests metadata and thumbnails of the media."""
+
+import io
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pumaduct import logger_format
+from pumaduct import media_info
+from pumaduct.media_info import get_media_info
+
+GIF_DATA = b"\x47\x49\x46\x38\x39\x61\x01\x00\x01\x00\x00\x00\x00\x3b"
+
+class MediaInfoTest(unittest.TestCase):
+  """Tests metadata and thumbnails of the media."""
+
+  def setUp(self):
+    logger_format.setup()
+
+  def tearDown(self):
+    logger_format.clean()
+
+  def test_file(self):
+    result = get_media_info(b"\x01\x02\x03", False)
+    self.assertEqual(result.content_type, "application/octet-stream")
+    self.assertEqual(result.info, {"mimetype": "application/octet-stream", "size": 3})
+    self.assertIsNone(result.thumbnail)
+
+  def test_image_without_pillow(self):
+    with patch.object(media_info, "Image", None):
+      result = get_media_info(GIF_DATA, True)
+    self.assertEqual(result.info, {"mimetype": "image/gif", "size": len(GIF_DATA)})
+    self.assertIsNone(result.thumbnail)
+
+  @unittest.skipUnless(media_info.Image, "Pillow is not available")
+  def test_image_thumbnail(self):
+    data = io.BytesIO()
+    media_info.Image.new("RGB", (640, 320)).save(data, "JPEG")
+    result = get_media_info(data.getvalue(), True, (100, 100))
+    self.assertEqual(result.info, {
+        "mimetype": "image/jpeg", "size": len(data.getvalue()), "w": 640, "h": 320})
+    self.assertEqual(result.thumbnail_info["mimetype"], "image/jpeg")
+    self.assertEqual((result.thumbnail_info["w"], result.thumbnail_info["h"]), (100, 50))
+    self.assertEqual(result.thumbnail_info["size"], len(result.thumbnail))
+    # Images fitting into the thumbnail size don't need one.
+    data = io.BytesIO()
+    media_info.Image.new("P", (80, 60)).save(data, "GIF")
+    result = get_media_info(data.getvalue(), True, (100, 100))
+    self.assertEqual((result.info["w"], result.info["h"]), (80, 60))
+    self.assertIsNone(result.thumbnail)
+    # Images that might have transparency have PNG thumbnails.
+    result = get_media_info(data.getvalue(), True, (40, 40))
+    self.assertEqual(result.thumbnail_info["mimetype"], "image/png")
+    self.assertEqual((result.thumbnail_info["w"], result.thumbnail_info["h"]), (40, 30))
+
+  @unittest.skipUnless(media_info.Image, "Pillow is not available")
+  def test_broken_image(self):
+    with self.assertLogs(level="WARNING"):
+      result = get_media_info(GIF_DATA, True)
+    self.assertEqual(result.info, {"mimetype": "image/gif", "size": len(GIF_DATA)})
+
+  def test_failed_thumbnail(self):
+    image = MagicMock(width=640, height=320)
+    image.__enter__.return_value = image
+    with patch.object(media_info, "Image") as image_module:
+      image_module.open.return_value = image
+      with patch.object(media_info, "_create_thumbnail", side_effect=SyntaxError("Broken")):
+        with self.assertLogs(level="WARNING"):
+          result = get_media_info(GIF_DATA, True, (100, 100))
+    # The image is still sent, just without the dimensions and the thumbnail.
+    self.assertEqual(result.info, {"mimetype": "image/gif", "size": len(GIF_DATA)})
+    self.assertIsNone(result.thumbnail)
@@ -0,0 +1,86 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests media spool."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pumaduct import logger_format
+from pumaduct.media_spool import MediaSpool
+
+class MediaSpoolTest(unittest.TestCase):
+  """Tests media spool."""
+
+  def setUp(self):
+    logger_format.setup()
+    self.path = tempfile.mkdtemp(prefix="pumaduct-media-")
+    self.spool = MediaSpool(self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+    logger_format.clean()
+
+  def test_put_and_open(self):
+    blob_id = self.spool.put(b"content")
+    # The same content should map to the same blob.
+    self.assertEqual(self.spool.put(b"content"), blob_id)
+    self.assertNotEqual(self.spool.put(b"other content"), blob_id)
+    with self.spool.open(blob_id) as blob:
+      self.assertEqual(blob.read(), b"content")
+    self.assertEqual(self.spool.size(blob_id), 7)
+    self.assertEqual(len(self.spool.blob_ids()), 2)
+    self.spool.remove(blob_id)
+    self.spool.remove(blob_id)
+    self.assertEqual(len(self.spool.blob_ids()), 1)
+
+  def test_temp_files(self):
+    tmp_path1 = self.spool.write_temp(b"content1")
+    tmp_path2 = self.spool.write_temp(b"content2")
+    # Temporary files are not blobs until added.
+    self.assertEqual(self.spool.blob_ids(), set())
+    self.spool.add(tmp_path1, "a" * 64)
+    with self.spool.open("a" * 64) as blob:
+      self.assertEqual(blob.read(), b"content1")
+    self.spool.remove_temp(tmp_path2)
+    self.assertEqual(self.spool.blob_ids(), {"a" * 64})
+    # Leftover temporary files are removed on restart.
+    self.spool.write_temp(b"content3")
+    self.spool = MediaSpool(self.path)
+    self.assertEqual(os.listdir(self.spool.temp_path), [])
+
+  def test_collect_garbage(self):
+    blob_id1 = self.spool.put(b"content1")
+    self.spool.put(b"content2")
+    self.assertEqual(self.spool.collect_garbage([blob_id1]), 1)
+    self.assertEqual(self.spool.blob_ids(), set([blob_id1]))
+
+  def test_release(self):
+    blob_id1 = self.spool.put(b"content1")
+    blob_id2 = self.spool.put(b"content2")
+    blob_id3 = self.spool.put(b"content3")
+    self.spool.start_release([blob_id1, blob_id2, blob_id3])
+    # Spooling the blob again meanwhile keeps it, even if no references are found yet.
+    self.assertEqual(self.spool.put(b"content2"), blob_id2)
+    self.spool.finish_release([blob_id1, blob_id2, blob_id3], set([blob_id3]))
+    self.assertEqual(self.spool.blob_ids(), set([blob_id2, blob_id3]))
+    self.assertEqual(self.spool.releasing_blobs, {})
+    self.assertEqual(self.spool.respooled_blobs, set())
@@ -0,0 +1,124 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests media transfers."""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import create_autospec, patch
+
+from pumaduct import logger_format
+from pumaduct import matrix_client
+from pumaduct.media_transfers import MediaTransfers
+
+def downloading(*chunks):
+  def download_content(server, media_id, dest=None, timeout=None):
+    del server, media_id, timeout # Unused.
+    for chunk in chunks:
+      dest.write(chunk)
+    return True
+  return download_content
+
+class MediaTransfersTest(unittest.TestCase):
+  """Tests media transfers."""
+
+  def setUp(self):
+    logger_format.setup()
+    self.path = tempfile.mkdtemp(prefix="pumaduct-transfers-")
+    self.mc = create_autospec(matrix_client.Client)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+    logger_format.clean()
+
+  def create_transfers(self, **kwargs):
+    transfers = MediaTransfers(self.mc, self.path, workers=0, **kwargs)
+    transfers.__enter__()
+    return transfers
+
+  def test_download_and_release(self):
+    os.makedirs(os.path.join(self.path, "downloads"))
+    with open(os.path.join(self.path, "downloads", "leftover"), "wb"):
+      pass
+    with open(os.path.join(self.path, "other"), "wb"):
+      pass
+    transfers = self.create_transfers()
+    # Leftovers of the previous run should be removed, other files should be kept.
+    self.assertEqual(os.listdir(transfers.downloads_path), [])
+    self.assertEqual(sorted(os.listdir(self.path)), ["downloads", "other"])
+    self.mc.download_content.side_effect = downloading(b"abc", b"def")
+    path = transfers.download("localhost", "/media")
+    with open(path, "rb") as content:
+      self.assertEqual(content.read(), b"abcdef")
+    self.assertEqual(transfers.usage, 6)
+    transfers.release(path)
+    self.assertEqual(os.listdir(transfers.downloads_path), [])
+    self.assertEqual(transfers.usage, 0)
+    self.mc.download_content.return_value = None
+    self.mc.download_content.side_effect = None
+    self.assertIsNone(transfers.download("localhost", "/media"))
+    self.assertEqual(os.listdir(transfers.downloads_path), [])
+
+  def test_download_quota(self):
+    transfers = self.create_transfers(quota=10)
+    self.mc.download_content.side_effect = downloading(b"abcdef")
+    path = transfers.download("localhost", "/media1")
+    # The second download doesn't fit into the quota.
+    self.mc.download_content.side_effect = downloading(b"abc", b"def")
+    with self.assertLogs(level="ERROR"):
+      self.assertIsNone(transfers.download("localhost", "/media2"))
+    self.assertEqual(os.listdir(transfers.downloads_path), [os.path.basename(path)])
+    self.assertEqual(transfers.usage, 6)
+    transfers.release(path)
+    self.assertIsNotNone(transfers.download("localhost", "/media2"))
+
+  def test_timeout(self):
+    transfers = self.create_transfers(timeout=10)
+    self.mc.download_content.side_effect = downloading(b"abc", b"def")
+    with patch("time.monotonic", side_effect=[0, 5, 11]):
+      with self.assertLogs(level="ERROR") as log_cm:
+        self.assertIsNone(transfers.download("localhost", "/media"))
+    self.assertIn("timed out", log_cm.output[0])
+    self.assertEqual(transfers.usage, 0)
+    self.assertEqual(os.listdir(transfers.downloads_path), [])
+
+  def test_upload(self):
+    transfers = self.create_transfers()
+    uploads = []
+    def upload_content(content_type, data, timeout=None):
+      uploads.append((content_type, data.read(), timeout))
+      return "mxc://localhost/media"
+    self.mc.upload_content.side_effect = upload_content
+    url = transfers.upload("image/gif", lambda: io.BytesIO(b"GIF"))
+    self.assertEqual(url, "mxc://localhost/media")
+    self.assertEqual(uploads, [("image/gif", b"GIF", transfers.timeout)])
+    # Content that cannot be opened fails the upload.
+    def open_content():
+      raise FileNotFoundError("missing")
+    with self.assertLogs(level="ERROR"):
+      self.assertIsNone(transfers.upload("image/gif", open_content))
+
+  def test_workers(self):
+    transfers = MediaTransfers(self.mc, self.path, workers=2)
+    with transfers:
+      self.assertIsNotNone(transfers.executor)
+    self.assertIsNone(transfers.executor)
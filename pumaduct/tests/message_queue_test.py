@@ -0,0 +1,274 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests offline messages queue backends."""
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from pumaduct import logger_format
+from pumaduct.message_queue import JournalMessageQueue, SqlMessageQueue, create_message_queue
+from pumaduct.payload_codec import PayloadCodec
+from pumaduct.storage import Base, Message
+from pumaduct.storage_service import StorageService
+
+def message_fields(sender, time, destination="client"):
+  return {
+      "network": "prpl-jabber", "ext_user": "test@localhost", "room_id": "room_id1",
+      "sender": sender, "recipient": "@xmpp-test2:localhost", "destination": destination,
+      "time": time, "payload": {}, "blob_id": None}
+
+def client_pages(queue, network="prpl-jabber", ext_user="test@localhost", process_page=None):
+  """Returns the pages of messages to the client passed by the walk through the queue,
+  `process_page` returns True to stop it."""
+  pages = []
+  def on_page(page):
+    pages.append(page)
+    return process_page(page) if process_page else False
+  queue.walk_pages_to_client("@test:localhost", network, ext_user, on_page, lambda: None)
+  return pages
+
+class JournalMessageQueueTest(unittest.TestCase):
+  """Tests journal-based offline messages queue."""
+
+  def setUp(self):
+    logger_format.setup()
+    self.path = tempfile.mkdtemp(prefix="pumaduct-queue-")
+    self.glib = Mock()
+    self.glib.timeout_add_seconds.return_value = 1
+    self.dt = datetime(1970, 1, 1, 3, 25, 45)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+    logger_format.clean()
+
+  def create_queue(self, **kwargs):
+    queue = JournalMessageQueue(self.glib, self.path, 2, **kwargs)
+    queue.start()
+    return queue
+
+  def test_pages_and_remove(self):
+    queue = self.create_queue()
+    # Insert out of order - pages should be ordered by time.
+    for i in (3, 1, 2, 0, 4):
+      queue.put(**message_fields("@test:localhost", self.dt + timedelta(seconds=i)))
+    queue.put(**message_fields("@test:localhost", self.dt, "matrix"))
+    self.assertEqual(sorted(queue.depths()), [
+        ("client", "@test:localhost", "prpl-jabber", "test@localhost", 5),
+        ("matrix", None, None, None, 1)])
+    pages = client_pages(queue)
+    self.assertEqual([len(page) for page in pages], [2, 2, 1])
+    times = [message.time for page in pages for message in page]
+    self.assertEqual(times, sorted(times))
+    # Removing while walking should not skip any messages.
+    pages = client_pages(queue, process_page=lambda page: queue.remove(
+        [message.id for message in page]))
+    self.assertEqual(sum(len(page) for page in pages), 5)
+    self.assertEqual(queue.depths(), [("matrix", None, None, None, 1)])
+    pages = []
+    queue.walk_pages_to_matrix(pages.append, lambda: None)
+    self.assertEqual(len(pages), 1)
+    queue.stop()
+
+  def test_walk_pages(self):
+    queue = self.create_queue(group_commit_size=1000)
+    for i in range(3000):
+      queue.put(**message_fields("@test:localhost", self.dt + timedelta(seconds=i)))
+    seen = []
+    done = Mock()
+    def process_page(page):
+      seen.extend(message.id for message in page)
+      queue.remove([message.id for message in page])
+    # Pages are returned right away, that shouldn't recurse for each of them.
+    queue.walk_pages_to_client(
+        "@test:localhost", "prpl-jabber", "test@localhost", process_page, done)
+    self.assertEqual(len(seen), 3000)
+    done.assert_called_once_with()
+    # Processing can stop the walk.
+    queue.put(**message_fields("@test:localhost", self.dt, "matrix"))
+    queue.put(**message_fields("@test:localhost", self.dt, "matrix"))
+    queue.put(**message_fields("@test:localhost", self.dt, "matrix"))
+    pages = []
+    queue.walk_pages_to_matrix(lambda page: pages.append(page) or True, done)
+    self.assertEqual([len(page) for page in pages], [2])
+    self.assertEqual(done.call_count, 2)
+    queue.stop()
+
+  def test_group_commit(self):
+    queue = self.create_queue(group_commit_size=3)
+    queue.put(**message_fields("@test:localhost", self.dt))
+    # Not written yet, but the group commit is scheduled.
+    self.assertEqual(len(queue.pending), 1)
+    (interval, callback) = self.glib.timeout_add_seconds.call_args[0]
+    self.assertEqual(interval, 1)
+    self.assertFalse(callback())
+    self.assertEqual(len(queue.pending), 0)
+    # Reaching the group size should write the records right away.
+    self.glib.timeout_add_seconds.reset_mock()
+    for _ in range(3):
+      queue.put(**message_fields("@test:localhost", self.dt))
+    self.assertEqual(len(queue.pending), 0)
+    self.glib.source_remove.assert_called_with(1)
+    queue.stop()
+
+  def test_replay(self):
+    queue = self.create_queue()
+    message1 = queue.put(**message_fields("@test:localhost", self.dt))
+    queue.put(**message_fields("@test:localhost", self.dt + timedelta(seconds=1)))
+    queue.remove([message1.id])
+    queue.stop()
+    # Simulate crash in the middle of writing the record.
+    segment = os.path.join(self.path, sorted(os.listdir(self.path))[-1])
+    with open(segment, "ab") as segment_file:
+      segment_file.write(b'{"put": {"id": 3')
+    queue = self.create_queue()
+    messages = [message for page in client_pages(queue) for message in page]
+    self.assertEqual([message.id for message in messages], [2])
+    self.assertEqual(messages[0].time, self.dt + timedelta(seconds=1))
+    # IDs should not be reused.
+    self.assertEqual(queue.put(**message_fields("@test:localhost", self.dt)).id, 3)
+    queue.stop()
+
+  def test_compaction(self):
+    queue = self.create_queue(group_commit_size=1, segment_size=512)
+    for _ in range(20):
+      message = queue.put(**message_fields("@test:localhost", self.dt))
+      queue.remove([message.id])
+    live = queue.put(**message_fields("@test:localhost", self.dt))
+    queue.stop()
+    # Journal should have been compacted along the way, keeping it small.
+    self.assertLess(queue.records, 10)
+    self.assertLess(len(os.listdir(self.path)), 3)
+    queue = self.create_queue()
+    self.assertEqual(list(queue.messages), [live.id])
+    self.assertEqual(len(os.listdir(self.path)), 1)
+    queue.stop()
+
+  def test_expire(self):
+    queue = self.create_queue()
+    queue.put(**message_fields("@test1:localhost", self.dt + timedelta(seconds=3)))
+    queue.put(**message_fields("@test1:localhost", self.dt + timedelta(seconds=1)))
+    queue.put(**message_fields("@test2:localhost", self.dt + timedelta(seconds=2)))
+    queue.put(**message_fields("@test2:localhost", self.dt + timedelta(seconds=4)))
+    queue.put(**message_fields("@test2:localhost", self.dt, "matrix"))
+    expired = []
+    queue.expire("client", self.dt + timedelta(seconds=4), 2, expired.extend)
+    self.assertEqual(
+        [message.time for message in expired],
+        [self.dt + timedelta(seconds=1), self.dt + timedelta(seconds=2)])
+    queue.expire("client", self.dt + timedelta(seconds=4), 2, expired.extend)
+    self.assertEqual(len(expired), 3)
+    self.assertEqual(sorted(queue.depths()), [
+        ("client", "@test2:localhost", "prpl-jabber", "test@localhost", 1),
+        ("matrix", None, None, None, 1)])
+    queue.stop()
+
+  def test_create_message_queue(self):
+    queue = create_message_queue(
+        {"offline_queue_backend": "journal", "offline_queue_journal_path": self.path},
+        self.glib, None, None, 10)
+    self.assertIsInstance(queue, JournalMessageQueue)
+    with self.assertRaises(ValueError):
+      create_message_queue({"offline_queue_backend": "smth"}, self.glib, None, None, 10)
+
+class SqlMessageQueueTest(unittest.TestCase):
+  """Tests SQL-based offline messages queue."""
+
+  def setUp(self):
+    logger_format.setup()
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    self.storage_service = StorageService(None, sessionmaker(bind=engine)(), threaded=False)
+    self.dt = datetime(1970, 1, 1, 3, 25, 45)
+
+  def tearDown(self):
+    self.storage_service.db_session.close()
+    logger_format.clean()
+
+  def create_queue(self, **kwargs):
+    return SqlMessageQueue(self.storage_service, Message, 2, PayloadCodec(), **kwargs)
+
+  def test_pages_and_remove(self):
+    queue = self.create_queue()
+    for i in (3, 1, 2, 0, 4):
+      queue.put(**message_fields("@test:localhost", self.dt + timedelta(seconds=i)))
+    no_account = message_fields("@test:localhost", self.dt)
+    no_account.update(network=None, ext_user=None)
+    queue.put(**no_account)
+    pages = client_pages(queue, process_page=lambda page: queue.remove(
+        [message.id for message in page]))
+    self.assertEqual(
+        [message.time for page in pages for message in page],
+        [self.dt + timedelta(seconds=i) for i in range(5)])
+    pages = client_pages(queue, None, None)
+    self.assertEqual([len(page) for page in pages], [1])
+    self.assertEqual(pages[0][0].payload, {})
+
+  def test_walk_pages_deferred(self):
+    queue = self.create_queue()
+    for i in range(5):
+      queue.put(**message_fields("@test:localhost", self.dt + timedelta(seconds=i)))
+    # Defer the storage operations, as if these were performed by the storage thread.
+    deferred = []
+    submit = self.storage_service.submit
+    self.storage_service.submit = lambda *args: deferred.append(lambda: submit(*args))
+    pages = []
+    done = Mock()
+    queue.walk_pages_to_client(
+        "@test:localhost", "prpl-jabber", "test@localhost", pages.append, done)
+    self.assertEqual(pages, [])
+    while deferred:
+      deferred.pop(0)()
+    self.assertEqual([len(page) for page in pages], [2, 2, 1])
+    done.assert_called_once_with()
+    referenced = Mock()
+    queue.referenced_blob_ids({"blob1"}, callback=referenced)
+    referenced.assert_not_called()
+    deferred.pop(0)()
+    referenced.assert_called_once_with(set())
+
+  def test_claim(self):
+    queue1 = self.create_queue(claim_lease=60, worker_id="worker1")
+    queue2 = self.create_queue(claim_lease=60, worker_id="worker2")
+    for i in range(3):
+      queue1.put(**message_fields("@test:localhost", datetime.utcnow() + timedelta(seconds=i)))
+    # The first page is claimed by the first worker, so the second one only gets the rest.
+    (page1,) = client_pages(queue1, process_page=lambda page: True)
+    self.assertEqual(len(page1), 2)
+    pages2 = client_pages(queue2)
+    self.assertEqual([len(page) for page in pages2], [1])
+    # The claim doesn't prevent the first worker from retrying its own messages.
+    pages1 = client_pages(queue1)
+    self.assertEqual([message.id for message in pages1[0]], [message.id for message in page1])
+    # Expired claims can be taken over.
+    queue3 = self.create_queue(claim_lease=60, worker_id="worker3")
+    self.storage_service.call(lambda db_session: db_session.query(Message).update(
+        {Message.claimed_until: datetime.utcnow() - timedelta(seconds=1)}))
+    pages3 = client_pages(queue3)
+    self.assertEqual(sum(len(page) for page in pages3), 3)
+    # Claims must survive restarts, so the worker ID can't be generated.
+    with self.assertRaises(ValueError):
+      self.create_queue(claim_lease=60)
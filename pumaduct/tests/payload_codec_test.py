@@ -0,0 +1,79 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests offline messages payload codec."""
+
+import json
+import unittest
+
+from pumaduct import logger_format
+from pumaduct import payload_codec
+from pumaduct.payload_codec import PayloadCodec, PayloadCodecError
+
+SMALL_PAYLOAD = {"msgtype": "m.text", "body": "Test"}
+LARGE_PAYLOAD = {
+    "msgtype": "m.text", "body": "Test message " * 100,
+    "format": "org.matrix.custom.html", "formatted_body": "<b>Test message</b> " * 100}
+
+class PayloadCodecTest(unittest.TestCase):
+  """Tests offline messages payload codec."""
+
+  def setUp(self):
+    logger_format.setup()
+
+  def tearDown(self):
+    logger_format.clean()
+
+  def test_roundtrip(self):
+    codec = PayloadCodec()
+    for payload in (SMALL_PAYLOAD, LARGE_PAYLOAD, {"body": "Тест"}):
+      self.assertEqual(codec.decode(codec.encode(payload)), payload)
+
+  def test_compression_threshold(self):
+    codec = PayloadCodec()
+    small = codec.encode(SMALL_PAYLOAD)
+    self.assertEqual(small[0], payload_codec.FORMAT_VERSION)
+    self.assertEqual(small[2], payload_codec.COMPRESSION_NONE)
+    large = codec.encode(LARGE_PAYLOAD)
+    self.assertEqual(large[2], payload_codec.COMPRESSION_ZLIB)
+    self.assertLess(len(large), len(json.dumps(LARGE_PAYLOAD)) / 4)
+    uncompressed = PayloadCodec("none").encode(LARGE_PAYLOAD)
+    self.assertEqual(uncompressed[2], payload_codec.COMPRESSION_NONE)
+    # Any codec instance should be able to decode payloads regardless of its settings.
+    self.assertEqual(codec.decode(uncompressed), LARGE_PAYLOAD)
+
+  def test_zstd_fallback(self):
+    codec = PayloadCodec("zstd")
+    self.assertEqual(codec.decode(codec.encode(LARGE_PAYLOAD)), LARGE_PAYLOAD)
+    if not payload_codec.zstandard:
+      self.assertEqual(codec.compression, payload_codec.COMPRESSION_ZLIB)
+
+  def test_decode_stored(self):
+    codec = PayloadCodec()
+    self.assertEqual(codec.decode_stored(json.dumps(SMALL_PAYLOAD), None), SMALL_PAYLOAD)
+    self.assertEqual(codec.decode_stored("", codec.encode(SMALL_PAYLOAD)), SMALL_PAYLOAD)
+
+  def test_invalid(self):
+    codec = PayloadCodec()
+    with self.assertRaises(PayloadCodecError):
+      codec.decode(b"\x00\x00\x00{}")
+    with self.assertRaises(PayloadCodecError):
+      codec.decode(bytes((payload_codec.FORMAT_VERSION, 0, 7)) + b"{}")
+    with self.assertRaises(ValueError):
+      PayloadCodec("lzma")
@@ -0,0 +1,63 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests retry schedule."""
+
+import unittest
+from unittest.mock import Mock
+
+from pumaduct.retry_schedule import RetrySchedule
+
+class RetryScheduleTest(unittest.TestCase):
+  """Tests retry schedule."""
+
+  def setUp(self):
+    self.glib = Mock()
+    self.glib.timeout_add_seconds.return_value = 1
+    self.schedule = RetrySchedule(self.glib, 1, 4)
+
+  def test_backoff(self):
+    attempts = []
+    intervals = []
+    for _ in range(4):
+      self.schedule.schedule("key", lambda: attempts.append("key"), backoff=True)
+      # Already scheduled retry is kept as is.
+      self.schedule.schedule("key", lambda: attempts.append("other"), backoff=True)
+      (interval, callback) = self.glib.timeout_add_seconds.call_args[0]
+      intervals.append(interval)
+      self.assertFalse(callback())
+    self.assertEqual(intervals, [1, 2, 4, 4])
+    self.assertEqual(attempts, ["key"] * 4)
+    self.assertEqual(self.schedule.cbs, {})
+    # Reset restarts from the base interval.
+    self.schedule.reset("key")
+    self.schedule.schedule("key", lambda: None, backoff=True)
+    self.assertEqual(self.glib.timeout_add_seconds.call_args[0][0], 1)
+
+  def test_cancel_and_clear(self):
+    self.schedule.schedule("key1", lambda: None)
+    self.schedule.schedule("key2", lambda: None)
+    self.schedule.cancel("key1")
+    self.glib.source_remove.assert_called_once_with(1)
+    # Cancelled retry keeps its interval.
+    self.assertEqual(self.schedule.intervals, {"key1": 1, "key2": 1})
+    self.schedule.clear()
+    self.assertEqual(self.glib.source_remove.call_count, 2)
+    self.assertEqual(self.schedule.cbs, {})
+    self.assertEqual(self.schedule.intervals, {})
@@ -0,0 +1,110 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests storage service."""
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import ANY, Mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from pumaduct import logger_format
+from pumaduct.storage import Base, Account
+from pumaduct.storage_service import StorageService
+
+def add_account(ext_user):
+  def add(db_session):
+    db_session.add(Account(
+        user="@test:localhost", network="prpl-jabber", ext_user=ext_user, password="password"))
+  return add
+
+def count_accounts(db_session):
+  return db_session.query(Account).count()
+
+class StorageServiceTest(unittest.TestCase):
+  """Tests storage service."""
+
+  def setUp(self):
+    logger_format.setup()
+    (fd, self.db_path) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    engine = create_engine("sqlite:///" + self.db_path)
+    Base.metadata.create_all(engine)
+    self.db_session = sessionmaker(bind=engine)()
+    self.glib = Mock()
+    self.glib.main_context_invoke.side_effect = lambda callback: callback()
+
+  def tearDown(self):
+    self.db_session.close()
+    os.unlink(self.db_path)
+    logger_format.clean()
+
+  def test_threaded(self):
+    service = StorageService(self.glib, self.db_session)
+    threads = []
+    with service:
+      for i in range(10):
+        service.submit(add_account("test{0}@localhost".format(i)),
+                       lambda result: threads.append(threading.current_thread()))
+      self.assertEqual(service.call(count_accounts), 10)
+    self.assertEqual(len(threads), 10)
+    self.assertEqual(self.glib.main_context_invoke.call_count, 10)
+    self.assertNotIn(threading.current_thread(), threads)
+
+  def test_failed_operation_in_batch(self):
+    service = StorageService(self.glib, self.db_session)
+    callback = Mock()
+    error_callback = Mock()
+    with service:
+      with self.assertLogs("pumaduct.storage_service", level="ERROR") as log_cm:
+        service.submit(add_account("test1@localhost"), error_callback=error_callback)
+        # Violates unique constraint on (network, ext_user).
+        service.submit(add_account("test1@localhost"), callback, error_callback)
+        service.submit(add_account("test2@localhost"))
+        self.assertEqual(service.call(count_accounts), 2)
+      self.assertIn("Storage operation failed", log_cm.output[0])
+    callback.assert_not_called()
+    # Only the failed operation reports the error.
+    error_callback.assert_called_once_with(ANY)
+    self.assertIsInstance(error_callback.call_args[0][0], IntegrityError)
+
+  def test_call_error(self):
+    service = StorageService(self.glib, self.db_session)
+    def fail(db_session):
+      del db_session # Unused.
+      raise ValueError("Something bad happened")
+    with service:
+      with self.assertLogs("pumaduct.storage_service", level="ERROR"):
+        with self.assertRaises(ValueError):
+          service.call(fail)
+      self.assertEqual(service.call(count_accounts), 0)
+
+  def test_inline(self):
+    service = StorageService(self.glib, self.db_session, threaded=False)
+    callback = Mock()
+    with service:
+      service.submit(add_account("test1@localhost"), callback)
+      callback.assert_called_with(None)
+      self.assertEqual(self.db_session.query(Account).count(), 1)
+    self.glib.main_context_invoke.assert_not_called()
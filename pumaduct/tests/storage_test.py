@@ -0,0 +1,113 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests PuMaDuct persistent storage."""
+
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+from pumaduct import logger_format
+from pumaduct.storage import Base, SQLITE_AUTO_VACUUM_INCREMENTAL
+from pumaduct.storage import create_db_engine, maintain, upgrade
+
+# Schema of 'pumaduct_message' table before any indexes or columns were added.
+OLD_MESSAGE_TABLE = """
+CREATE TABLE pumaduct_message (
+  id INTEGER NOT NULL PRIMARY KEY,
+  network VARCHAR,
+  ext_user VARCHAR,
+  room_id VARCHAR,
+  sender VARCHAR NOT NULL,
+  recipient VARCHAR,
+  destination VARCHAR(6) NOT NULL,
+  time DATETIME NOT NULL,
+  payload VARCHAR NOT NULL)
+"""
+
+class StorageTest(unittest.TestCase):
+  """Tests PuMaDuct persistent storage."""
+
+  def setUp(self):
+    logger_format.setup()
+    self.engine = create_engine("sqlite:///:memory:")
+
+  def tearDown(self):
+    logger_format.clean()
+
+  def test_upgrade_creates_indexes(self):
+    self.engine.execute(OLD_MESSAGE_TABLE)
+    Base.metadata.create_all(self.engine)
+    self.assertEqual(inspect(self.engine).get_indexes("pumaduct_message"), [])
+    upgrade(self.engine)
+    indexes = set(
+        index["name"] for index in inspect(self.engine).get_indexes("pumaduct_message"))
+    self.assertEqual(indexes, set([
+        "ix_pumaduct_message_client", "ix_pumaduct_message_matrix",
+        "ix_pumaduct_message_blob_id"]))
+    columns = [column["name"] for column in inspect(self.engine).get_columns("pumaduct_message")]
+    self.assertIn("blob_id", columns)
+    # Should be no-op on the up to date schema.
+    upgrade(self.engine)
+
+  def test_upgrade_enables_incremental_vacuum(self):
+    (fd, db_path) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    self.addCleanup(os.unlink, db_path)
+    engine = create_engine("sqlite:///" + db_path)
+    Base.metadata.create_all(engine)
+    self.assertNotEqual(engine.execute("PRAGMA auto_vacuum").scalar(),
+                        SQLITE_AUTO_VACUUM_INCREMENTAL)
+    upgrade(engine)
+    self.assertEqual(engine.execute("PRAGMA auto_vacuum").scalar(),
+                     SQLITE_AUTO_VACUUM_INCREMENTAL)
+    db_session = sessionmaker(bind=engine)()
+    maintain(db_session, 100)
+    db_session.commit()
+    # ANALYZE should have created planner statistics.
+    self.assertIn("sqlite_stat1", inspect(engine).get_table_names())
+
+  def test_create_db_engine_sqlite_pragmas(self):
+    (fd, db_path) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    self.addCleanup(os.unlink, db_path)
+    engine = create_db_engine({"db_spec": "sqlite:///" + db_path, "sqlite_synchronous": "FULL"})
+    self.assertEqual(engine.execute("PRAGMA journal_mode").scalar(), "wal")
+    # FULL synchronous level is 2.
+    self.assertEqual(engine.execute("PRAGMA synchronous").scalar(), 2)
+    engine.dispose()
+    for suffix in ("-wal", "-shm"):
+      if os.path.exists(db_path + suffix):
+        os.unlink(db_path + suffix)
+
+  def test_delivery_queries_use_indexes(self):
+    Base.metadata.create_all(self.engine)
+    plan = " ".join(str(row) for row in self.engine.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM pumaduct_message WHERE network = 'n' AND "
+        "ext_user = 'u' AND sender = 's' AND destination = 'client' ORDER BY time"))
+    self.assertIn("ix_pumaduct_message_client", plan)
+    self.assertNotIn("TEMP B-TREE", plan)
+    plan = " ".join(str(row) for row in self.engine.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM pumaduct_message "
+        "WHERE destination = 'matrix' ORDER BY time"))
+    self.assertIn("ix_pumaduct_message_matrix", plan)
+    self.assertNotIn("TEMP B-TREE", plan)
@@ -21,7 +21,7 @@
 
 import unittest
 
-from pumaduct.utils import query_json_path
+from pumaduct.utils import intern_id, query_json_path
 
 class UtilsTest(unittest.TestCase):
   """Tests PuMaDuct utilities functions."""
@@ -30,3 +30,8 @@ class UtilsTest(unittest.TestCase):
     json = {"a": {"b": {"c": 1}}}
     self.assertEqual(query_json_path(json, "a", "b", "c"), 1)
     self.assertIsNone(query_json_path(json, "a", "b", "d"))
+
+  def test_intern_id(self):
+    user = "".join(["@test", ":localhost"])
+    self.assertIs(intern_id(user), intern_id("@test:localhost"))
+    self.assertIsNone(intern_id(None))
@@ -0,0 +1,117 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests worker pool."""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import unittest
+from unittest.mock import Mock
+
+from pumaduct import logger_format
+from pumaduct.worker_pool import WorkerPool
+
+class WorkerPoolTest(unittest.TestCase):
+  """Tests worker pool."""
+
+  def setUp(self):
+    logger_format.setup()
+    self.invoked = []
+    self.glib = Mock()
+    self.glib.main_context_invoke.side_effect = self.invoked.append
+
+  def tearDown(self):
+    logger_format.clean()
+
+  def test_ordering_per_key(self):
+    pool = WorkerPool(self.glib, 2)
+    results = []
+    release = threading.Event()
+    def slow(value):
+      release.wait()
+      return value
+    with pool:
+      pool.submit("room1", results.append, slow, ("slow",))
+      pool.submit("room1", results.append, str.upper, ("fast",), offload=False)
+      pool.submit("room1", lambda: results.append("no-op"))
+      # Other keys are not affected.
+      pool.submit("room2", results.append, str.upper, ("other",), offload=False)
+      self.assertEqual(results, ["OTHER"])
+      release.set()
+    # Remaining tasks are completed on exit.
+    self.assertEqual(results, ["OTHER", "slow", "FAST", "no-op"])
+    self.assertEqual(pool.pending, {})
+
+  def test_results_delivered_to_main_loop(self):
+    pool = WorkerPool(self.glib, 1)
+    results = []
+    with pool:
+      pool.submit("room1", results.append, str.upper, ("test",))
+      pool.executor.shutdown(wait=True)
+      self.assertEqual(results, [])
+      for callback in self.invoked:
+        callback()
+      self.assertEqual(results, ["TEST"])
+      self.assertEqual(pool.pending, {})
+
+  def test_failed_task(self):
+    pool = WorkerPool(self.glib, 0)
+    results = []
+    errors = []
+    with pool:
+      with self.assertLogs("pumaduct.worker_pool", level="ERROR"):
+        pool.submit("room1", results.append, int, ("not a number",), error_callback=errors.append)
+        # Without the error callback, the failure is only logged.
+        pool.submit("room1", results.append, int, ("not a number",))
+      pool.submit("room1", results.append, int, ("1",))
+    self.assertEqual(results, [1])
+    self.assertEqual(len(errors), 1)
+    self.assertIsInstance(errors[0], ValueError)
+
+  def test_failed_callback(self):
+    pool = WorkerPool(self.glib, 1)
+    results = []
+    release = threading.Event()
+    def slow(value):
+      release.wait()
+      return value
+    def fail(value):
+      raise ValueError(value)
+    with pool:
+      pool.submit("room1", fail, slow, ("slow",))
+      pool.submit("room1", results.append, str.upper, ("fast",), offload=False)
+      release.set()
+      with self.assertLogs("pumaduct.worker_pool", level="ERROR"):
+        pool.executor.shutdown(wait=True)
+        for callback in self.invoked:
+          callback()
+    # The failed callback doesn't prevent the following ones.
+    self.assertEqual(results, ["FAST"])
+    self.assertEqual(pool.pending, {})
+
+  def test_external_executor_drained(self):
+    pool = WorkerPool(self.glib, 0)
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      with pool:
+        pool.submit("room1", results.append, str.upper, ("test",), executor=executor)
+        pool.submit("room1", results.append, str.upper, ("next",), offload=False)
+      # Completed on exit, even though the pool has no workers of its own.
+      self.assertEqual(results, ["TEST", "NEXT"])
+      self.assertEqual(pool.pending, {})
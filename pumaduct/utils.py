@@ -20,11 +20,31 @@
 """Utility functionality for PuMaDuct."""
 
 from datetime import datetime
+import sys
 
 def get_event_datetime(event):
   """Converts Matrix server timestamp in the event to datetime()."""
   return datetime.utcfromtimestamp(event["origin_server_ts"] / 1000.0)
 
+# Defaults for the limits on bookkeeping data structures, see 'get_bookkeeping_limits'.
+DEFAULT_MAX_BOOKKEEPING_ITEMS = 100000
+DEFAULT_BOOKKEEPING_TTL = 86400
+
+def get_bookkeeping_limits(conf):
+  """Returns (max items, TTL in seconds) for the bounded bookkeeping data structures."""
+  return (
+      conf["max_bookkeeping_items"] if "max_bookkeeping_items" in conf
+      else DEFAULT_MAX_BOOKKEEPING_ITEMS,
+      conf["bookkeeping_ttl"] if "bookkeeping_ttl" in conf
+      else DEFAULT_BOOKKEEPING_TTL)
+
+def intern_id(value):
+  """Returns the shared copy of the given ID string from the interpreter string table.
+
+  IDs such as MXIDs are referenced from many data structures at once, interning them
+  makes sure only one copy of each ID is kept in memory."""
+  return sys.intern(value) if value is not None else None
+
 def query_json_path(json, *args):
   """Returns json value given its path in the hierarchy or None if not present."""
   for arg in args:
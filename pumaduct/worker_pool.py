@@ -0,0 +1,147 @@
+# PuMaDuct - integrates libpurple-supported IM protocols
+# into Matrix, see https://endl.ch/projects/pumaduct
+# https://matrix.org and https://developer.pidgin.im/wiki/WhatIsLibpurple
+#
+# Copyright (C) 2019 - 2020 Alexander Tsvyashchenko <matrix@endl.ch>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs CPU-heavy functions on worker threads or processes."""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+class WorkerTask(object):
+  """Function submitted to `WorkerPool`, together with its callback."""
+  __slots__ = ("callback", "error_callback", "with_result", "future", "completed", "result",
+               "error")
+
+  def __init__(self, callback, error_callback, with_result):
+    self.callback = callback
+    self.error_callback = error_callback
+    self.with_result = with_result
+    self.future = None
+    self.completed = False
+    self.result = None
+    self.error = None
+
+  def run(self, fn, args):
+    """Runs the function on the calling thread."""
+    try:
+      self.result = fn(*args) if fn else None
+    except Exception as e: # pylint: disable=broad-except
+      logger.exception("Worker task failed")
+      self.error = e
+    self.completed = True
+
+  def collect(self):
+    """Takes the result of the function that was run by the worker."""
+    if not self.completed:
+      self.completed = True
+      self.error = self.future.exception()
+      if self.error:
+        logger.error("Worker task failed: {0!r}", self.error)
+      else:
+        self.result = self.future.result()
+
+  def run_callback(self):
+    """Calls the callback with the result, or the error callback with the error."""
+    try:
+      if self.error:
+        if self.error_callback:
+          self.error_callback(self.error)
+      elif self.with_result:
+        self.callback(self.result)
+      else:
+        self.callback()
+    except Exception: # pylint: disable=broad-except
+      # Must not prevent the callbacks of the following tasks.
+      logger.exception("Worker task callback failed")
+
+class WorkerPool(object):
+  """
+  Runs functions on worker threads or processes, delivering results to the main loop.
+
+  Callbacks of the tasks submitted with the same key are called in the order
+  of submission, even if some of these tasks were not offloaded to the workers,
+  e.g. as too cheap. If the function of the task fails, its error callback
+  is called with the exception instead, if any.
+
+  With processes, functions and their arguments must be picklable. If
+  `workers` is zero, all functions are run right away on the calling thread.
+  """
+  def __init__(self, glib, workers, use_processes=False):
+    self.glib = glib
+    self.workers = workers
+    self.use_processes = use_processes
+    self.executor = None
+    # Tasks per key which callbacks were not called yet, in submission order.
+    self.pending = {}
+
+  def __enter__(self):
+    if self.workers:
+      executor_type = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+      self.executor = executor_type(max_workers=self.workers)
+
+  def __exit__(self, type_, value, traceback):
+    if self.executor:
+      self.executor.shutdown(wait=True)
+      self.executor = None
+    # The main loop might not be running anymore, so complete the remaining tasks here,
+    # including the ones offloaded to other executors.
+    for key in list(self.pending):
+      for task in self.pending[key]:
+        task.collect()
+      self._flush(key)
+
+  def submit( # pylint: disable=too-many-arguments
+      self, key, callback, fn=None, args=(), offload=True, executor=None, error_callback=None):
+    """Calls `fn(*args)`, then `callback` with its result in the main loop.
+
+    If `offload` is False or there are no workers, `fn` is called on the
+    calling thread. If `fn` is None, `callback` is called without arguments
+    once all preceding tasks with the same key are done. `executor` overrides
+    the pool's own one, e.g. for IO-bound functions. If `fn` fails,
+    `error_callback` is called with the exception instead of `callback`."""
+    task = WorkerTask(callback, error_callback, fn is not None)
+    executor = executor or self.executor
+    offload = offload and fn and executor
+    if not offload and key not in self.pending:
+      # Nothing to wait for.
+      task.run(fn, args)
+      task.run_callback()
+      return
+    self.pending.setdefault(key, deque()).append(task)
+    if offload:
+      task.future = executor.submit(fn, *args)
+      task.future.add_done_callback(lambda _: self.glib.main_context_invoke(
+          functools.partial(self._on_done, key, task)))
+    else:
+      task.run(fn, args)
+      self._flush(key)
+
+  def _on_done(self, key, task):
+    task.collect()
+    self._flush(key)
+
+  def _flush(self, key):
+    tasks = self.pending.get(key)
+    while tasks and tasks[0].completed:
+      tasks.popleft().run_callback()
+    if key in self.pending and not self.pending[key]:
+      del self.pending[key]
@@ -61,6 +61,14 @@ setup(
         "python-magic>=0.4.18",
         "sqlalchemy>=1.3.19"
         ],
+    extras_require={
+        # Dimensions and thumbnails of images sent to Matrix.
+        "images": ["Pillow>=7.2.0"],
+        # Compact serialization of offline messages payloads.
+        "msgpack": ["msgpack>=1.0.0"],
+        # "zstd" compression of offline messages payloads.
+        "zstd": ["zstandard>=0.14.0"]
+        },
     data_files=[("/etc/synapse", ["pumaduct.yaml", "synapse-pumaduct.yaml", "pumaduct.log.config"])],
     entry_points={
         "console_scripts": [